@@ -1,14 +1,34 @@
+import os
 import re
 import json
+import tempfile
 import time
+import heapq
+import random
+import itertools
 from datetime import datetime, timedelta, date
+import numpy as np
 import pandas as pd
 import streamlit as st
 import uuid
+import bisect
+import threading
+import sys
+import html
+import functools
+import hashlib
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Google Sheets (gspread) ---
 import gspread
 from google.oauth2.service_account import Credentials
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Tab frames are shared across sessions (see load_sheet): with copy-on-write every
+# derived frame copies lazily, so a caller mutating its copy never touches the original.
+pd.set_option("mode.copy_on_write", True)
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -23,9 +43,19 @@ TAB_VEHICLE_MODELS     = "vehicle_models"  # NEW: model->class mapping
 TAB_EMPLOYEES          = "employees"
 TAB_COMMISSION_POLICY  = "commission_policy"
 TAB_ATTENDANCE         = "attendance"
-TAB_TRANSACTIONS       = "transactions"
+TAB_TRANSACTIONS       = "transactions"   # legacy: one denormalized row per service line
+TAB_VISITS             = "visits"         # one row per visit
+TAB_VISIT_LINES        = "visit_lines"    # one row per service line, keyed by visit_id
 TAB_PAYROLL_EXPORTS    = "payroll_exports"  # optional archive tab (append-only)
 
+# Branch shards: attendance/transactions of a branch can live in its own workbook, e.g.
+#   [sheets.branch_workbooks]
+#   B1 = "RJ_AutoSpa_B1"
+# Branches without an entry stay in SHEET_NAME; the catalog tabs always do.
+BRANCHES               = ["B1", "B2"]
+BRANCH_WORKBOOKS       = {str(b).upper(): wb for b, wb in dict(st.secrets["sheets"].get("branch_workbooks", {})).items()}
+SHARDED_TABS           = [TAB_ATTENDANCE, TAB_TRANSACTIONS, TAB_VISITS, TAB_VISIT_LINES]
+
 # Transactions expected columns (supports multi-service visits)
 TX_COLS = [
     "timestamp_iso","shift_id","visit_id","branch_id","plate","vehicle_model","vehicle_class","service","units",
@@ -33,6 +63,14 @@ TX_COLS = [
     "performed_by_employee_id","customer_name","customer_phone","notes"
 ]
 
+# Normalized storage of the same data: visit fields once per visit, lines keyed by visit_id.
+# Readers get TX_COLS rows back from the joined view (see load_transactions).
+VISIT_COLS = [
+    "visit_id","timestamp_iso","shift_id","branch_id","plate","vehicle_model","vehicle_class",
+    "amount_paid_peso","payment_method","customer_name","customer_phone"
+]
+LINE_COLS = ["visit_id","service","units","price_peso","amount_peso","performed_by_employee_id","notes"]
+
 # Add near TX_COLS
 ATT_COLS = ["timestamp_iso","shift_id","branch_id","employee_id","action"]
 
@@ -59,30 +97,556 @@ def get_client():
     client = gspread.authorize(creds)
     return client
 
-@st.cache_data(ttl=30)
-def load_sheet(sheet_name, tab):
-    client = get_client()
-    sh = client.open(sheet_name)
+# ======= SHEETS API SCHEDULER (shared by all sessions in this process) =======
+SHEETS_QUOTA_PER_MIN = int(st.secrets["sheets"].get("quota_per_minute", 60))
+PRIORITY_WRITE, PRIORITY_READ, PRIORITY_BACKGROUND = 0, 1, 2
+
+class SheetsScheduler:
+    """
+    Every Sheets API call goes through here:
+    - token bucket sized to the per-minute quota; waiters are served by priority
+      (writes, then page reads, then background refreshes), FIFO within a priority
+    - identical in-flight reads are coalesced into one request (never with one issued
+      before the last write to the tab it reads)
+    - 429/5xx responses are retried with jittered exponential backoff
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, per_minute=SHEETS_QUOTA_PER_MIN, max_retries=5, backoff_base=1.0, backoff_cap=32.0):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0  # tokens per second
+        self.max_retries = max_retries
+        self.backoff_base, self.backoff_cap = backoff_base, backoff_cap
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._inflight = {}  # read key -> {"event", "result", "error"}
+        self._written = {}   # (workbook, tab) -> writes finished, part of its read keys
+        self._inflight_lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "wait_s": 0.0}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _acquire(self, priority):
+        t0 = time.monotonic()
+        with self._cond:
+            me = (priority, next(self._seq))
+            heapq.heappush(self._waiters, me)
+            while True:
+                self._refill()
+                if self._waiters[0] == me and self._tokens >= 1:
+                    heapq.heappop(self._waiters)
+                    self._tokens -= 1
+                    self._cond.notify_all()
+                    break
+                self._cond.wait(timeout=max(0.01, (1 - self._tokens) / self.rate))
+            self.stats["calls"] += 1
+            self.stats["wait_s"] += time.monotonic() - t0
+
+    def call(self, fn, *args, priority=PRIORITY_READ, writes=(), **kwargs):
+        """
+        Run one API call under the quota, retrying quota/server errors.
+        writes: (workbook, tab) pairs the call changes; see read().
+        """
+        try:
+            for attempt in range(self.max_retries + 1):
+                self._acquire(priority)
+                try:
+                    return fn(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    status = getattr(e.response, "status_code", None)
+                    if status not in self.RETRY_STATUS or attempt == self.max_retries:
+                        raise
+                    self.stats["retries"] += 1
+                    # full jitter: sleep U(0, min(cap, base * 2^attempt))
+                    time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+        finally:
+            if writes:  # even a failed write may have landed
+                with self._inflight_lock:
+                    for tab in writes:
+                        self._written[tab] = self._written.get(tab, 0) + 1
+
+    def read(self, key, fn, *args, priority=PRIORITY_READ, reads=None, **kwargs):
+        """
+        Like call(), but concurrent reads with the same key share one request.
+        reads: the (workbook, tab) read; a read only joins one issued after the last
+        write to it, so a session reading back its own write never gets older data.
+        """
+        with self._inflight_lock:
+            if reads is not None:
+                key = (key, self._written.get(reads, 0))
+            slot = self._inflight.get(key)
+            leader = slot is None
+            if leader:
+                slot = {"event": threading.Event(), "result": None, "error": None}
+                self._inflight[key] = slot
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            slot["event"].wait()
+            if slot["error"] is not None:
+                raise slot["error"]
+            return slot["result"]
+        try:
+            slot["result"] = self.call(fn, *args, priority=priority, **kwargs)
+            return slot["result"]
+        except Exception as e:
+            slot["error"] = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            slot["event"].set()
+
+@st.cache_resource
+def get_scheduler():
+    return SheetsScheduler()
+
+@st.cache_resource
+def _open_workbook(sheet_name):
+    return get_client().open(sheet_name)
+
+@st.cache_resource
+def get_worksheet(sheet_name, tab):
+    """Worksheet handle, looked up (or created) once per process."""
+    sched = get_scheduler()
+    sh = _open_workbook(sheet_name)
     try:
-        ws = sh.worksheet(tab)
+        ws = sched.read(("worksheet", sheet_name, tab), sh.worksheet, tab)
     except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab, rows=2000, cols=26)
-    data = ws.get_all_records()
-    df = pd.DataFrame(data)
-    return df
-
-def write_df(sheet_name, tab, df: pd.DataFrame):
-    client = get_client()
-    sh = client.open(sheet_name)
+        ws = sched.call(sh.add_worksheet, title=tab, rows=2000, cols=26, priority=PRIORITY_WRITE)
+    return ws
+
+def arrow_frame(df):
+    """df with its text columns stored as Arrow strings (blank-only and mixed columns kept)."""
+    text = [c for c in df.columns
+            if df[c].dtype == object and df[c].map(type).eq(str).all() and df[c].ne("").any()]
+    return df.astype({c: "string[pyarrow]" for c in text}) if text else df
+
+def read_tab(sheet_name, tab, _priority=PRIORITY_READ):
+    """A tab's records as a DataFrame, straight from the API (uncached)."""
+    ws = get_worksheet(sheet_name, tab)
+    return pd.DataFrame(get_scheduler().read(("records", sheet_name, tab), ws.get_all_records,
+                                             priority=_priority, reads=(sheet_name, tab)))
+
+@st.cache_resource(ttl=30, show_spinner=False)
+def _shared_sheet(sheet_name, tab, _priority=PRIORITY_READ):
+    """One frame per tab and process, shared by reference by every session."""
+    return arrow_frame(read_tab(sheet_name, tab, _priority))
+
+def load_sheet(sheet_name, tab, _priority=PRIORITY_READ):
+    """
+    The tab as a DataFrame. Unlike st.cache_data (a fresh unpickled copy per session and
+    rerun) this is a shallow view of the shared frame: free to hand out, copied on write.
+    """
+    return _shared_sheet(sheet_name, tab, _priority).copy(deep=False)
+
+def refresh_sheets():
+    """Drop cached tab frames (and derived data caches) after a write."""
+    _shared_sheet.clear()
+    _shared_visit_view.clear()
+    st.cache_data.clear()
+
+# ---------- minimal writes (diff against the sheet) ----------
+# Key columns match rows between the sheet and a new frame; other tabs match by position.
+TAB_KEYS = {
+    TAB_SERVICES:          ["service","vehicle_class"],
+    TAB_VEHICLE_CLASSES:   ["vehicle_class"],
+    TAB_VEHICLE_MODELS:    ["label","vehicle_class"],
+    TAB_EMPLOYEES:         ["employee_id"],
+    TAB_COMMISSION_POLICY: ["rule_id"],
+    TAB_PAYROLL_EXPORTS:   ["employee_id","branch_scope","period_start","period_end"],
+}
+
+def cell_value(v):
+    """Comparable form of a cell: '' for blanks/NaN, float for numbers, else text."""
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return ""
+    if isinstance(v, (bool, np.bool_)):
+        return bool(v)
+    if isinstance(v, (int, float, np.integer, np.floating)):
+        return float(v)
+    return str(v)
+
+def cell_data(v):
+    """A value as Sheets CellData (entered as-is, like RAW)."""
+    v = cell_value(v)
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, float):
+        return {"userEnteredValue": {"numberValue": int(v) if v.is_integer() else v}}
+    return {"userEnteredValue": {"stringValue": v}} if v != "" else {}
+
+def diff_requests(sheet_id, old, df, keys=None):
+    """
+    batchUpdate requests turning the sheet's values `old` (header first) into df:
+    changed cells, deleted rows (bottom-up) and appended rows. A changed header
+    rewrites the tab, still within the one batch.
+    """
+    header = [str(c) for c in df.columns]
+    new = df.astype(object).values.tolist()
+    width = len(header)
+    old = [list(r) + [""] * (width - len(r)) for r in old]
+
+    def cells(row_index, col_index, rows):
+        return {"updateCells": {"start": {"sheetId": sheet_id, "rowIndex": row_index, "columnIndex": col_index},
+                                "rows": [{"values": [cell_data(v) for v in r]} for r in rows],
+                                "fields": "userEnteredValue"}}
+    def append(rows):
+        return [{"appendCells": {"sheetId": sheet_id, "rows": [{"values": [cell_data(v) for v in r]} for r in rows],
+                                 "fields": "userEnteredValue"}}] if rows else []
+
+    if not old or [str(v) for v in old[0][:width]] != header or any(str(v) != "" for v in old[0][width:]):
+        # written in place over a grid sized to fit, so kiosks seeding a new tab at once
+        # leave one copy (appending would stack theirs)
+        requests = []
+        if old:
+            requests.append({"updateCells": {"range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": len(old)},
+                                             "fields": "userEnteredValue"}})
+        requests.append({"updateSheetProperties": {"properties": {"sheetId": sheet_id,
+                                                                  "gridProperties": {"rowCount": len(new) + 1}},
+                                                   "fields": "gridProperties.rowCount"}})
+        return requests + [cells(0, 0, [header] + new)]
+
+    old_rows = old[1:]
+    target = None  # new row i -> old row index (None = append)
+    if keys and all(k in header for k in keys):
+        idx = [header.index(k) for k in keys]
+        old_keys = [tuple(cell_value(r[i]) for i in idx) for r in old_rows]
+        new_keys = [tuple(cell_value(r[i]) for i in idx) for r in new]
+        if len(set(old_keys)) == len(old_keys) and len(set(new_keys)) == len(new_keys):
+            pos = {k: i for i, k in enumerate(old_keys)}
+            target = [pos.get(k) for k in new_keys]
+    if target is None:  # no usable keys: by position
+        target = [i if i < len(old_rows) else None for i in range(len(new))]
+
+    requests = []
+    for row, at in zip(new, target):
+        if at is None:
+            continue
+        changed = [j for j in range(width) if cell_value(row[j]) != cell_value(old_rows[at][j])]
+        # one request per run of adjacent changed cells
+        for _, run in itertools.groupby(enumerate(changed), lambda p: p[1] - p[0]):
+            cols = [j for _, j in run]
+            requests.append(cells(at + 1, cols[0], [row[cols[0]:cols[-1] + 1]]))
+
+    gone = sorted(set(range(len(old_rows))) - {at for at in target if at is not None}, reverse=True)
+    for _, run in itertools.groupby(enumerate(gone), lambda p: p[1] + p[0]):
+        rows = [i for _, i in run]
+        requests.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                                       "startIndex": rows[-1] + 1, "endIndex": rows[0] + 2}}})
+    return requests + append([row for row, at in zip(new, target) if at is None])
+
+def write_df(sheet_name, tab, df: pd.DataFrame, keys=None):
+    """
+    Make the tab equal to df with one batchUpdate holding only the changes (rows matched
+    by keys / TAB_KEYS, else by position). The tab is never cleared in between.
+    Returns the number of requests sent.
+    """
+    sched = get_scheduler()
+    ws = get_worksheet(sheet_name, tab)
+    old = sched.call(ws.get_all_values, value_render_option=gspread.utils.ValueRenderOption.unformatted,
+                     priority=PRIORITY_WRITE)
+    requests = diff_requests(ws.id, old, df, keys or TAB_KEYS.get(tab))
+    if requests:
+        sched.call(_open_workbook(sheet_name).batch_update, {"requests": requests}, priority=PRIORITY_WRITE,
+                   writes=[(sheet_name, tab)])
+    return len(requests)
+
+def append_df(sheet_name, tab, df: pd.DataFrame):
+    """Append df's rows under the tab's header (written first, or extended, if needed)."""
+    append_frames(sheet_name, {tab: df})
+
+def append_frames(sheet_name, frames, priority=PRIORITY_WRITE):
+    """
+    Append rows to several tabs of one workbook ({tab: df}) in one batchUpdate, so
+    readers see all of them or none.
+    """
+    sched = get_scheduler()
+    requests, tabs = [], []
+    for tab, df in frames.items():
+        if df.empty:
+            continue
+        tabs.append((sheet_name, tab))
+        ws = get_worksheet(sheet_name, tab)
+        header = sched.call(ws.row_values, 1, priority=priority)
+        # the header row is written in place, so racing first appends agree on it
+        missing = [str(c) for c in df.columns if str(c) not in header]
+        if missing:
+            header = header + missing
+            sched.call(ws.update, [header], "A1", priority=priority, writes=[(sheet_name, tab)])
+        rows = df.reindex(columns=header).astype(object).values.tolist()
+        requests.append({"appendCells": {"sheetId": ws.id, "rows": [{"values": [cell_data(v) for v in r]} for r in rows],
+                                         "fields": "userEnteredValue"}})
+    if requests:
+        sched.call(_open_workbook(sheet_name).batch_update, {"requests": requests}, priority=priority, writes=tabs)
+
+# ======= BRANCH SHARDS (federated reads) =======
+def branch_workbook(branch_id):
+    """Workbook that holds this branch's attendance and transactions."""
+    return BRANCH_WORKBOOKS.get(str(branch_id or "").upper(), SHEET_NAME)
+
+def branch_scope(branch_filter):
+    """'B1' -> ['B1']; None/'ALL' -> None (all branches)."""
+    if branch_filter and str(branch_filter).upper() != "ALL":
+        return [str(branch_filter).upper()]
+    return None
+
+def shard_workbooks(branches=None):
+    """Distinct workbooks covering these branches (all when None), in a stable order."""
+    return list(dict.fromkeys(branch_workbook(b) for b in (branches or BRANCHES)))
+
+def in_parallel(fn, items):
+    """map(fn, items) on worker threads that share this script run's context."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    ctx = get_script_run_ctx()
+    def run(x):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(x)
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        return list(pool.map(run, items))
+
+def load_shards(tab, branches=None, _priority=PRIORITY_READ):
+    """{workbook: DataFrame} of a sharded tab; only the shards of these branches are read."""
+    books = shard_workbooks(branches)
+    return dict(zip(books, in_parallel(lambda wb: load_sheet(wb, tab, _priority=_priority), books)))
+
+def load_branch_tab(tab, branches=None, _priority=PRIORITY_READ):
+    """
+    A sharded tab as one DataFrame, federated across the shards of these branches.
+    Shards are not filtered: a shared workbook still returns every branch's rows,
+    so callers keep their own branch_id filters.
+    """
+    return concat_frames(load_shards(tab, branches, _priority).values())
+
+def concat_frames(frames):
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+# ======= PROFILER (on-demand, sampling) =======
+PROFILE_INTERVAL_S = 0.005
+PROFILE_KEEP       = 20  # captures kept in memory
+# a sample goes to the category of its leaf-most matching frame (earlier entry on a tie)
+PROFILE_CATEGORIES = [
+    ("Sheets I/O",       ("/gspread/", "/google/auth/", "/googleapiclient/", "/requests/", "/urllib3/", "/httplib2/", "/ssl.py", "/socket.py", "/http/client.py")),
+    ("Streamlit cache",  ("/streamlit/runtime/caching/",)),
+    ("Streamlit render", ("/streamlit/elements/", "/streamlit/delta_generator.py")),
+    ("pandas/numpy",     ("/pandas/", "/numpy/", "/pyarrow/")),
+]
+
+class StackSampler:
+    """Samples one thread's Python stack every `interval` seconds from a helper thread."""
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_S):
+        self.thread_id, self.interval = thread_id, interval
+        self.samples = Counter()  # tuple of (filename, func, line) root->leaf -> count
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self.started = datetime.now()
+        self._t0 = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self, label):
+        self._stop.set()
+        self._thread.join()
+        return {"label": label, "started": self.started.isoformat(timespec="seconds"),
+                "duration_s": time.perf_counter() - self._t0, "interval_s": self.interval,
+                "samples": self.samples}
+
+def profile_category(stack):
+    for filename, _, _ in reversed(stack):
+        f = filename.replace("\\", "/")
+        for name, needles in PROFILE_CATEGORIES:
+            if any(n in f for n in needles):
+                return name
+    return "app/other"
+
+def frame_label(frame):
+    filename, func, line = frame
+    return f"{func} ({os.path.basename(filename)}:{line})"
+
+def folded_stacks(capture):
+    """Brendan Gregg 'folded' format (flamegraph.pl / speedscope)."""
+    return "\n".join(";".join(frame_label(f) for f in stack) + f" {n}"
+                     for stack, n in capture["samples"].most_common())
+
+def category_split(capture):
+    total = sum(capture["samples"].values()) or 1
+    by_cat = Counter()
+    for stack, n in capture["samples"].items():
+        by_cat[profile_category(stack)] += n
+    return pd.DataFrame([{"category": c, "samples": n, "share": n / total,
+                          "est_seconds": n / total * capture["duration_s"]} for c, n in by_cat.most_common()])
+
+def call_tree(capture, min_share=0.01):
+    """Inclusive sample counts per call path, as indented rows (paths under min_share hidden)."""
+    total = sum(capture["samples"].values()) or 1
+    tree = {}
+    for stack, n in capture["samples"].items():
+        node = tree
+        for f in stack:
+            child = node.setdefault(f, {"n": 0, "kids": {}})
+            child["n"] += n
+            node = child["kids"]
+    rows = []
+    def walk(node, depth):
+        for f, child in sorted(node.items(), key=lambda kv: -kv[1]["n"]):
+            if child["n"] / total < min_share:
+                continue
+            rows.append({"call": "  " * depth + frame_label(f), "samples": child["n"], "share": round(child["n"] / total, 3)})
+            walk(child["kids"], depth + 1)
+    walk(tree, 0)
+    return pd.DataFrame(rows)
+
+def flame_html(capture, min_share=0.005):
+    """Self-contained icicle chart (root on top) as nested flex boxes."""
+    total = sum(capture["samples"].values()) or 1
+    tree = {}
+    for stack, n in capture["samples"].items():
+        node = tree
+        for f in stack:
+            child = node.setdefault(f, {"n": 0, "kids": {}, "stack": None})
+            child["n"] += n
+            child["stack"] = child["stack"] or stack
+            node = child["kids"]
+    colors = {"Sheets I/O": "#f4a261", "Streamlit cache": "#b5838d", "Streamlit render": "#e76f51",
+              "pandas/numpy": "#2a9d8f", "app/other": "#8ab17d"}
+    def render(node, parent_n):
+        parts = []
+        for f, child in sorted(node.items(), key=lambda kv: -kv[1]["n"]):
+            if child["n"] / total < min_share:
+                continue
+            label = html.escape(frame_label(f))
+            color = colors[profile_category(child["stack"])]
+            parts.append(
+                f'<div style="width:{100 * child["n"] / parent_n:.3f}%;min-width:0">'
+                f'<div title="{label} — {child["n"]} samples" style="background:{color};border:1px solid #fff;'
+                f'font:11px monospace;white-space:nowrap;overflow:hidden;padding:1px 2px">{label}</div>'
+                f'<div style="display:flex">{render(child["kids"], child["n"])}</div></div>')
+        return "".join(parts)
+    return f'<div style="display:flex;width:100%">{render(tree, total)}</div>'
+
+class ProfilerStore:
+    """Process-wide: what to profile next, and the last captures."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reruns_left = 0
+        self.calls_left = Counter()  # function name -> calls to capture
+        self.captures = []
+
+    def arm_reruns(self, n):
+        with self._lock:
+            self.reruns_left = int(n)
+
+    def arm_call(self, name, n=1):
+        with self._lock:
+            self.calls_left[name] = int(n)
+
+    def take_rerun(self):
+        with self._lock:
+            if self.reruns_left <= 0:
+                return False
+            self.reruns_left -= 1
+            return True
+
+    def take_call(self, name):
+        with self._lock:
+            if self.calls_left[name] <= 0:
+                return False
+            self.calls_left[name] -= 1
+            return True
+
+    def add(self, capture):
+        with self._lock:
+            self.captures = (self.captures + [capture])[-PROFILE_KEEP:]
+
+@st.cache_resource(show_spinner=False)  # runs before set_page_config; must not draw
+def get_profiler_store():
+    return ProfilerStore()
+
+@contextmanager
+def profile_rerun():
+    """Profile this script run if an admin armed rerun captures."""
+    store = get_profiler_store()
+    if not store.take_rerun():
+        yield
+        return
+    sampler = StackSampler(threading.get_ident()).start()
     try:
-        ws = sh.worksheet(tab)
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=tab, rows=2000, cols=26)
-    ws.clear()
-    if df.empty:
-        ws.update("A1", [list(df.columns)])
-    else:
-        ws.update([list(df.columns)] + df.astype(object).values.tolist())
+        yield
+    finally:
+        store.add(sampler.stop("rerun"))
+
+def profiled_call(name):
+    """Decorator: profile the next armed call(s) of this function."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            store = get_profiler_store()
+            if not store.take_call(name):
+                return fn(*args, **kwargs)
+            sampler = StackSampler(threading.get_ident()).start()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                store.add(sampler.stop(name))
+        return wrapper
+    return deco
+
+def render_profiler_admin():
+    store = get_profiler_store()
+    c1, c2, c3 = st.columns([1, 1, 1])
+    with c1:
+        n = st.number_input("Reruns to profile", min_value=1, max_value=50, value=3, step=1, key="prof_n")
+        if st.button("Profile next reruns", key="prof_arm_reruns"):
+            store.arm_reruns(n)
+    with c2:
+        if st.button("Profile next compute_commissions", key="prof_arm_payroll"):
+            store.arm_call("compute_commissions")
+    with c3:
+        st.caption(f"Armed: {store.reruns_left} rerun(s), "
+                   f"{store.calls_left['compute_commissions']} payroll call(s). Any session's reruns count.")
+
+    if not store.captures:
+        st.caption("No captures yet.")
+        return
+    labels = [f"#{i} {c['label']} @ {c['started']} — {c['duration_s']:.2f}s"
+              for i, c in enumerate(store.captures)][::-1]
+    pick = st.selectbox("Capture", options=labels, key="prof_pick")
+    cap = store.captures[int(pick.split(" ")[0][1:])]
+
+    split = category_split(cap)
+    st.dataframe(split, use_container_width=True)
+    st.bar_chart(split.set_index("category")["est_seconds"])
+    st.components.v1.html(flame_html(cap), height=420, scrolling=True)
+    if st.toggle("Show call tree", key="prof_tree"):
+        st.dataframe(call_tree(cap), use_container_width=True)
+    st.download_button("⬇️ Download raw profile (folded stacks)", data=folded_stacks(cap),
+                       file_name=f"profile_{cap['label']}_{cap['started']}.folded.txt", mime="text/plain",
+                       key="prof_download")
 
 # ======= SEED: vehicle_models (brand, model, label, class) =======
 VEHICLE_MODELS_SEED = [
@@ -236,7 +800,6 @@ def ensure_vehicle_models_sheet():
     return vm
 
 # ======= BUSINESS LOGIC =======
-@st.cache_data(ttl=30)
 def load_catalog():
     services = load_sheet(SHEET_NAME, TAB_SERVICES)
     classes  = load_sheet(SHEET_NAME, TAB_VEHICLE_CLASSES)
@@ -282,6 +845,54 @@ def get_shift_id(ts=None):
     shift = "Day" if 6 <= hour < 18 else "Night"
     return f"{ts.date()}_{shift}"
 
+# ======= MONEY (integer centavos) =======
+# Pesos live in the sheets as decimals; arithmetic is done on int64 centavos
+# so line totals, pool shares and payroll totals add up exactly.
+def to_centavos(values):
+    """Pesos (scalar, list/array or Series) -> int64 centavos, rounded half away from zero."""
+    if np.isscalar(values):
+        return int(to_centavos(pd.Series([values])).iloc[0])
+    s = values if isinstance(values, pd.Series) else pd.Series(values)
+    x = pd.to_numeric(s, errors="coerce").fillna(0).to_numpy(dtype=float)
+    c = np.sign(x) * np.floor(np.round(np.abs(x) * 100, 6) + 0.5)
+    return pd.Series(c.astype("int64"), index=s.index, name=s.name)
+
+def from_centavos(cents):
+    """int64 centavos -> pesos (float, exact to the centavo)."""
+    if np.isscalar(cents):
+        return int(cents) / 100.0
+    return pd.Series(cents).astype("int64") / 100.0
+
+def scale_centavos(cents, factor):
+    """cents * factor (e.g. units), rounded half away from zero to whole centavos."""
+    x = np.asarray(cents, dtype=float) * np.asarray(factor, dtype=float)
+    out = (np.sign(x) * np.floor(np.abs(x) + 0.5)).astype("int64")
+    if isinstance(cents, pd.Series):
+        return pd.Series(out, index=cents.index)
+    return int(out) if np.ndim(out) == 0 else out
+
+def pct_of_centavos(cents, percent):
+    """percent% of cents, exact: percent is taken to basis points, result rounded half up."""
+    bp = to_centavos(percent)  # 12.5% -> 1250 bp, same rounding as money
+    c = np.asarray(cents, dtype="int64") * np.asarray(bp, dtype="int64")
+    out = np.sign(c) * ((np.abs(c) + 5000) // 10000)
+    if isinstance(cents, pd.Series):
+        return pd.Series(out, index=cents.index)
+    return int(out) if np.ndim(out) == 0 else out
+
+def split_start(branch_id, shift_id, n):
+    """
+    Where split_centavos starts handing out leftover centavos for this pool: a stable
+    hash of (branch, shift), so the extra centavo doesn't always land on the lowest id.
+    """
+    digest = hashlib.sha1(f"{branch_id}|{shift_id}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") % n
+
+def split_centavos(total, n, start=0):
+    """Split total centavos into n shares that sum exactly; `remainder` shares from `start` on (wrapping) get +1."""
+    q, r = divmod(int(total), n)
+    return [q + 1 if (i - start) % n < r else q for i in range(n)]
+
 def ensure_columns(df, cols, fill_value=""):
     for c in cols:
         if c not in df.columns:
@@ -298,8 +909,6 @@ def ensure_tx_columns(df):
 
 
 def record_attendance(employee_id, action, branch_id):
-    att = load_sheet(SHEET_NAME, TAB_ATTENDANCE)
-    att = ensure_columns(att, ["timestamp_iso","shift_id","employee_id","action","branch_id"])
     row = {
         "timestamp_iso": datetime.now().isoformat(timespec="seconds"),
         "shift_id": get_shift_id(),
@@ -307,21 +916,561 @@ def record_attendance(employee_id, action, branch_id):
         "action": action,
         "branch_id": branch_id,
     }
-    att = pd.concat([att, pd.DataFrame([row])], ignore_index=True)
-    write_df(SHEET_NAME, TAB_ATTENDANCE, att)
+    # append only: concurrent kiosks never overwrite each other's rows
+    append_df(branch_workbook(branch_id), TAB_ATTENDANCE, pd.DataFrame([row])[ATT_COLS])
 
 
+# ======= VISITS (normalized storage) =======
+# A visit is stored as one visits row plus one visit_lines row per service, written
+# together in one batchUpdate. Consumers keep working on TX_COLS rows: the joined view
+# repeats the visit fields on each line, after any rows still in the legacy transactions tab.
+def derive_visit_ids(tx):
+    """visit_id, derived for rows without one: one visit per (timestamp, plate, branch), stable across runs."""
+    key = tx["timestamp_iso"].astype(str) + "|" + tx["plate"].astype(str) + "|" + tx["branch_id"].astype(str)
+    derived = tx["timestamp_iso"].astype(str) + "-" + key.map(lambda k: hashlib.sha1(k.encode()).hexdigest()[:6].upper())
+    return tx["visit_id"].where(tx["visit_id"].astype(str).str.strip() != "", derived)
+
+def split_visit_rows(tx, known=None):
+    """
+    TX_COLS rows -> (visits, lines). Lines of one visit_id whose visit fields disagree
+    (old or imported data) become separate visits "<visit_id>#2", "#3", ... so nothing is lost.
+    known ({visit_id: [fields digest, ...]}, updated in place) carries that numbering across
+    calls: lines of a visit written by an earlier call reuse its id and get no second visits row.
+    """
+    known = {} if known is None else known
+    tx = ensure_tx_columns(pd.DataFrame(tx))
+    vid = derive_visit_ids(tx).astype(str)
+    sig = tx[VISIT_COLS[1:]].astype(str).agg("\x1f".join, axis=1)
+    number, fresh = {}, set()
+    for v, s in dict.fromkeys(zip(vid, sig)):
+        digest = hashlib.sha1(s.encode()).digest()[:8]
+        sigs = known.setdefault(v, [])
+        if digest not in sigs:
+            sigs.append(digest)
+            fresh.add((v, s))
+        number[(v, s)] = sigs.index(digest)
+    n = pd.Series([number[k] for k in zip(vid, sig)], index=tx.index)
+    new = pd.Series([k in fresh for k in zip(vid, sig)], index=tx.index, dtype=bool)
+    tx = tx.assign(visit_id=vid.where(n == 0, vid + "#" + (n + 1).astype(str)))
+    return tx[new].drop_duplicates("visit_id")[VISIT_COLS], tx[LINE_COLS]
+
+def index_visits(visits):
+    """Visit fields by visit_id (first row wins), ready for join_visit_lines."""
+    visits = ensure_columns(visits, VISIT_COLS)
+    visits = visits.assign(visit_id=visits["visit_id"].astype(str)).drop_duplicates("visit_id")
+    return visits.set_index("visit_id")
+
+def join_visit_lines(visit_index, lines):
+    """Lines as TX_COLS rows (in line order) carrying their visit's fields; unknown visits get blanks."""
+    if lines.empty:
+        return pd.DataFrame(columns=TX_COLS)
+    lines = ensure_columns(lines, LINE_COLS).reset_index(drop=True)
+    fields = visit_index.reindex(lines["visit_id"].astype(str)).reset_index(drop=True)
+    return ensure_tx_columns(pd.concat([lines, fields.fillna("")], axis=1))
+
+@st.cache_resource(ttl=30, show_spinner=False)
+def _shared_visit_view(sheet_name, _priority=PRIORITY_READ):
+    """A workbook's visit lines joined with their visits (shared like _shared_sheet)."""
+    # lines first: a line is saved with its visit, so the later visits read has them all
+    lines = read_tab(sheet_name, TAB_VISIT_LINES, _priority)
+    visits = read_tab(sheet_name, TAB_VISITS, _priority)
+    return arrow_frame(join_visit_lines(index_visits(visits), lines))
+
+def load_transaction_shards(branches=None, _priority=PRIORITY_READ):
+    """
+    {(workbook, tab): TX rows} for the shards of these branches: legacy transactions rows
+    and the joined visit lines, each only ever appended to (see CustomerIndex).
+    """
+    parts = [(wb, tab) for wb in shard_workbooks(branches) for tab in [TAB_TRANSACTIONS, TAB_VISIT_LINES]]
+    def load(part):
+        wb, tab = part
+        if tab == TAB_TRANSACTIONS:
+            return load_sheet(wb, tab, _priority=_priority)
+        return _shared_visit_view(wb, _priority).copy(deep=False)
+    return dict(zip(parts, in_parallel(load, parts)))
+
+def load_transactions(branches=None, _priority=PRIORITY_READ):
+    """
+    Transaction lines (TX_COLS rows) of these branches' shards, unfiltered like
+    load_branch_tab. Legacy rows of visits already migrated are skipped.
+    """
+    shards = load_transaction_shards(branches, _priority)
+    joined = concat_frames(df for (wb, tab), df in shards.items() if tab == TAB_VISIT_LINES)
+    legacy = concat_frames(df for (wb, tab), df in shards.items() if tab == TAB_TRANSACTIONS)
+    if not legacy.empty and not joined.empty and "visit_id" in legacy.columns:
+        legacy = legacy[~legacy["visit_id"].astype(str).isin(set(joined["visit_id"].astype(str)))]
+    return concat_frames([legacy, joined])
+
+def iter_transaction_chunks(sheet_name, chunk_rows, start_date=None, end_date=None):
+    """
+    A workbook's transaction lines as TX_COLS chunks: legacy rows, then visit lines one
+    pay window at a time. Only visits in [start_date, end_date] are kept (when given).
+    Visits and lines are spilled to disk per window and joined a window at a time, so
+    only a visit_id -> window map is held for the whole range; lines saved after the
+    visits were read wait for the next run.
+    """
+    first_day, last_day = start_date or date.min, end_date or date.max
+    with tempfile.TemporaryDirectory(prefix="tx_join_") as spill_dir:
+        window_of = {}  # visit_id -> its pay window (first in-range visits row wins)
+        def first_visits(chunks):
+            for chunk in chunks:
+                chunk = ensure_columns(chunk, VISIT_COLS)
+                d = pd.to_datetime(chunk["timestamp_iso"], errors="coerce").dt.date
+                keep = d.notna() & (d >= first_day) & (d <= last_day)
+                chunk, d = chunk[keep], d[keep]
+                vid = chunk["visit_id"].astype(str)
+                first = ~vid.duplicated() & vid.map(window_of).isna()
+                chunk, vid, d = chunk[first], vid[first], d[first]
+                window_of.update(zip(vid, d.map({x: current_pay_window(x)[0] for x in d.unique()})))
+                yield chunk
+        visit_paths = spill_by_window(first_visits(iter_sheet_chunks(sheet_name, TAB_VISITS, chunk_rows)),
+                                      VISIT_COLS, first_day, last_day, spill_dir, "visits")
+
+        line_paths = {}
+        for chunk in iter_sheet_chunks(sheet_name, TAB_VISIT_LINES, chunk_rows):
+            window = chunk["visit_id"].astype(str).map(window_of)
+            for w, part in chunk[window.notna()].groupby(window[window.notna()], sort=False):
+                path = line_paths.setdefault(w, os.path.join(spill_dir, f"lines_{w.isoformat()}.csv"))
+                part.to_csv(path, mode="a", index=False, header=not os.path.exists(path))
+
+        for chunk in iter_sheet_chunks(sheet_name, TAB_TRANSACTIONS, chunk_rows):
+            chunk = ensure_tx_columns(chunk)
+            d = pd.to_datetime(chunk["timestamp_iso"], errors="coerce").dt.date
+            chunk = chunk[((d >= start_date) if start_date else True) & ((d <= end_date) if end_date else True)
+                          & chunk["visit_id"].astype(str).map(window_of).isna()]
+            if not chunk.empty:
+                yield chunk
+        for w in sorted(line_paths):
+            visit_index = index_visits(read_spill(visit_paths[w], VISIT_COLS))
+            yield join_visit_lines(visit_index, read_spill(line_paths[w], LINE_COLS))
 
 def record_transaction_rows(rows):
-    """Append multiple rows (one visit with many services)."""
-    tx = load_sheet(SHEET_NAME, TAB_TRANSACTIONS)
-    tx = ensure_tx_columns(tx)
-    tx = pd.concat([tx, pd.DataFrame(rows)], ignore_index=True)
-    write_df(SHEET_NAME, TAB_TRANSACTIONS, tx)
+    """Save one visit's lines (TX_COLS rows) as visits + visit_lines rows in their branch's shard."""
+    by_book = {}
+    for r in rows:
+        by_book.setdefault(branch_workbook(r.get("branch_id")), []).append(r)
+    for workbook, book_rows in by_book.items():
+        visits, lines = split_visit_rows(book_rows)
+        append_frames(workbook, {TAB_VISITS: visits, TAB_VISIT_LINES: lines})
+    _customer_index().add_rows(rows)
+    _revenue_cube().add_rows(rows, recorded=True)
+
+MIGRATE_BATCH_VISITS = 2000
+
+def migrate_transactions(sheet_name):
+    """
+    Move a workbook's legacy transactions rows into visits + visit_lines, then delete
+    them from the legacy tab. Visits already migrated are skipped and each batch is
+    written whole, so an interrupted run can simply be repeated.
+    Returns (visits, lines) moved.
+    """
+    legacy = read_tab(sheet_name, TAB_TRANSACTIONS, PRIORITY_BACKGROUND)
+    if legacy.empty:
+        return 0, 0
+    data = legacy[legacy.astype(str).ne("").any(axis=1)]  # blank rows carry nothing
+    visits, lines = split_visit_rows(data)
+    done = read_tab(sheet_name, TAB_VISITS, PRIORITY_BACKGROUND)
+    if not done.empty:
+        fresh = ~visits["visit_id"].isin(set(done["visit_id"].astype(str)))
+        visits, lines = visits[fresh], lines[lines["visit_id"].isin(set(visits["visit_id"][fresh]))]
+    for i in range(0, len(visits), MIGRATE_BATCH_VISITS):
+        batch = visits.iloc[i:i + MIGRATE_BATCH_VISITS]
+        append_frames(sheet_name, {TAB_VISITS: batch, TAB_VISIT_LINES: lines[lines["visit_id"].isin(set(batch["visit_id"]))]},
+                      priority=PRIORITY_BACKGROUND)
+    # only the rows read above: anything appended since stays for the next run
+    ws = get_worksheet(sheet_name, TAB_TRANSACTIONS)
+    get_scheduler().call(_open_workbook(sheet_name).batch_update, {"requests": [{"deleteDimension": {
+        "range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": 1, "endIndex": len(legacy) + 1}}}]},
+        priority=PRIORITY_BACKGROUND, writes=[(sheet_name, TAB_TRANSACTIONS)])
+    return len(visits), len(lines)
+
+# ======= CUSTOMER / PLATE INDEX =======
+def normalize_plate(plate):
+    return re.sub(r"[^A-Z0-9]", "", str(plate or "").upper())
+
+def normalize_phone(phone):
+    digits = re.sub(r"\D", "", str(phone or ""))
+    if digits.startswith("63") and len(digits) == 12:  # +63 917... -> 0917...
+        digits = "0" + digits[2:]
+    return digits
+
+class CustomerIndex:
+    """
+    Normalized plate/phone -> last vehicle, customer and visit history.
+    Built once per process and fed only the transaction rows it has not seen yet;
+    plates are kept sorted for prefix search.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.rows_seen = {}  # (workbook, tab) -> transaction rows consumed
+        self.by_plate = {}   # plate -> record (see add_rows)
+        self.by_phone = {}   # phone -> set of plates
+        self._plates = []    # sorted plate keys
+
+    def update_from_sheet(self, shards):
+        """Consume rows appended to each shard (see load_transaction_shards) since the last call."""
+        with self._lock:
+            if any(len(tx) < self.rows_seen.get(wb, 0) for wb, tx in shards.items()):
+                self.reset()  # a tab was rewritten/shrunk -> rebuild
+            new = [tx.iloc[self.rows_seen.get(wb, 0):] for wb, tx in shards.items()]
+            self.rows_seen.update({wb: len(tx) for wb, tx in shards.items()})
+        for rows in new:
+            if not rows.empty:
+                self.add_rows(rows)
+
+    def add_rows(self, rows):
+        """Index transaction lines; re-adding a visit_id just overwrites it."""
+        df = ensure_tx_columns(pd.DataFrame(rows).copy()).copy()
+        df["plate_key"] = df["plate"].map(normalize_plate)
+        df = df[df["plate_key"] != ""]
+        if df.empty:
+            return
+        df["visit_id"] = df["visit_id"].astype(str).where(df["visit_id"].astype(str) != "", df["timestamp_iso"].astype(str))
+        df["service"] = df["service"].astype(str)
+        visits = (
+            df.groupby(["plate_key","visit_id"], sort=False)
+              .agg(timestamp_iso=("timestamp_iso","first"), branch_id=("branch_id","first"),
+                   vehicle_model=("vehicle_model","first"), vehicle_class=("vehicle_class","first"),
+                   customer_name=("customer_name","first"), customer_phone=("customer_phone","first"),
+                   amount_paid_peso=("amount_paid_peso","first"), services=("service", ", ".join))
+              .reset_index()
+        )
+        visits["timestamp_iso"] = visits["timestamp_iso"].astype(str)
+        visits = visits.sort_values("timestamp_iso", kind="mergesort")
+
+        with self._lock:
+            for v in visits.itertuples(index=False):
+                rec = self.by_plate.get(v.plate_key)
+                if rec is None:
+                    rec = {"plate": v.plate_key, "vehicle_model": "", "vehicle_class": "",
+                           "customer_name": "", "customer_phone": "", "last_seen": "", "visits": {}}
+                    self.by_plate[v.plate_key] = rec
+                    bisect.insort(self._plates, v.plate_key)
+                rec["visits"][v.visit_id] = {
+                    "timestamp_iso": v.timestamp_iso, "branch_id": v.branch_id, "vehicle_model": v.vehicle_model,
+                    "services": v.services, "amount_paid_peso": v.amount_paid_peso,
+                }
+                if v.timestamp_iso >= rec["last_seen"]:
+                    rec["last_seen"] = v.timestamp_iso
+                    for f in ["vehicle_model","vehicle_class","customer_name","customer_phone"]:
+                        val = getattr(v, f)
+                        if str(val or "").strip():
+                            rec[f] = str(val)
+                phone = normalize_phone(v.customer_phone)
+                if phone:
+                    self.by_phone.setdefault(phone, set()).add(v.plate_key)
+
+    def lookup(self, plate):
+        return self.by_plate.get(normalize_plate(plate))
+
+    def search(self, prefix, limit=8):
+        """Known plates starting with prefix (normalized), in sorted order."""
+        key = normalize_plate(prefix)
+        if not key:
+            return []
+        i = bisect.bisect_left(self._plates, key)
+        out = []
+        while i < len(self._plates) and self._plates[i].startswith(key) and len(out) < limit:
+            out.append(self._plates[i])
+            i += 1
+        return out
+
+    def plates_for_phone(self, phone):
+        return sorted(self.by_phone.get(normalize_phone(phone), set()))
+
+    def history(self, plate):
+        rec = self.lookup(plate)
+        if rec is None:
+            return pd.DataFrame()
+        hist = pd.DataFrame([{"visit_id": vid, **v} for vid, v in rec["visits"].items()])
+        return hist.sort_values("timestamp_iso", ascending=False).reset_index(drop=True)
+
+@st.cache_resource
+def _customer_index():
+    return CustomerIndex()
+
+def get_customer_index():
+    """Process-wide index, caught up with the (cached) transaction lines."""
+    idx = _customer_index()
+    idx.update_from_sheet(load_transaction_shards(_priority=PRIORITY_BACKGROUND))
+    return idx
+
+# ======= VEHICLE MODEL SEARCH (typeahead) =======
+VEHICLE_SEARCH_LIMIT = 20
+VEHICLE_ALIASES = {  # what people type -> words used in vehicle_models (more per row: `aliases` column)
+    "vw": "volkswagen", "chevy": "chevrolet", "merc": "mercedes", "mb": "mercedes benz",
+}
+
+def search_words(text):
+    return re.findall(r"[a-z0-9]+", str(text or "").lower())
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def within_one_edit(a, b):
+    """True if a and b differ by at most one insert, delete, substitution or adjacent swap."""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return (a[i + 1:] == b[i + 1:]                                             # substitution
+                or (a[i:i + 2] == b[i:i + 2][::-1] and a[i + 2:] == b[i + 2:]))  # swap ("vois"/"vios")
+    return a[i + 1:] == b[i:] if len(a) > len(b) else a[i:] == b[i + 1:]          # delete / insert
+
+class VehicleModelIndex:
+    """
+    Word/trigram index over vehicle_models (brand, model, label, optional `aliases`)
+    for ranked typeahead. Each option resolves to exactly one class: a label listed
+    under several classes (e.g. JEEP - Cherokee) becomes one option per class.
+    """
+    def __init__(self, vmodels):
+        vm = vmodels.reindex(columns=["brand","model","label","vehicle_class","aliases"], fill_value="")
+        vm = vm.fillna("").astype(str).apply(lambda c: c.str.strip())
+        vm = vm[vm["label"] != ""].drop_duplicates(["label","vehicle_class"])
+        classes = vm.groupby(vm["label"].str.casefold())["vehicle_class"].transform("nunique")
+        vm["option"] = vm["label"].where(classes <= 1, vm["label"] + " (" + vm["vehicle_class"] + ")")
+        # label -> class only where the option needed no class suffix (same casefold rule)
+        self.class_by_label = dict(zip(vm.loc[classes <= 1, "label"], vm.loc[classes <= 1, "vehicle_class"]))
+        vm = vm.drop_duplicates("option").sort_values("option", key=lambda s: s.str.casefold(), kind="mergesort")
+
+        self.entries = vm.to_dict("records")
+        self.options = [e["option"] for e in self.entries]
+        self._by_option = {e["option"]: e for e in self.entries}
+        self.words = {}       # word -> entry positions
+        self.by_trigram = {}  # trigram -> words
+        for pos, e in enumerate(self.entries):
+            for w in self._entry_words(e):
+                self.words.setdefault(w, set()).add(pos)
+        for w in self.words:
+            for t in trigrams(w):
+                self.by_trigram.setdefault(t, set()).add(w)
+        self._sorted_words = sorted(self.words)
+        self._by_length = {}  # len -> words, for the one-edit typo check
+        for w in self.words:
+            self._by_length.setdefault(len(w), []).append(w)
+
+    @staticmethod
+    def _entry_words(e):
+        words = set()
+        for field in ["brand","model","label","aliases","vehicle_class"]:
+            ws = search_words(e[field])
+            words.update(ws)
+            words.update(a + b for a, b in zip(ws, ws[1:]))  # "Hi-Ace" -> hiace, "X-Trail" -> xtrail
+        return words
+
+    def entry(self, option):
+        return self._by_option.get(option)
+
+    def option_for(self, label, vehicle_class=""):
+        """Option for a stored (label, class); the class breaks ties between same-label rows."""
+        hits = [e for e in self.entries if e["label"] == str(label)]
+        exact = [e for e in hits if e["vehicle_class"] == str(vehicle_class)]
+        return (exact or hits)[0]["option"] if (exact or hits) else None
+
+    def _word_scores(self, q):
+        """entry position -> best score for one query word: exact 3, prefix 2, typo 1, fuzzy < 1."""
+        scores = {}
+        i = bisect.bisect_left(self._sorted_words, q)
+        while i < len(self._sorted_words) and self._sorted_words[i].startswith(q):
+            w = self._sorted_words[i]
+            for pos in self.words[w]:
+                scores[pos] = max(scores.get(pos, 0), 3 if w == q else 2)
+            i += 1
+        if len(q) >= 3:  # typos: trigram similarity
+            grams = trigrams(q)
+            for w in set().union(*(self.by_trigram.get(t, ()) for t in grams)):
+                g = trigrams(w)
+                sim = len(grams & g) / len(grams | g)
+                if sim >= 0.4:
+                    for pos in self.words[w]:
+                        scores[pos] = max(scores.get(pos, 0), sim)
+        if len(q) >= 4:  # one slip (e.g. swapped letters) shares too few trigrams on short words
+            for n in (len(q) - 1, len(q), len(q) + 1):
+                for w in self._by_length.get(n, ()):
+                    if len(w) >= 4 and within_one_edit(q, w):
+                        for pos in self.words[w]:
+                            scores[pos] = max(scores.get(pos, 0), 1)
+        return scores
+
+    def search(self, query, limit=VEHICLE_SEARCH_LIMIT):
+        """Options matching every query word, best first; no query -> the first options A-Z."""
+        words = [w for q in search_words(query) for w in search_words(VEHICLE_ALIASES.get(q, q))]
+        if not words:
+            return self.options[:limit]
+        total = None
+        for q in words:
+            scores = self._word_scores(q)
+            total = scores if total is None else {p: total[p] + s for p, s in scores.items() if p in total}
+            if not total:
+                return []
+        ranked = sorted(total, key=lambda p: (-total[p], len(self.entries[p]["label"]), p))
+        return [self.entries[p]["option"] for p in ranked[:limit]]
+
+def vehicle_models_fingerprint(vmodels):
+    h = hashlib.sha1("|".join(map(str, vmodels.columns)).encode())
+    h.update(pd.util.hash_pandas_object(vmodels.astype(str), index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _vehicle_model_index(fingerprint, _vmodels):
+    return VehicleModelIndex(_vmodels)
+
+def get_vehicle_model_index(vmodels=None):
+    """Process-wide search index, rebuilt only when the vehicle_models tab's contents change."""
+    vm = ensure_vehicle_models_sheet() if vmodels is None else vmodels
+    return _vehicle_model_index(vehicle_models_fingerprint(vm), vm)
+
+# ======= REVENUE CUBE (live dashboard) =======
+CUBE_DIMS  = ["date","branch_id","shift","service","vehicle_class","payment_method"]
+VISIT_DIMS = [d for d in CUBE_DIMS if d != "service"]
+
+class RevenueCube:
+    """
+    Rollup of transactions at date x branch x shift x service x vehicle_class x payment_method.
+    Line measures (lines, amount) are kept per service; visit measures (visits, amount paid)
+    live on a service-less cube so a multi-service visit is counted once.
+    Maintained incrementally: every line is folded in once, each visit counted once
+    however its lines are split across calls.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.rows_seen = {}  # (workbook, tab) -> transaction rows consumed
+        self._lines  = {}     # CUBE_DIMS key  -> [lines, amount_c, visits]
+        self._visits = {}     # VISIT_DIMS key -> [visits, paid_c]
+        self._seen   = {}     # visit key -> services already counted for it
+        self._recorded = {}   # (visit key, service, amount_c) -> lines added by add_rows(recorded=True)
+                              # whose sheet copy has not been read back yet
+
+    def update_from_sheet(self, shards):
+        """Fold in rows appended to each shard (see load_transaction_shards) since the last call."""
+        with self._lock:
+            if any(len(tx) < self.rows_seen.get(wb, 0) for wb, tx in shards.items()):
+                self.reset()  # a tab was rewritten/shrunk -> rebuild
+            new = [tx.iloc[self.rows_seen.get(wb, 0):] for wb, tx in shards.items()]
+            self.rows_seen.update({wb: len(tx) for wb, tx in shards.items()})
+        for rows in new:
+            if not rows.empty:
+                self.add_rows(rows)
+
+    def add_rows(self, rows, recorded=False):
+        """
+        Fold in transaction lines. recorded=True: lines this process just wrote, so the
+        same lines read back from the sheet later are skipped instead of counted twice.
+        """
+        df = ensure_tx_columns(pd.DataFrame(rows).copy()).copy()
+        if df.empty:
+            return
+        vid = df["visit_id"].astype(str)
+        df["visit_key"] = vid.where(vid != "", df["timestamp_iso"].astype(str) + "|" + df["plate"].astype(str))
+        df["service"]  = df["service"].astype(str)
+        df["amount_c"] = to_centavos(df["amount_peso"])
+        line_keys = list(zip(df["visit_key"], df["service"], df["amount_c"].tolist()))
+        with self._lock:
+            if recorded:
+                for k in line_keys:
+                    self._recorded[k] = self._recorded.get(k, 0) + 1
+            else:
+                keep = []
+                for k in line_keys:
+                    n = self._recorded.pop(k, 0)
+                    if n > 1:
+                        self._recorded[k] = n - 1
+                    keep.append(n == 0)
+                df = df[keep].copy()
+            # visits are counted on the first line seen; a later line only adds its service
+            pairs = list(zip(df["visit_key"], df["service"]))
+            df["new_visit"] = ~df.duplicated("visit_key") & np.array([v not in self._seen for v, _ in pairs], dtype=bool)
+            df["new_cell"]  = ~df.duplicated(["visit_key","service"]) & np.array(
+                [s not in self._seen.get(v, ()) for v, s in pairs], dtype=bool)
+            for v, s in pairs:
+                self._seen.setdefault(v, set()).add(s)
+        if df.empty:
+            return
+
+        df["date"]   = pd.to_datetime(df["timestamp_iso"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("")
+        df["shift"]  = df["shift_id"].astype(str).str.split("_").str[-1]
+        df["branch_id"] = df["branch_id"].astype(str).str.upper()
+        for c in ["vehicle_class","payment_method"]:
+            df[c] = df[c].astype(str)
+        df["paid_c"]   = to_centavos(df["amount_paid_peso"])
+
+        lines = df.groupby(CUBE_DIMS).agg(
+            lines=("service","size"), amount_c=("amount_c","sum"), visits=("new_cell","sum"))
+        visits = df[df["new_visit"]].groupby(VISIT_DIMS).agg(
+            visits=("visit_key","size"), paid_c=("paid_c","sum"))
+
+        with self._lock:
+            for key, vals in zip(lines.index, lines.to_numpy().tolist()):
+                cell = self._lines.setdefault(key, [0, 0, 0])
+                for i, v in enumerate(vals):
+                    cell[i] += int(v)
+            for key, vals in zip(visits.index, visits.to_numpy().tolist()):
+                cell = self._visits.setdefault(key, [0, 0])
+                for i, v in enumerate(vals):
+                    cell[i] += int(v)
+
+    def _frame(self, cells, dims, measures):
+        with self._lock:
+            items = list(cells.items())
+        return pd.DataFrame([(*k, *v) for k, v in items], columns=dims + measures)
+
+    def values(self, dim):
+        """Distinct values of a dimension (for filter pickers)."""
+        cells = self._lines if dim == "service" else self._visits
+        i = (CUBE_DIMS if dim == "service" else VISIT_DIMS).index(dim)
+        with self._lock:
+            return sorted({k[i] for k in cells})
+
+    def query(self, group_by, filters=None):
+        """
+        Slice by filters (dim -> allowed values) and roll up to group_by dims.
+        With service grouped/filtered, visits count per service and amount paid is
+        not reported (it is per visit, not per line).
+        """
+        filters = filters or {}
+        by_service = "service" in group_by or "service" in filters
+        lines  = self._frame(self._lines, CUBE_DIMS, ["lines","amount_c","visits"])
+        visits = self._frame(self._visits, VISIT_DIMS, ["visits","paid_c"])
+        for dim, allowed in filters.items():
+            lines = lines[lines[dim].isin(allowed)]
+            if dim in VISIT_DIMS:
+                visits = visits[visits[dim].isin(allowed)]
+
+        keys = list(group_by) or ["_all"]
+        lines, visits = lines.assign(_all="ALL"), visits.assign(_all="ALL")
+        if by_service:
+            out = lines.groupby(keys)[["visits","lines","amount_c"]].sum()
+            out["paid_c"] = np.nan
+        else:
+            out = lines.groupby(keys)[["lines","amount_c"]].sum().join(
+                visits.groupby(keys)[["visits","paid_c"]].sum(), how="outer").fillna(0)
+        out = out.reset_index()
+        out["amount_peso"]      = from_centavos(out["amount_c"].astype("int64"))
+        out["amount_paid_peso"] = out["paid_c"] / 100.0
+        cols = [k for k in keys if k != "_all"] + ["visits","lines","amount_peso","amount_paid_peso"]
+        return out[cols]
+
+@st.cache_resource
+def _revenue_cube():
+    return RevenueCube()
+
+def get_revenue_cube():
+    """Process-wide cube, caught up with the (cached) transaction lines."""
+    cube = _revenue_cube()
+    cube.update_from_sheet(load_transaction_shards(_priority=PRIORITY_BACKGROUND))
+    return cube
 
 def who_is_clocked_in(att_df, shift_id, branch_id):
     # Be tolerant of old rows without branch_id: use them as "wildcard"
-    att_df = att_df.copy()
     if "branch_id" not in att_df.columns:
         att_df["branch_id"] = ""
 
@@ -340,17 +1489,320 @@ def who_is_clocked_in(att_df, shift_id, branch_id):
             status[eid] = False
     return [eid for eid, on in status.items() if on]
 
+# ======= PRESENCE INTERVALS (attendance -> who was on site when) =======
+PRESENCE_COLS = ["employee_id","branch_id","start","end"]
+
+def shift_block(ts):
+    """
+    Physical shift block (start, end) containing ts: Day 06:00-18:00, Night 18:00-06:00.
+    Note: Night shift_ids switch date at midnight, blocks do not.
+    """
+    day0 = ts.normalize()
+    if 6 <= ts.hour < 18:
+        return day0 + pd.Timedelta(hours=6), day0 + pd.Timedelta(hours=18)
+    if ts.hour >= 18:
+        return day0 + pd.Timedelta(hours=18), day0 + pd.Timedelta(hours=30)
+    return day0 - pd.Timedelta(hours=6), day0 + pd.Timedelta(hours=6)
+
+def presence_step(open_at, ts, action, last_out=None):
+    """
+    One attendance event of an (employee, branch): returns (closed intervals, new open_at).
+    Every interval ends by the end of its opening shift block. last_out is the time of
+    this employee's previous CLOCK_OUT at the branch, if any.
+    """
+    if action == "CLOCK_IN":
+        closed = [] if open_at is None else [(open_at, min(ts, shift_block(open_at)[1]))]
+        return closed, ts
+    if action == "CLOCK_OUT":
+        closed = []
+        if open_at is not None and ts > shift_block(open_at)[1]:
+            # forgot to clock out last shift: close it at its block end
+            closed.append((open_at, shift_block(open_at)[1]))
+            open_at = None
+        if open_at is None:
+            block_start = shift_block(ts)[0]
+            if last_out is not None and last_out >= block_start:
+                return closed, None  # already clocked out this block: a repeated tap, not a new stretch
+            open_at = block_start
+        closed.append((open_at, ts))
+        return closed, None
+    return [], open_at
+
+def presence_close(open_at, now):
+    """Interval of a CLOCK_IN still open at the end of the data."""
+    end = shift_block(open_at)[1]
+    return open_at, now if open_at <= now < end else end
+
+def build_presence_intervals(att_df):
+    """
+    Turn CLOCK_IN/CLOCK_OUT rows into presence intervals per (employee, branch).
+    - an open CLOCK_IN ends at the end of its shift block (or now, if still running)
+    - a CLOCK_OUT without a CLOCK_IN counts from the start of its shift block, unless
+      the employee already clocked out in that block (double tap): then it is ignored
+    - a second CLOCK_IN closes the previous interval
+    """
+    if att_df is None or att_df.empty:
+        return pd.DataFrame(columns=PRESENCE_COLS)
+    att = ensure_columns(att_df, ATT_COLS)
+    att["timestamp"]   = pd.to_datetime(att["timestamp_iso"], errors="coerce")
+    att["employee_id"] = att["employee_id"].astype(str)
+    att["branch_id"]   = att["branch_id"].astype(str).str.upper()
+    att = att.dropna(subset=["timestamp"]).sort_values("timestamp", kind="mergesort")
+
+    now = pd.Timestamp(datetime.now())
+    rows = []
+    for (eid, branch_id), g in att.groupby(["employee_id","branch_id"], sort=False):
+        open_at = last_out = None
+        for ts, action in zip(g["timestamp"], g["action"]):
+            closed, open_at = presence_step(open_at, ts, action, last_out)
+            rows.extend((eid, branch_id, a, b) for a, b in closed)
+            if action == "CLOCK_OUT":
+                last_out = ts
+        if open_at is not None:
+            rows.append((eid, branch_id, *presence_close(open_at, now)))
+
+    out = pd.DataFrame(rows, columns=PRESENCE_COLS)
+    return out[out["end"] > out["start"]].reset_index(drop=True)
+
+NS_PER_HOUR = 3_600 * 10**9
+
+def clipped_ns(iv, start, end):
+    """Nanoseconds of each interval inside [start, end)."""
+    s = iv["start"].clip(lower=pd.Timestamp(start))
+    e = iv["end"].clip(upper=pd.Timestamp(end))
+    return (e - s).astype("int64").clip(lower=0)
+
+class PresenceIndex:
+    """
+    Interval index over presence intervals, one sorted array per branch.
+    No interval is longer than a shift block, so a point query only scans
+    intervals whose start lies in (ts - max_span, ts].
+    """
+    def __init__(self, intervals: pd.DataFrame):
+        self.intervals = intervals
+        self._by_branch = {}
+        for branch_id, g in intervals.groupby("branch_id", sort=False):
+            g = g.sort_values("start", kind="mergesort")
+            starts = g["start"].astype("int64").to_numpy()
+            ends   = g["end"].astype("int64").to_numpy()
+            self._by_branch[branch_id] = (
+                starts, ends, g["employee_id"].to_numpy(), int((ends - starts).max())
+            )
+
+    @classmethod
+    def from_attendance(cls, att_df):
+        return cls(build_presence_intervals(att_df))
+
+    def present_at(self, branch_id, ts):
+        """Employees present at `branch_id` at time ts (start <= ts < end)."""
+        entry = self._by_branch.get(str(branch_id).upper())
+        if entry is None or pd.isna(ts):
+            return set()
+        starts, ends, eids, max_span = entry
+        t = pd.Timestamp(ts).value
+        lo = np.searchsorted(starts, t - max_span, side="left")
+        hi = np.searchsorted(starts, t, side="right")
+        return set(eids[lo:hi][ends[lo:hi] > t])
+
+    def hours_worked(self, start, end, branch_id=None):
+        """Hours present per employee, clipped to [start, end)."""
+        iv = self.intervals
+        if branch_id and str(branch_id).upper() != "ALL":
+            iv = iv[iv["branch_id"] == str(branch_id).upper()]
+        if iv.empty:
+            return pd.Series(dtype=float, name="hours_worked", index=pd.Index([], name="employee_id"))
+        # integer nanoseconds until the end, so the sum does not depend on row order
+        ns = clipped_ns(iv, start, end)
+        return (ns.groupby(iv["employee_id"]).sum() / NS_PER_HOUR).rename("hours_worked")
+
+# ======= EXPORTS (on demand, chunked) =======
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_FORMATS    = ["csv", "parquet"]
+EXPORT_MIME       = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+EXPORT_PART_BYTES = 32 * 2**20  # Streamlit holds a download's bytes in memory: cap each part
+EXPORT_TTL_S      = 6 * 3600    # temp files older than this are from sessions that went away
+TX_NUMERIC_COLS   = ["units","price_peso","amount_peso","amount_paid_peso"]
+
+def iter_sheet_chunks(sheet_name, tab, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield a tab as DataFrames of up to chunk_rows rows, fetched range by range."""
+    sched = get_scheduler()
+    ws = get_worksheet(sheet_name, tab)
+    header = sched.call(ws.row_values, 1, priority=PRIORITY_BACKGROUND)
+    if not header:
+        return
+    last_col = gspread.utils.rowcol_to_a1(1, len(header)).rstrip("0123456789")
+    start = 2
+    while True:
+        end = start + chunk_rows - 1
+        values = sched.call(ws.get, f"A{start}:{last_col}{end}",
+                            value_render_option=gspread.utils.ValueRenderOption.unformatted,
+                            priority=PRIORITY_BACKGROUND)
+        if not values:
+            return
+        rows = [list(r) + [""] * (len(header) - len(r)) for r in values]
+        yield pd.DataFrame(rows, columns=header)
+        if len(values) < chunk_rows:
+            return
+        start = end + 1
+
+def iter_transactions(start_date, end_date, branches=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Transactions in [start_date, end_date] (and branches, if given), chunk by chunk."""
+    branches = [b.upper() for b in branches or []]
+    for workbook in shard_workbooks(branches):
+        for chunk in iter_transaction_chunks(workbook, chunk_rows, start_date, end_date):
+            if branches:
+                chunk = chunk[chunk["branch_id"].astype(str).str.upper().isin(branches)]
+            if not chunk.empty:
+                yield chunk
+
+def write_export(chunks, fmt, numeric_cols=None, part_bytes=EXPORT_PART_BYTES):
+    """
+    Stream DataFrame chunks into temp files (csv/parquet); returns (paths, rows).
+    A new part starts once the current one reaches part_bytes (each part is a complete
+    file). Columns in numeric_cols are written as floats, everything else as text, so
+    every chunk has the same Parquet schema. numeric_cols=None takes them from the first chunk.
+    """
+    paths, rows, fh, writer, part_size = [], 0, None, None, 0
+    def new_part():
+        fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{fmt}")
+        os.close(fd)
+        paths.append(path)
+        return path
+
+    try:
+        for chunk in chunks:
+            if fmt == "csv":
+                if fh is None or fh.tell() >= part_bytes:
+                    if fh is not None:
+                        fh.close()
+                    fh = open(new_part(), "w", newline="", encoding="utf-8")
+                    header = True
+                chunk.to_csv(fh, index=False, header=header)
+                header = False
+            else:
+                if numeric_cols is None:
+                    numeric_cols = [c for c in chunk.columns if pd.api.types.is_numeric_dtype(chunk[c])]
+                chunk = chunk.copy()
+                for c in chunk.columns:
+                    chunk[c] = (pd.to_numeric(chunk[c], errors="coerce").astype("float64")
+                                if c in numeric_cols else chunk[c].astype(str))
+                if writer is not None and part_size >= part_bytes:  # the writer buffers: count, don't stat
+                    writer.close()
+                    writer = None
+                if writer is None:
+                    part_size = 0
+                writer = _write_parquet_chunk(writer, paths[-1] if writer is not None else new_part(), chunk)
+                part_size += int(chunk.memory_usage(index=False, deep=True).sum())  # >= its Parquet size
+            rows += len(chunk)
+    except BaseException:
+        discard_export_files(paths)
+        raise
+    finally:
+        if fh is not None:
+            fh.close()
+        if writer is not None:
+            writer.close()
+    return paths, rows
+
+def _write_parquet_chunk(writer, path, chunk):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow).")
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+    writer.write_table(table)
+    return writer
+
+def discard_export_files(paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def sweep_export_files(max_age_s=EXPORT_TTL_S):
+    """Delete export/ledger temp files left behind by sessions that ended before downloading."""
+    cutoff = time.time() - max_age_s
+    tmp = tempfile.gettempdir()
+    for name in os.listdir(tmp):
+        path = os.path.join(tmp, name)
+        if name.startswith(("export_", "ledger_")) and os.path.isfile(path):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass  # another session got there first
+
+def _served_export_part(key):
+    """Download clicked: that part is done; the next one (if any) renders on this rerun."""
+    pending = st.session_state.get(f"{key}_file")
+    if pending:
+        discard_export_files(pending["parts"][:1])
+        pending["parts"], pending["served"] = pending["parts"][1:], False
+
+def render_export(key, file_stem, make_chunks, numeric_cols=None, label="export"):
+    """
+    Format picker + 'Prepare' button; the file is only built when asked for and offered
+    for one render: Streamlit reads a download's bytes into memory each time the button
+    is drawn, so it is dropped (and deleted) as soon as the user does anything else.
+    Large exports come in parts of up to EXPORT_PART_BYTES, one download at a time.
+    """
+    pending = st.session_state.get(f"{key}_file")
+    if pending and pending["served"]:  # shown last run, not clicked -> the user moved on
+        discard_export_files(pending["parts"])
+        st.session_state.pop(f"{key}_file")
+
+    c1, c2 = st.columns([1, 2])
+    with c1:
+        fmt = st.radio("Format", EXPORT_FORMATS, horizontal=True, key=f"{key}_fmt")
+    with c2:
+        if st.button(f"Prepare {label}", key=f"{key}_prepare"):
+            old = st.session_state.pop(f"{key}_file", None)
+            if old:
+                discard_export_files(old["parts"])
+            sweep_export_files()
+            try:
+                with st.spinner("Building export…"):
+                    paths, rows = write_export(make_chunks(), fmt, numeric_cols)
+                if rows:
+                    st.session_state[f"{key}_file"] = {"parts": paths, "count": len(paths), "rows": rows,
+                                                       "fmt": fmt, "served": False}
+                else:
+                    discard_export_files(paths)
+                    st.info("No rows in this range — nothing to export.")
+            except RuntimeError as e:
+                st.error(str(e))
+
+    pending = st.session_state.get(f"{key}_file")
+    if not pending:
+        return
+    if not pending["parts"] or not os.path.exists(pending["parts"][0]):
+        discard_export_files(pending["parts"])
+        st.session_state.pop(f"{key}_file")
+        return
+    fmt, n, count = pending["fmt"], pending["count"] - len(pending["parts"]) + 1, pending["count"]
+    part = f" — part {n} of {count}" if count > 1 else ""
+    with open(pending["parts"][0], "rb") as fh:
+        st.download_button(
+            f"⬇️ Download {fmt.upper()} ({pending['rows']:,} rows){part}", data=fh,
+            file_name=f"{file_stem}{f'_part{n}' if count > 1 else ''}.{fmt}", mime=EXPORT_MIME[fmt],
+            key=f"{key}_download", on_click=_served_export_part, args=(key,),
+        )
+    pending["served"] = True
+    st.caption("Ready until your next action on this page" + (" — the next part follows each download." if count > 1 else "."))
+
 # ---------- DAILY VISITS VIEW (raw transactions with filters) ----------
 def render_daily_visits_view():
     st.subheader("📒 Daily Visits — Transactions (raw)")
 
-    tx = load_sheet(SHEET_NAME, TAB_TRANSACTIONS)
+    tx = load_transactions()
     if tx.empty:
         st.info("No transactions yet.")
         return
 
     # Ensure same columns/order as the sheet
-    tx = ensure_tx_columns(tx).copy()
+    tx = ensure_tx_columns(tx)
 
     # Parse timestamp + helper date column
     tx["timestamp"] = pd.to_datetime(tx["timestamp_iso"], errors="coerce")
@@ -373,7 +1825,7 @@ def render_daily_visits_view():
     if branch_pick != "ALL" and "branch_id" in tx.columns:
         filt &= (tx["branch_id"].astype(str).str.upper() == branch_pick)
 
-    tx_day = tx.loc[filt].copy()
+    tx_day = tx.loc[filt]
 
     with colC:
         shifts = ["ALL"] + sorted(tx_day["shift_id"].dropna().unique().tolist())
@@ -394,159 +1846,279 @@ def render_daily_visits_view():
     # Show EXACT columns as in the sheet (TX_COLS order)
     st.dataframe(tx_day[TX_COLS], use_container_width=True)
 
-    # Download
-    st.download_button(
-        "⬇️ Download CSV (filtered)",
-        data=tx_day[TX_COLS].to_csv(index=False),
-        file_name=f"transactions_{day}_{branch_pick}_{shift_pick}.csv",
-        mime="text/csv",
+    # Download (built on demand)
+    render_export(
+        "visits_day", f"transactions_{day}_{branch_pick}_{shift_pick}",
+        lambda: iter([tx_day[TX_COLS]]), TX_NUMERIC_COLS,
     )
 
-def compute_commissions(start_date, end_date, branch_filter: str | None = None):
-    """
-    Compute payroll using commission_policy rules.
-    branch_filter: None/"ALL" for company-wide, or "B1"/"B2" to scope by branch.
-    """
-    B2_SHIFT_BASE_PESO = 500.0  # fixed base per shift at B2
+    with st.expander("Export a date range (streamed from the sheet)"):
+        colR1, colR2, colR3 = st.columns(3)
+        with colR1:
+            r_start = st.date_input("From", value=day.replace(day=1), key="export_from")
+        with colR2:
+            r_end = st.date_input("To", value=day, key="export_to")
+        with colR3:
+            r_branches = st.multiselect("Branches", options=branches[1:], key="export_branches")
+        render_export(
+            "visits_range", f"transactions_{r_start}_{r_end}_{'-'.join(r_branches) or 'ALL'}",
+            lambda: iter_transactions(r_start, r_end, r_branches), TX_NUMERIC_COLS,
+        )
 
-    services, classes, policy, emps, vmodels = load_catalog()
+# ---------- DASHBOARD (revenue cube slices) ----------
+def render_dashboard_view():
+    st.subheader("📊 Revenue Dashboard")
+    cube = get_revenue_cube()
 
-    # ---- Load transactions in window (and scope if requested)
-    tx = load_sheet(SHEET_NAME, TAB_TRANSACTIONS)
+    s_guess, e_guess = current_pay_window(date.today())
+    colA, colB, colC = st.columns([1, 1, 2])
+    with colA:
+        d_start = st.date_input("From", value=s_guess, key="dash_from")
+    with colB:
+        d_end = st.date_input("To", value=e_guess, key="dash_to")
+    with colC:
+        branches = st.multiselect("Branches", options=cube.values("branch_id"), key="dash_branches")
+
+    colD, colE = st.columns([2, 2])
+    with colD:
+        group_by = st.multiselect("Group by", options=CUBE_DIMS, default=["date","branch_id","shift"], key="dash_group")
+    with colE:
+        services = st.multiselect("Services", options=cube.values("service"), key="dash_services")
+
+    days = [d.strftime("%Y-%m-%d") for d in pd.date_range(d_start, d_end)]
+    filters = {"date": days}
+    if branches:
+        filters["branch_id"] = branches
+    if services:
+        filters["service"] = services
+
+    totals = cube.query([], {k: v for k, v in filters.items() if k != "service"})
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Visits", f"{int(totals['visits'].sum()):,}")
+    m2.metric("Services revenue (₱)", f"{totals['amount_peso'].sum():,.2f}")
+    m3.metric("Amount paid (₱)", f"{totals['amount_paid_peso'].sum():,.2f}")
+
+    view = cube.query(group_by, filters)
+    if view.empty:
+        st.info("No transactions in this range.")
+        return
+    st.dataframe(view, use_container_width=True)
+    if group_by:
+        st.bar_chart(view.groupby(group_by[0])["amount_peso"].sum())
+
+# ---------- PAYROLL BUILDING BLOCKS ----------
+def load_period_transactions(start_date, end_date, branch_filter: str | None = None):
+    """Transactions dated in [start_date, end_date], optionally scoped to one branch."""
+    return prepare_period_transactions(load_transactions(branch_scope(branch_filter)),
+                                       start_date, end_date, branch_filter)
+
+def prepare_period_transactions(tx, start_date, end_date, branch_filter=None):
+    """Normalize raw transaction rows and keep those in the window (and branch)."""
     if tx.empty:
-        return pd.DataFrame(), pd.DataFrame()
-    tx = ensure_tx_columns(tx).copy()
+        return pd.DataFrame(columns=TX_COLS + ["timestamp"])
+    tx = ensure_tx_columns(tx)
     if "branch_id" not in tx.columns:
         tx["branch_id"] = "B1"
     tx["branch_id"] = tx["branch_id"].astype(str).str.upper()
     tx["performed_by_employee_id"] = tx["performed_by_employee_id"].astype(str).fillna("")
     tx["timestamp"] = pd.to_datetime(tx["timestamp_iso"], errors="coerce")
     mask = (tx["timestamp"].dt.date >= start_date) & (tx["timestamp"].dt.date <= end_date)
-    tx = tx[mask].copy()
+    tx = tx[mask]
     if branch_filter and branch_filter.upper() != "ALL":
-        tx = tx[tx["branch_id"] == branch_filter.upper()].copy()
+        tx = tx[tx["branch_id"] == branch_filter.upper()]
+    return tx
+
+def price_lines(tx, services):
+    """Add amount_c (centavos): price book price, else the sheet price, times units."""
+    # last catalog row wins for duplicate (service, vehicle_class)
+    book = services[["service","vehicle_class","price_peso"]].drop_duplicates(["service","vehicle_class"], keep="last")
+    book = book.rename(columns={"price_peso": "book_price_peso"})
+    tx = tx.merge(book, on=["service","vehicle_class"], how="left")
+    units = pd.to_numeric(tx["units"], errors="coerce").fillna(1).replace(0, 1)
+    price_c = to_centavos(tx["book_price_peso"]).where(tx["book_price_peso"].notna(), to_centavos(tx["price_peso"]))
+    tx["amount_c"] = scale_centavos(price_c, units)
+    return tx
+
+def performer_mask(tx):
+    return tx["performed_by_employee_id"].replace("nan", "") != ""
+
+def performers_by_shift(tx):
+    """(branch_id, shift_id) -> set of employees who performed at least one line."""
+    return (
+        tx[performer_mask(tx)]
+        .groupby(["branch_id","shift_id"])["performed_by_employee_id"]
+        .apply(lambda s: set(map(str, s)))
+        .to_dict()
+    )
 
-    if tx.empty:
-        return pd.DataFrame(), pd.DataFrame()
+def pool_participants(branch_id, shift_id, ts, presence, perf_by_key):
+    """Who shares a pooled line: present at ts AND performed in the shift."""
+    return choose_participants(presence.present_at(branch_id, ts), perf_by_key.get((branch_id, shift_id), set()))
+
+def choose_participants(active, performers):
+    # split to intersection first
+    participants = sorted(active & performers)
+
+    # Fallbacks: performers-only, then present-only, then UNASSIGNED
+    if not participants:
+        participants = sorted(performers) if performers else sorted(active)
+    if not participants:
+        participants = ["UNASSIGNED"]  # keep ledger balanced even if totally empty
+    return tuple(participants)
+
+def apply_commission_rules(tx, policy, rules):
+    """Add commission_type/percent/commission_c per line; rules caches (service, branch) lookups."""
+    for key in tx[["service","branch_id"]].drop_duplicates().itertuples(index=False, name=None):
+        if key not in rules:
+            rules[key] = match_commission_rule(str(key[0]), policy, key[1])
+    matched = [rules[key] for key in zip(tx["service"], tx["branch_id"])]
+    tx["commission_type"] = [ctype for ctype, _ in matched]
+    tx["percent"] = [pct for _, pct in matched]
+    tx["commission_c"] = pct_of_centavos(tx["amount_c"], tx["percent"])
+    return tx
+
+def split_commission_lines(tx):
+    """(direct ledger rows, pooled lines); a direct line without a performer goes to the pool."""
+    has_performer = performer_mask(tx)
+    direct = tx[(tx["commission_type"] == "direct") & has_performer]
+    # no performer recorded on a direct line -> safest is to add to pool for this shift
+    pooled = tx[(tx["commission_type"] == "pool_split") | ((tx["commission_type"] == "direct") & ~has_performer)]
+
+    comm_df = pd.DataFrame({
+        "branch_id": direct["branch_id"], "shift_id": direct["shift_id"],
+        "employee_id": direct["performed_by_employee_id"], "service": direct["service"],
+        "vehicle_class": direct["vehicle_class"], "commission_type": "direct",
+        "percent": direct["percent"], "base_amount": from_centavos(direct["amount_c"]),
+        "commission_c": direct["commission_c"],
+    }).reset_index(drop=True)
+    return comm_df, pooled
+
+def pool_ledger(groups, pool_by_key):
+    """
+    Ledger rows for pooled commission: groups maps (branch, shift, participants) to
+    centavos, each group split once; pool_by_key holds the shift totals.
+    """
+    shares = {}  # (branch_id, shift_id, employee_id) -> centavos
+    for (branch_id, shift_id, participants), cents in groups.items():
+        n = len(participants)
+        for eid, share in zip(participants, split_centavos(cents, n, split_start(branch_id, shift_id, n))):
+            shares[(branch_id, shift_id, eid)] = shares.get((branch_id, shift_id, eid), 0) + share
+
+    return pd.DataFrame([{
+        "branch_id": branch_id, "shift_id": shift_id, "employee_id": eid,
+        "service": "POOL_SPLIT", "vehicle_class": "", "commission_type": "pool_split",
+        "percent": None, "base_amount": from_centavos(pool_by_key[(branch_id, shift_id)]), "commission_c": cents
+    } for (branch_id, shift_id, eid), cents in shares.items()])
+
+def finish_ledger(comm_df):
+    """Typed commission columns; an empty ledger becomes an empty frame."""
+    if comm_df.empty:
+        return pd.DataFrame()
+    comm_df["commission_c"] = comm_df["commission_c"].astype("int64")
+    comm_df["commission_peso"] = from_centavos(comm_df["commission_c"])
+    return comm_df
+
+def assemble_payroll(days_present, b2_shifts, hours, comm_sum, start_date, end_date, branch_filter):
+    """
+    Payroll table from per-employee parts: days present, B2 shifts, hours worked
+    and commission centavos (comm_sum: employee_id, commission_c; may be empty).
+    """
+    B2_SHIFT_BASE_PESO = 500.0  # fixed base per shift at B2
+
+    emps2 = load_sheet(SHEET_NAME, TAB_EMPLOYEES)
+    for c in ["employee_id","name","role","base_daily_salary"]:
+        if c not in emps2.columns:
+            emps2[c] = 0 if c == "base_daily_salary" else ""
+    emps2["base_daily_salary"] = pd.to_numeric(emps2["base_daily_salary"], errors="coerce").fillna(0)
 
-    # ---- Price map
-    price_map = {(r["service"], r["vehicle_class"]): float(r["price_peso"]) for _, r in services.iterrows()}
+    payroll = days_present.merge(emps2[["employee_id","name","role","base_daily_salary"]], on="employee_id", how="left")
+    if payroll.empty:
+        payroll = pd.DataFrame(columns=["employee_id","name","role","base_daily_salary","days_present_branch"])
+
+    # hours actually on site in the window (from presence intervals)
+    payroll = payroll.merge(hours.reset_index(), on="employee_id", how="left")
+    payroll["hours_worked"] = pd.to_numeric(payroll["hours_worked"], errors="coerce").fillna(0.0).round(2)
+    days = pd.to_numeric(payroll["days_present_branch"], errors="coerce").fillna(0).astype("int64")
+    base_c = to_centavos(payroll["base_daily_salary"]) * days
+    payroll["base_pay_peso"] = from_centavos(base_c)
+
+    # add B2 base
+    payroll = payroll.merge(b2_shifts, on="employee_id", how="left")
+    payroll["b2_shifts"] = pd.to_numeric(payroll["b2_shifts"], errors="coerce").fillna(0).astype(int)
+    b2_c = payroll["b2_shifts"].astype("int64") * to_centavos(B2_SHIFT_BASE_PESO)
+    payroll["b2_shift_base_peso"] = from_centavos(b2_c)
+
+    # commissions
+    if not comm_sum.empty:
+        payroll = payroll.merge(comm_sum, on="employee_id", how="left")
+    else:
+        payroll["commission_c"] = 0
+    comm_c = payroll["commission_c"].fillna(0).astype("int64")
+    payroll["commission_peso"] = from_centavos(comm_c)
+
+    # totals reconcile to the centavo: sum integers, convert once
+    payroll["total_peso"] = from_centavos(base_c.to_numpy() + b2_c.to_numpy() + comm_c.to_numpy())
+
+    payroll["period_start"] = start_date.isoformat()
+    payroll["period_end"]   = end_date.isoformat()
+    payroll["branch_scope"] = (branch_filter or "ALL").upper()
+
+    order = ["employee_id","days_present_branch","hours_worked","name","role","base_daily_salary",
+             "base_pay_peso","b2_shifts","b2_shift_base_peso",
+             "commission_peso","total_peso","branch_scope","period_start","period_end"]
+    payroll = payroll[[c for c in order if c in payroll.columns]]
+    return payroll.sort_values(["employee_id"])
+
+@profiled_call("compute_commissions")
+def compute_commissions(start_date, end_date, branch_filter: str | None = None):
+    """
+    Compute payroll using commission_policy rules.
+    branch_filter: None/"ALL" for company-wide, or "B1"/"B2" to scope by branch.
+    """
+    services, classes, policy, emps, vmodels = load_catalog()
 
-    # ---- Commission pass driven by policy
-    comm_rows = []
-    pool_by_key = {}  # (branch_id, shift_id) -> peso pool
+    # ---- Load transactions in window (and scope if requested), priced in centavos
+    tx = load_period_transactions(start_date, end_date, branch_filter)
+    if tx.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    tx = price_lines(tx, services)
 
+    # ---- Commission pass driven by policy (one rule lookup per service/branch)
     # ensure policy has branch_id col
-    policy = policy.copy()
     if "branch_id" not in policy.columns:
         policy["branch_id"] = ""
 
-    for _, t in tx.iterrows():
-        branch_id = t["branch_id"]
-        service   = t["service"]
-        vclass    = t["vehicle_class"]
-        units     = float(t.get("units", 1) or 1)
-        price     = price_map.get((service, vclass), float(t.get("price_peso", 0) or 0))
-        amount    = price * units
-        shift_id  = t["shift_id"]
-        performer = str(t.get("performed_by_employee_id") or "")
-
-        # look up commission rule from sheet (branch-specific first, then global)
-        ctype, pct = match_commission_rule(service, policy, branch_id)
-
-        if ctype == "direct":
-            if performer:
-                comm_rows.append({
-                    "branch_id": branch_id, "shift_id": shift_id, "employee_id": performer,
-                    "service": service, "vehicle_class": vclass, "commission_type": "direct",
-                    "percent": pct, "base_amount": amount,
-                    "commission_peso": amount * (float(pct) / 100.0)
-                })
-            else:
-                # no performer recorded -> safest is to add to pool for this shift
-                pool_by_key[(branch_id, shift_id)] = pool_by_key.get((branch_id, shift_id), 0.0) + amount * (float(pct) / 100.0)
+    tx = apply_commission_rules(tx, policy, {})
+    comm_df, pooled = split_commission_lines(tx)
 
-        elif ctype == "pool_split":
-            pool_by_key[(branch_id, shift_id)] = pool_by_key.get((branch_id, shift_id), 0.0) + amount * (float(pct) / 100.0)
+    # ---- 2) split pools by attendance per branch+shift: each pooled line goes to
+    #         the people present at its timestamp who also performed in that shift.
+    # Attendance (may be empty) -> presence intervals
+    att = load_branch_tab(TAB_ATTENDANCE, branch_scope(branch_filter))
+    presence = PresenceIndex.from_attendance(att)
 
-        else:
-            # no matching rule -> no commission
-            pass
-
-    # ---- 2) split pools by attendance per branch+shift,
-    #         but only to people who are active AND performed at least one line.
-    comm_df = pd.DataFrame(comm_rows)
-
-    if pool_by_key:
-        # Build performers set per (branch, shift) from transactions
-        perf_by_key = (
-            tx[tx["performed_by_employee_id"] != ""]
-            .groupby(["branch_id","shift_id"])["performed_by_employee_id"]
-            .apply(lambda s: set(map(str, s)))
-            .to_dict()
-        )
+    if not pooled.empty:
+        pool_by_key = pooled.groupby(["branch_id","shift_id"])["commission_c"].sum().to_dict()
 
-        # Attendance (may be empty)
-        att = load_sheet(SHEET_NAME, TAB_ATTENDANCE)
-        if not att.empty:
-            att = ensure_columns(att, ["timestamp_iso","shift_id","employee_id","action","branch_id"]).copy()
-            att["timestamp"]   = pd.to_datetime(att["timestamp_iso"], errors="coerce")
-            att["branch_id"]   = att["branch_id"].astype(str).str.upper()
-            att["employee_id"] = att["employee_id"].astype(str)
-            # Optional scope
-            if branch_filter and branch_filter.upper() != "ALL":
-                att = att[att["branch_id"] == branch_filter.upper()]
-
-        for (branch_id, shift_id), pool_amt in pool_by_key.items():
-            active = set()
-            if not att.empty:
-                att_shift = att[(att["shift_id"] == shift_id) & (att["branch_id"] == branch_id)].sort_values("timestamp")
-                state = {}
-                for _, r in att_shift.iterrows():
-                    eid = r["employee_id"]
-                    if r["action"] == "CLOCK_IN":
-                        state[eid] = True
-                    elif r["action"] == "CLOCK_OUT":
-                        state[eid] = False
-                active = {eid for eid, on in state.items() if on}
-
-            performers = perf_by_key.get((branch_id, shift_id), set())
-
-            # NEW rule: split to intersection first
-            participants = sorted(active & performers) if (active and performers and (active & performers)) else []
-
-            # Fallbacks: performers-only, then active-only, then UNASSIGNED
-            if not participants:
-                participants = sorted(performers) if performers else sorted(active)
-
-            if not participants:
-                # keep ledger balanced even if totally empty
-                comm_df = pd.concat([comm_df, pd.DataFrame([{
-                    "branch_id": branch_id, "shift_id": shift_id, "employee_id": "UNASSIGNED",
-                    "service": "POOL_SPLIT", "vehicle_class": "", "commission_type": "pool_split",
-                    "percent": None, "base_amount": pool_amt, "commission_peso": pool_amt
-                }])], ignore_index=True)
-            else:
-                share = pool_amt / len(participants)
-                add = pd.DataFrame([{
-                    "branch_id": branch_id, "shift_id": shift_id, "employee_id": eid,
-                    "service": "POOL_SPLIT", "vehicle_class": "", "commission_type": "pool_split",
-                    "percent": None, "base_amount": pool_amt, "commission_peso": share
-                } for eid in participants])
-                comm_df = pd.concat([comm_df, add], ignore_index=True)
+        perf_by_key = performers_by_shift(tx)
+
+        # sum pooled centavos per (branch, shift, participant set), then split once
+        groups = {}
+        for branch_id, shift_id, ts, cents in zip(pooled["branch_id"], pooled["shift_id"], pooled["timestamp"], pooled["commission_c"]):
+            participants = pool_participants(branch_id, shift_id, ts, presence, perf_by_key)
+            k = (branch_id, shift_id, participants)
+            groups[k] = groups.get(k, 0) + int(cents)
+
+        comm_df = pd.concat([comm_df, pool_ledger(groups, pool_by_key)], ignore_index=True)
+
+    comm_df = finish_ledger(comm_df)
 
     # If we built across ALL but user asked for a specific branch, filter ledger now too
     if branch_filter and branch_filter.upper() != "ALL" and not comm_df.empty:
-        comm_df = comm_df[comm_df["branch_id"].astype(str).str.upper() == branch_filter.upper()].copy()
+        comm_df = comm_df[comm_df["branch_id"].astype(str).str.upper() == branch_filter.upper()]
 
     # ---- Base pay (days present and B2 base)
-    emps2 = load_sheet(SHEET_NAME, TAB_EMPLOYEES).copy()
-    for c in ["employee_id","name","role","base_daily_salary"]:
-        if c not in emps2.columns:
-            emps2[c] = 0 if c == "base_daily_salary" else ""
-    emps2["base_daily_salary"] = pd.to_numeric(emps2["base_daily_salary"], errors="coerce").fillna(0)
-
-    att_all = load_sheet(SHEET_NAME, TAB_ATTENDANCE).copy()
+    att_all = att
     if att_all.empty:
         days_present = pd.DataFrame(columns=["employee_id","days_present_branch"])
         b2_shifts    = pd.DataFrame(columns=["employee_id","b2_shifts"])
@@ -555,77 +2127,429 @@ def compute_commissions(start_date, end_date, branch_filter: str | None = None):
         att_all["timestamp"] = pd.to_datetime(att_all["timestamp_iso"], errors="coerce")
         att_all["branch_id"] = att_all["branch_id"].astype(str).str.upper()
         mask2 = (att_all["timestamp"].dt.date >= start_date) & (att_all["timestamp"].dt.date <= end_date)
-        att_all = att_all[mask2].copy()
+        att_all = att_all[mask2]
+        days_present, b2_shifts = base_pay_counts(*clock_in_keys(att_all, branch_filter))
 
-        # scope attendance to branch if requested (for base_daily_salary day counting)
-        if branch_filter and branch_filter.upper() != "ALL":
-            att_scope = att_all[(att_all["action"] == "CLOCK_IN") & (att_all["branch_id"] == branch_filter.upper())]
-        else:
-            att_scope = att_all[att_all["action"] == "CLOCK_IN"]
+    hours = presence.hours_worked(pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1), branch_filter)
+    comm_sum = (comm_df.groupby("employee_id")["commission_c"].sum().rename("commission_c").reset_index()
+                if not comm_df.empty else pd.DataFrame())
+    payroll = assemble_payroll(days_present, b2_shifts, hours, comm_sum, start_date, end_date, branch_filter)
 
-        if att_scope.empty:
-            days_present = pd.DataFrame(columns=["employee_id","days_present_branch"])
-        else:
-            att_scope["date"] = att_scope["timestamp"].dt.date
-            days_present = att_scope.groupby(["employee_id","date"]).size().reset_index()
-            days_present = days_present.groupby("employee_id").size().rename("days_present_branch").reset_index()
-
-        # B2 shift base: count unique (employee_id, shift_id) clock-ins at B2
-        if branch_filter and branch_filter.upper() == "B1":
-            b2_shifts = pd.DataFrame(columns=["employee_id","b2_shifts"])
-        else:
-            b2_only = att_all[(att_all["action"] == "CLOCK_IN") & (att_all["branch_id"] == "B2")]
-            if b2_only.empty:
-                b2_shifts = pd.DataFrame(columns=["employee_id","b2_shifts"])
-            else:
-                b2_shifts = b2_only.groupby(["employee_id","shift_id"]).size().reset_index().groupby("employee_id").size()
-                b2_shifts = b2_shifts.rename("b2_shifts").reset_index()
+    if not comm_df.empty:
+        comm_df = comm_df.drop(columns=["commission_c"]).sort_values(["branch_id","shift_id","employee_id","service"])
 
-    payroll = days_present.merge(emps2[["employee_id","name","role","base_daily_salary"]], on="employee_id", how="left")
-    if payroll.empty:
-        payroll = pd.DataFrame(columns=["employee_id","name","role","base_daily_salary","days_present_branch"])
-    payroll["base_pay_peso"] = payroll["base_daily_salary"] * payroll["days_present_branch"]
+    return payroll, comm_df
 
-    # add B2 base
-    payroll = payroll.merge(b2_shifts, on="employee_id", how="left")
-    payroll["b2_shifts"] = pd.to_numeric(payroll["b2_shifts"], errors="coerce").fillna(0).astype(int)
-    payroll["b2_shift_base_peso"] = payroll["b2_shifts"] * B2_SHIFT_BASE_PESO
+def clock_in_keys(att_all, branch_filter):
+    """
+    Clock-ins behind base pay, from attendance already limited to the window:
+    {(employee_id, date)} at the branch (if scoped) and {(employee_id, shift_id)} at B2.
+    """
+    clock_ins = att_all[att_all["action"] == "CLOCK_IN"]
 
-    # commissions
-    if not comm_df.empty:
-        comm_sum = comm_df.groupby("employee_id")["commission_peso"].sum().rename("commission_peso").reset_index()
-        payroll = payroll.merge(comm_sum, on="employee_id", how="left")
+    # scope attendance to branch if requested (for base_daily_salary day counting)
+    if branch_filter and branch_filter.upper() != "ALL":
+        att_scope = clock_ins[clock_ins["branch_id"] == branch_filter.upper()]
     else:
-        payroll["commission_peso"] = 0.0
-    payroll["commission_peso"] = payroll["commission_peso"].fillna(0.0)
+        att_scope = clock_ins
+    day_keys = set(zip(att_scope["employee_id"], att_scope["timestamp"].dt.date))
 
-    payroll["total_peso"] = (
-        payroll["base_pay_peso"].fillna(0.0)
-        + payroll["b2_shift_base_peso"].fillna(0.0)
-        + payroll["commission_peso"].fillna(0.0)
-    )
-
-    payroll["period_start"] = start_date.isoformat()
-    payroll["period_end"]   = end_date.isoformat()
-    payroll["branch_scope"] = (branch_filter or "ALL").upper()
+    # B2 shift base: unique (employee_id, shift_id) clock-ins at B2
+    if branch_filter and branch_filter.upper() == "B1":
+        b2_keys = set()
+    else:
+        b2_only = clock_ins[clock_ins["branch_id"] == "B2"]
+        b2_keys = set(zip(b2_only["employee_id"], b2_only["shift_id"]))
+    return day_keys, b2_keys
+
+def base_pay_counts(day_keys, b2_keys):
+    """(days_present, b2_shifts) per employee from clock_in_keys()."""
+    def per_employee(keys, col):
+        counts = Counter(eid for eid, _ in keys)
+        return pd.DataFrame(sorted(counts.items()), columns=["employee_id", col])
+    return per_employee(day_keys, "days_present_branch"), per_employee(b2_keys, "b2_shifts")
+
+# ======= STREAMING PAYROLL (long ranges, bounded memory) =======
+# Same result as compute_commissions, for multi-year ranges: transactions and attendance
+# are read chunk by chunk, spilled to disk per pay window, and folded one window at a
+# time into mergeable aggregates. Memory follows chunk/window size, not range length.
+STREAM_CHUNK_ROWS = EXPORT_CHUNK_ROWS
+
+def spill_by_window(chunks, cols, first_day, last_day, spill_dir, prefix):
+    """
+    Append rows dated in [first_day, last_day] to one CSV per pay window under spill_dir;
+    returns {window_start: path}. Rows keep their sheet order within a window.
+    """
+    paths = {}
+    for chunk in chunks:
+        chunk = ensure_columns(chunk.copy(), cols)
+        d = pd.to_datetime(chunk["timestamp_iso"], errors="coerce").dt.date
+        keep = d.notna() & (d >= first_day) & (d <= last_day)
+        chunk, d = chunk[keep], d[keep]
+        window = d.map({x: current_pay_window(x)[0] for x in d.unique()})
+        for w, part in chunk.groupby(window, sort=False):
+            path = paths.setdefault(w, os.path.join(spill_dir, f"{prefix}_{w.isoformat()}.csv"))
+            part.to_csv(path, mode="a", index=False, header=not os.path.exists(path))
+    return paths
+
+def read_spill(path, cols):
+    if path is None:
+        return pd.DataFrame(columns=cols)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def append_csv(df, path):
+    if not df.empty:
+        df.to_csv(path, mode="a", index=False, header=not (os.path.exists(path) and os.path.getsize(path)))
+
+class PresenceStream:
+    """
+    build_presence_intervals over attendance fed in time order. Every close rule caps
+    an interval at the end of its opening block, so once the stream is past that point
+    (and the block is not still running) the interval is final and is emitted.
+    """
+    def __init__(self):
+        self.open = {}      # (employee_id, branch_id) -> open CLOCK_IN timestamp
+        self.last_out = {}  # (employee_id, branch_id) -> last CLOCK_OUT timestamp
 
-    order = ["employee_id","days_present_branch","name","role","base_daily_salary",
-             "base_pay_peso","b2_shifts","b2_shift_base_peso",
-             "commission_peso","total_peso","branch_scope","period_start","period_end"]
-    payroll = payroll[[c for c in order if c in payroll.columns]]
+    def feed(self, att, watermark, now):
+        """att: rows sorted by time, all before watermark; returns intervals now final."""
+        rows = []
+        for eid, branch_id, ts, action in zip(att["employee_id"], att["branch_id"], att["timestamp"], att["action"]):
+            key = (eid, branch_id)
+            closed, open_at = presence_step(self.open.pop(key, None), ts, action, self.last_out.get(key))
+            rows.extend((eid, branch_id, a, b) for a, b in closed)
+            if action == "CLOCK_OUT":
+                self.last_out[key] = ts
+            if open_at is not None:
+                self.open[(eid, branch_id)] = open_at
+        for key, open_at in list(self.open.items()):
+            end = shift_block(open_at)[1]
+            if end <= watermark and end <= now:
+                rows.append((*key, open_at, end))
+                del self.open[key]
+        return self._frame(rows)
+
+    def close(self, now):
+        rows = [(*key, *presence_close(open_at, now)) for key, open_at in self.open.items()]
+        self.open = {}
+        return self._frame(rows)
+
+    @staticmethod
+    def _frame(rows):
+        out = pd.DataFrame(rows, columns=PRESENCE_COLS)
+        out["start"], out["end"] = pd.to_datetime(out["start"]), pd.to_datetime(out["end"])
+        return out[out["end"] > out["start"]].reset_index(drop=True)
+
+class PayrollPartial:
+    """Payroll aggregates over part of a range; merge() of two parts == both parts at once."""
+    def __init__(self):
+        self.direct_c   = Counter()  # employee_id -> direct commission centavos
+        self.pool_c     = Counter()  # (branch_id, shift_id) -> pooled centavos
+        self.pool_sets  = Counter()  # (branch_id, shift_id, frozenset(present)) -> pooled centavos
+        self.performers = {}         # (branch_id, shift_id) -> employees who performed
+        self.day_keys   = set()      # see clock_in_keys()
+        self.b2_keys    = set()
+        self.hours_ns   = Counter()  # employee_id -> ns on site inside the range
+        self.lines      = 0          # transaction lines folded in
+
+    def merge(self, other):
+        self.direct_c.update(other.direct_c)
+        self.pool_c.update(other.pool_c)
+        self.pool_sets.update(other.pool_sets)
+        for key, eids in other.performers.items():
+            self.performers.setdefault(key, set()).update(eids)
+        self.day_keys |= other.day_keys
+        self.b2_keys  |= other.b2_keys
+        self.hours_ns.update(other.hours_ns)
+        self.lines += other.lines
+        return self
+
+    def add_transactions(self, tx, presence):
+        """Priced, rule-tagged lines of one window; returns their direct ledger rows."""
+        self.lines += len(tx)
+        comm_df, pooled = split_commission_lines(tx)
+        self.direct_c.update({eid: int(c) for eid, c in comm_df.groupby("employee_id")["commission_c"].sum().items()})
+        for key, eids in performers_by_shift(tx).items():
+            self.performers.setdefault(key, set()).update(eids)
+        for branch_id, shift_id, ts, cents in zip(pooled["branch_id"], pooled["shift_id"], pooled["timestamp"], pooled["commission_c"]):
+            self.pool_c[(branch_id, shift_id)] += int(cents)
+            self.pool_sets[(branch_id, shift_id, frozenset(presence.present_at(branch_id, ts)))] += int(cents)
+        return comm_df
+
+    def add_intervals(self, iv, start, end, branch_filter):
+        if branch_scope(branch_filter):
+            iv = iv[iv["branch_id"] == branch_filter.upper()]
+        if not iv.empty:
+            ns = clipped_ns(iv, start, end)
+            self.hours_ns.update({eid: int(n) for eid, n in ns.groupby(iv["employee_id"]).sum().items()})
+
+    def pool_rows(self):
+        """Pool ledger rows: participants need the whole period's performers, so this runs last."""
+        groups = Counter()
+        for (branch_id, shift_id, present), cents in self.pool_sets.items():
+            performers = self.performers.get((branch_id, shift_id), set())
+            groups[(branch_id, shift_id, choose_participants(set(present), performers))] += cents
+        return pool_ledger(groups, self.pool_c) if groups else pd.DataFrame()
+
+@profiled_call("stream_payroll")
+def stream_payroll(start_date, end_date, branch_filter=None, ledger_path=None, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    compute_commissions, one pay window at a time. Returns the payroll table; the
+    commission ledger is appended to ledger_path (CSV, window order) if given.
+    """
+    services, classes, policy, emps, vmodels = load_catalog()
+    policy = policy.copy()
+    if "branch_id" not in policy.columns:
+        policy["branch_id"] = ""
+    scope = branch_scope(branch_filter)
+    now = pd.Timestamp(datetime.now())
+    range_start, range_end = pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1)
+
+    def chunks(tab):
+        for workbook in shard_workbooks(scope):
+            yield from iter_sheet_chunks(workbook, tab, chunk_rows)
+
+    total, presence, rules = PayrollPartial(), PresenceStream(), {}
+    recent = PresenceStream._frame([])  # intervals that may cover pending lines
+
+    def fold_window(w):
+        tx = prepare_period_transactions(read_spill(tx_paths[w], TX_COLS), start_date, end_date, branch_filter)
+        if tx.empty:
+            return
+        tx = apply_commission_rules(price_lines(tx, services), policy, rules)
+        direct = finish_ledger(total.add_transactions(tx, PresenceIndex(recent)))
+        if ledger_path and not direct.empty:
+            append_csv(direct.drop(columns=["commission_c"]).sort_values(["branch_id","shift_id","employee_id","service"]),
+                       ledger_path)
+
+    with tempfile.TemporaryDirectory(prefix="payroll_stream_") as spill_dir:
+        tx_chunks = (c for wb in shard_workbooks(scope) for c in iter_transaction_chunks(wb, chunk_rows, start_date, end_date))
+        tx_paths = spill_by_window(tx_chunks, TX_COLS, start_date, end_date, spill_dir, "tx")
+        # a day of attendance either side: blocks cross midnight at the range edges
+        att_paths = spill_by_window(chunks(TAB_ATTENDANCE), ATT_COLS, start_date - timedelta(days=1),
+                                    end_date + timedelta(days=1), spill_dir, "att")
+
+        # lines of a window are folded after the next window's attendance, when every
+        # interval that can cover them has been emitted
+        pending = None
+        for w in sorted(set(tx_paths) | set(att_paths)):
+            att = read_spill(att_paths.get(w), ATT_COLS)
+            att["timestamp"] = pd.to_datetime(att["timestamp_iso"], errors="coerce")
+            att["branch_id"] = att["branch_id"].astype(str).str.upper()
+            att = att.dropna(subset=["timestamp"]).sort_values("timestamp", kind="mergesort")
+
+            in_range = att[(att["timestamp"] >= range_start) & (att["timestamp"] < range_end)]
+            day_keys, b2_keys = clock_in_keys(in_range, branch_filter)
+            total.day_keys |= day_keys
+            total.b2_keys  |= b2_keys
+
+            watermark = pd.Timestamp(current_pay_window(w)[1]) + pd.Timedelta(days=1)
+            new = presence.feed(att, watermark, now)
+            total.add_intervals(new, range_start, range_end, branch_filter)
+            recent = pd.concat([recent, new], ignore_index=True) if not new.empty else recent
+            if pending is not None:
+                recent = recent[recent["end"] > pd.Timestamp(pending)].reset_index(drop=True)
+                fold_window(pending)
+            pending = w if w in tx_paths else None
+
+        new = presence.close(now)
+        total.add_intervals(new, range_start, range_end, branch_filter)
+        recent = pd.concat([recent, new], ignore_index=True) if not new.empty else recent
+        if pending is not None:
+            fold_window(pending)
+
+    pool = finish_ledger(total.pool_rows())
+    if ledger_path and not pool.empty:
+        append_csv(pool.drop(columns=["commission_c"]).sort_values(["branch_id","shift_id","employee_id","service"]),
+                   ledger_path)
+
+    comm_c = Counter(total.direct_c)
+    if not pool.empty:
+        comm_c.update({eid: int(c) for eid, c in pool.groupby("employee_id")["commission_c"].sum().items()})
+    comm_sum = pd.DataFrame(list(comm_c.items()), columns=["employee_id","commission_c"]) if comm_c else pd.DataFrame()
+    hours = pd.Series({eid: n / NS_PER_HOUR for eid, n in total.hours_ns.items()}, dtype=float, name="hours_worked")
+    hours.index.name = "employee_id"
+    days_present, b2_shifts = base_pay_counts(total.day_keys, total.b2_keys)
+    if not total.lines:
+        return pd.DataFrame()
+    return assemble_payroll(days_present, b2_shifts, hours, comm_sum, start_date, end_date, branch_filter)
+
+
+# ======= WHAT-IF POLICY SIMULATOR =======
+SETTINGS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated", "payroll_settings.csv")
+POLICY_COLS  = ["rule_id","branch_id","service_regex","commission_type","percent","notes"]
+
+def load_role_multipliers(path=SETTINGS_CSV):
+    """{role: {"pool": x, "direct": y}} from payroll_settings.csv; empty if disabled or missing."""
+    if not os.path.exists(path):
+        return {}
+    settings = pd.read_csv(path, dtype=str).fillna("")
+    kv = dict(zip(settings["key"].str.strip(), settings["value"].str.strip()))
+    if kv.get("enable_role_multipliers", "").upper() != "TRUE":
+        return {}
+    out = {}
+    for k, v in kv.items():
+        m = re.match(r"role_multiplier_(pool|direct)_(.+)$", k)
+        if m:
+            out.setdefault(m.group(2), {"pool": 1.0, "direct": 1.0})[m.group(1)] = float(v or 1.0)
+    return out
+
+@st.cache_data(ttl=300)
+def load_simulation_data(start_date, end_date, branch_filter: str = "ALL"):
+    """
+    Resolve everything about a period that does not depend on the policy, once:
+    line amounts, performers and pool participants (grouped like compute_commissions).
+    """
+    services, classes, policy, emps, vmodels = load_catalog()
+    tx = load_period_transactions(start_date, end_date, branch_filter)
+    if tx.empty:
+        return None
+    tx = price_lines(tx, services)
+    presence = PresenceIndex.from_attendance(load_branch_tab(TAB_ATTENDANCE, branch_scope(branch_filter)))
+    perf_by_key = performers_by_shift(tx)
+
+    pair_keys = list(zip(tx["service"].astype(str), tx["branch_id"]))
+    pairs = sorted(set(pair_keys))
+    pair_pos = {p: i for i, p in enumerate(pairs)}
+
+    has_perf = performer_mask(tx).to_numpy()
+    performers = tx["performed_by_employee_id"].astype(str).to_numpy()
+    groups = {}   # (branch, shift, participants) -> group id
+    line_group = np.empty(len(tx), dtype="int64")
+    for i, (branch_id, shift_id, ts) in enumerate(zip(tx["branch_id"], tx["shift_id"], tx["timestamp"])):
+        k = (branch_id, shift_id, pool_participants(branch_id, shift_id, ts, presence, perf_by_key))
+        line_group[i] = groups.setdefault(k, len(groups))
+
+    employees = sorted(set(performers[has_perf]) | {e for (_, _, ps) in groups for e in ps})
+    emp_pos = {e: i for i, e in enumerate(employees)}
+    # rank counted from the group's split_start, so "rank < remainder" matches split_centavos
+    members = [(gid, emp_pos[e], (i - split_start(b, s, len(ps))) % len(ps))
+               for (b, s, ps), gid in groups.items() for i, e in enumerate(ps)]
+
+    return {
+        "pairs": pairs,
+        "pair_code": np.array([pair_pos[p] for p in pair_keys], dtype="int64"),
+        "amount_c": tx["amount_c"].to_numpy(dtype="int64"),
+        "perf_idx": np.array([emp_pos[e] if h else -1 for e, h in zip(performers, has_perf)], dtype="int64"),
+        "line_group": line_group,
+        "group_size": np.array([len(ps) for (_, _, ps) in groups], dtype="int64"),
+        "member_group": np.array([m[0] for m in members], dtype="int64"),
+        "member_emp": np.array([m[1] for m in members], dtype="int64"),
+        "member_rank": np.array([m[2] for m in members], dtype="int64"),
+        "employees": employees,
+    }
 
-    if not comm_df.empty:
-        comm_df = comm_df.sort_values(["branch_id","shift_id","employee_id","service"])
+def simulate_policies(data, candidates, emps_df):
+    """
+    Evaluate K candidate policies over the same period in one pass.
+    candidates: {name: (policy_df, role_multipliers)}; returns commission pesos per
+    employee (rows) and candidate (columns). Pools split exactly like compute_commissions.
+    """
+    K = len(candidates)
+    P, N, E = len(data["pairs"]), len(data["amount_c"]), len(data["employees"])
+    codes, amount = data["pair_code"], data["amount_c"]
+
+    # rule lookup per (service, branch) pair: 0 = none, 1 = direct, 2 = pool_split
+    ctype = np.zeros((K, P), dtype="int8")
+    pct   = np.zeros((K, P), dtype=float)
+    for k, (policy, _) in enumerate(candidates.values()):
+        policy = ensure_columns(policy.copy(), POLICY_COLS)
+        for p, (service, branch_id) in enumerate(data["pairs"]):
+            t, pc = match_commission_rule(service, policy, branch_id)
+            ctype[k, p] = 1 if t == "direct" else 2 if t == "pool_split" else 0
+            pct[k, p] = pc
+
+    comm = pct_of_centavos(np.broadcast_to(amount, (K, N)).ravel(), pct[:, codes].ravel()).reshape(K, N)
+    t = ctype[:, codes]
+    has_perf = data["perf_idx"] >= 0
+    direct = (t == 1) & has_perf
+    pooled = (t == 2) | ((t == 1) & ~has_perf)
+
+    rows = np.broadcast_to(np.arange(K)[:, None], (K, N))
+    direct_c = np.zeros((K, E), dtype="int64")
+    np.add.at(direct_c, (rows, np.broadcast_to(np.where(has_perf, data["perf_idx"], 0), (K, N))), comm * direct)
+
+    G = len(data["group_size"])
+    group_c = np.zeros((K, G), dtype="int64")
+    np.add.at(group_c, (rows, np.broadcast_to(data["line_group"], (K, N))), comm * pooled)
+    # split_centavos per group: q each, the r members ranked first from split_start get +1
+    q, r = np.divmod(group_c, data["group_size"])
+    mg = data["member_group"]
+    shares = q[:, mg] + (data["member_rank"] < r[:, mg])
+    pool_c = np.zeros((K, E), dtype="int64")
+    M = len(mg)
+    np.add.at(pool_c, (np.broadcast_to(np.arange(K)[:, None], (K, M)), np.broadcast_to(data["member_emp"], (K, M))), shares)
+
+    # role multipliers on each employee's pool/direct totals
+    roles = {}
+    if not emps_df.empty and "role" in emps_df.columns:
+        roles = dict(zip(emps_df["employee_id"].astype(str), emps_df["role"].astype(str)))
+    out = pd.DataFrame(index=pd.Index(data["employees"], name="employee_id"))
+    for k, (name, (_, mults)) in enumerate(candidates.items()):
+        m_pool   = np.array([mults.get(roles.get(e, ""), {}).get("pool", 1.0) for e in data["employees"]])
+        m_direct = np.array([mults.get(roles.get(e, ""), {}).get("direct", 1.0) for e in data["employees"]])
+        out[name] = from_centavos(scale_centavos(pool_c[k], m_pool) + scale_centavos(direct_c[k], m_direct)).to_numpy()
+    return out
+
+def render_simulator_view():
+    st.subheader("🧪 What-if Commission Policy Simulator")
+    services, classes, policy, emps, vmodels = load_catalog()
 
-    return payroll.sort_values(["employee_id"]), comm_df
+    s_guess, e_guess = current_pay_window(date.today())
+    colA, colB, colC = st.columns(3)
+    with colA:
+        sim_start = st.date_input("Start", value=s_guess, key="sim_start")
+    with colB:
+        sim_end = st.date_input("End", value=e_guess, key="sim_end")
+    with colC:
+        sim_scope = st.selectbox("Branch scope", ["ALL", "B1", "B2"], key="sim_scope")
 
+    data = load_simulation_data(sim_start, sim_end, sim_scope)
+    if data is None:
+        st.info("No transactions in this range.")
+        return
 
+    live = ensure_columns(policy.copy(), POLICY_COLS)
+    st.caption("Edit the draft policy below (add rows with a branch_id for per-branch overrides).")
+    draft = st.data_editor(live, num_rows="dynamic", use_container_width=True, key="sim_policy")
+
+    mults = load_role_multipliers()
+    roles = sorted(set(mults) | set(emps.get("role", pd.Series(dtype=str)).astype(str)) - {""})
+    mult_df = pd.DataFrame([{"role": r, "pool": mults.get(r, {}).get("pool", 1.0),
+                             "direct": mults.get(r, {}).get("direct", 1.0)} for r in roles])
+    use_mults = st.toggle("Apply role multipliers (payroll_settings.csv)", value=bool(mults), key="sim_use_mults")
+    if use_mults and not mult_df.empty:
+        mult_df = st.data_editor(mult_df, disabled=["role"], use_container_width=True, key="sim_mults")
+    draft_mults = {r["role"]: {"pool": float(r["pool"]), "direct": float(r["direct"])}
+                   for r in mult_df.to_dict("records")} if use_mults else {}
+
+    saved = st.session_state.setdefault("sim_candidates", {})
+    c1, c2, c3 = st.columns([2, 1, 1])
+    with c1:
+        cand_name = st.text_input("Candidate name", value=f"Candidate {len(saved) + 1}", key="sim_cand_name")
+    with c2:
+        if st.button("Save draft as candidate", key="sim_save"):
+            saved[cand_name] = (draft.copy(), draft_mults)
+    with c3:
+        if st.button("Clear candidates", key="sim_clear"):
+            saved.clear()
+
+    candidates = {"Live": (live, {}), "Draft": (draft, draft_mults), **saved}
+    result = simulate_policies(data, candidates, emps)
+    for name in list(candidates)[1:]:
+        result[f"Δ {name}"] = (result[name] - result["Live"]).round(2)
+
+    if not emps.empty and "name" in emps.columns:
+        names = emps.assign(employee_id=emps["employee_id"].astype(str)).set_index("employee_id")["name"]
+        result.insert(0, "name", result.index.map(names).fillna(""))
+    st.dataframe(result.reset_index(), use_container_width=True)
+    st.caption("Commission only (₱); base pay does not depend on the policy.")
 
 def active_employees_for(branch_id: str, shift_id: str):
-    att = load_sheet(SHEET_NAME, TAB_ATTENDANCE)
+    att = load_branch_tab(TAB_ATTENDANCE, [branch_id])
     if att.empty:
         return []
-    att = ensure_att_columns(att).copy()
+    att = ensure_att_columns(att)
     att["employee_id"] = att["employee_id"].astype(str)
     att["branch_id"] = att["branch_id"].astype(str).fillna("")
 
@@ -669,36 +2593,72 @@ def log_visit_ui(branch_id: str):
     )
 
     if show_only_active and active_now:
-        emps_for_picker = emps_df[emps_df["employee_id"].isin(active_now)].copy()
+        emps_for_picker = emps_df[emps_df["employee_id"].isin(active_now)]
     else:
-        emps_for_picker = emps_df.copy()
+        emps_for_picker = emps_df
 
     # If somehow empty, fall back to all employees so the form remains usable
     if emps_for_picker.empty:
-        emps_for_picker = emps_df.copy()
+        emps_for_picker = emps_df
 
     st.caption(
         f"Current shift: `{current_shift}` • Active @ {branch_id}: "
         f"{', '.join(active_now) if active_now else 'none'}"
     )
 
-    # --- Vehicle model selector ---
-    vmodels_df = vmodels_df.copy()
-    vmodels_df["label"] = vmodels_df["label"].astype(str)
-    vehicle_label = st.selectbox(
-        "Vehicle model (search by name)",
-        options=sorted(vmodels_df["label"].unique().tolist()),
-        key=f"vehicle_label_{branch_id}"
+    vindex = get_vehicle_model_index(vmodels_df)
+    vkey = f"vehicle_label_{branch_id}"
+
+    # --- Plate lookup: autofill model + customer from the last visit ---
+    plate = st.text_input("Plate (optional)", key=f"plate_{branch_id}")
+    cust_idx = get_customer_index()
+    known = cust_idx.lookup(plate) if plate else None
+    if known and st.session_state.get(f"autofill_{branch_id}") != known["plate"]:
+        option = vindex.option_for(known["vehicle_model"], known["vehicle_class"])
+        if option:
+            st.session_state[vkey] = option
+        st.session_state[f"cname_{branch_id}"]  = known["customer_name"]
+        st.session_state[f"cphone_{branch_id}"] = known["customer_phone"]
+        st.session_state[f"autofill_{branch_id}"] = known["plate"]
+    if known:
+        st.caption(f"Returning vehicle **{known['plate']}** — last seen {known['last_seen']}, "
+                   f"{len(known['visits'])} visit(s)")
+        with st.expander("Past visits", expanded=False):
+            st.dataframe(cust_idx.history(plate), use_container_width=True)
+    elif plate:
+        matches = cust_idx.search(plate)
+        st.caption(f"Known plates: {', '.join(matches)}" if matches else "New plate.")
+
+    # --- Vehicle model: typeahead over the prebuilt index ---
+    query = st.text_input("Vehicle model search", key=f"vsearch_{branch_id}",
+                          placeholder="brand, model or alias — e.g. vios, hiace, chevy")
+    hits = vindex.search(query)
+    if query and not hits:
+        st.warning("No vehicle model matches that search.")
+    if hits and st.session_state.get(f"vquery_{branch_id}") != query:
+        st.session_state[vkey] = hits[0]  # new search -> best match selected
+    st.session_state[f"vquery_{branch_id}"] = query
+    if vindex.entry(st.session_state.get(vkey)) is None:  # model removed from the tab meanwhile
+        st.session_state[vkey] = (hits or vindex.options or [None])[0]
+    current = st.session_state[vkey]
+    vehicle_option = st.selectbox(
+        "Vehicle model",
+        options=hits if current in hits else [current] + hits,
+        key=vkey
     )
-    vehicle_class = vmodels_df.set_index("label").loc[vehicle_label, "vehicle_class"]
+    chosen = vindex.entry(vehicle_option) or {"label": "", "vehicle_class": ""}
+    vehicle_label, vehicle_class = chosen["label"], chosen["vehicle_class"]
     st.caption(f"Detected vehicle class: **{vehicle_class}**")
 
     # Visit-level fields
-    c0, c1, c2, c3 = st.columns(4)
-    with c0: plate = st.text_input("Plate (optional)", key=f"plate_{branch_id}")
+    c1, c2, c3 = st.columns(3)
     with c1: customer_name = st.text_input("Customer name (optional)", key=f"cname_{branch_id}")
     with c2: customer_phone = st.text_input("Customer phone (optional)", key=f"cphone_{branch_id}")
     with c3: payment_method = st.selectbox("Payment method", ["", "cash", "gcash", "card", "other"], key=f"pm_{branch_id}")
+    if customer_phone and not plate:
+        phone_plates = cust_idx.plates_for_phone(customer_phone)
+        if phone_plates:
+            st.caption(f"Plates on file for this phone: {', '.join(phone_plates)}")
     amount_paid = st.number_input("Amount paid (₱) — per visit (total)", min_value=0.0, value=0.0, step=10.0, key=f"paid_{branch_id}")
 
     # Services
@@ -706,7 +2666,7 @@ def log_visit_ui(branch_id: str):
     all_services = sorted(services_df["service"].unique().tolist())
     selected_services = st.multiselect("Services included in this visit", options=all_services, key=f"svcsel_{branch_id}")
 
-    per_line_inputs, services_total = [], 0.0
+    per_line_inputs, services_total_c = [], 0
     for svc in selected_services:
         with st.expander(f"{svc}", expanded=True):
             c1, c2, c3 = st.columns([1, 1, 1])
@@ -719,7 +2679,7 @@ def log_visit_ui(branch_id: str):
                     price = st.number_input(f"{svc} — Price (₱)", min_value=0.0, step=10.0, value=0.0, key=f"price_{branch_id}_{svc}")
                 else:
                     price = float(price_row.iloc[0]["price_peso"])
-                    st.write(f"Price (₱): **{price:,.2f}**")
+                    st.write(f"Price (₱): **{from_centavos(to_centavos(price)):,.2f}**")
             with c3:
                 performer = st.selectbox(
                     f"{svc} — Performed by (required)",
@@ -729,21 +2689,23 @@ def log_visit_ui(branch_id: str):
                 )
 
             notes = st.text_input(f"{svc} — Notes (optional)", key=f"notes_{branch_id}_{svc}")
-            line_total = float(price) * float(units)
-            services_total += line_total
-            st.caption(f"Line total: ₱{line_total:,.2f}")
+            price_c = to_centavos(price)
+            line_c  = scale_centavos(price_c, float(units))
+            services_total_c += line_c
+            st.caption(f"Line total: ₱{from_centavos(line_c):,.2f}")
 
             per_line_inputs.append({
                 "service": svc,
                 "units": float(units),
-                "price_peso": float(price),
-                "amount_peso": float(line_total),
+                "price_peso": from_centavos(price_c),
+                "amount_peso": from_centavos(line_c),
                 "performed_by_employee_id": performer,
                 "notes": notes
             })
 
-    st.metric("Services total (₱)", f"{services_total:,.2f}")
-    st.metric("Change (₱)", f"{(amount_paid - services_total):,.2f}")
+    paid_c = to_centavos(amount_paid or 0.0)
+    st.metric("Services total (₱)", f"{from_centavos(services_total_c):,.2f}")
+    st.metric("Change (₱)", f"{from_centavos(paid_c - services_total_c):,.2f}")
 
     # Save
     if st.button(f"🧾 Save visit — {branch_id}", type="primary", disabled=(len(per_line_inputs) == 0), key=f"save_{branch_id}"):
@@ -770,7 +2732,7 @@ def log_visit_ui(branch_id: str):
                 "units": item["units"],
                 "price_peso": item["price_peso"],
                 "amount_peso": item["amount_peso"],
-                "amount_paid_peso": float(amount_paid or 0.0),
+                "amount_paid_peso": from_centavos(paid_c),
                 "payment_method": payment_method,
                 "performed_by_employee_id": item["performed_by_employee_id"],
                 "customer_name": customer_name,
@@ -783,104 +2745,162 @@ def log_visit_ui(branch_id: str):
 
 
 # ======= UI =======
-st.set_page_config(page_title="RJ AutoSpa Payroll", page_icon="🧽", layout="wide")
-st.title("🏎️ Bodi's 24/7 Car Wash Payroll")
-
-# Tabs
-# tab_run, tab_tx_b1, tab_tx_b2, tab_admin, tab_pay = st.tabs(["Clock In/Out", "Log Visit — Branch 1", "Log Visit — Branch 2", "Admin", "Payroll"])
-tab_run, tab_tx_b1, tab_tx_b2, tab_admin, tab_pay, tab_visits = st.tabs(
-    ["Clock In/Out", "Log Visit — Branch 1", "Log Visit — Branch 2", "Admin", "Payroll", "Visits/Transactions"]
-)
-with tab_visits:
-    render_daily_visits_view()
-
-
-with tab_admin:
-    st.subheader("🔧 Google Sheets connection")
-    st.write("Workbook:", SHEET_NAME)
-    if st.button("Refresh Catalog (Services, Classes, Policy, Employees, Models)"):
-        st.cache_data.clear()
+def main():
+    st.set_page_config(page_title="RJ AutoSpa Payroll", page_icon="🧽", layout="wide")
+    st.title("🏎️ Bodi's 24/7 Car Wash Payroll")
+
+    # Tabs
+    # tab_run, tab_tx_b1, tab_tx_b2, tab_admin, tab_pay = st.tabs(["Clock In/Out", "Log Visit — Branch 1", "Log Visit — Branch 2", "Admin", "Payroll"])
+    tab_run, tab_tx_b1, tab_tx_b2, tab_admin, tab_pay, tab_visits, tab_dash, tab_sim = st.tabs(
+        ["Clock In/Out", "Log Visit — Branch 1", "Log Visit — Branch 2", "Admin", "Payroll", "Visits/Transactions", "Dashboard", "Simulator"]
+    )
+    with tab_visits:
+        render_daily_visits_view()
+
+    with tab_dash:
+        render_dashboard_view()
+
+    with tab_sim:
+        render_simulator_view()
+
+
+    with tab_admin:
+        st.subheader("🔧 Google Sheets connection")
+        st.write("Workbook:", SHEET_NAME)
+        if BRANCH_WORKBOOKS:
+            st.write("Branch shards (attendance, transactions):",
+                     {b: branch_workbook(b) for b in BRANCHES})
+        if st.button("Refresh Catalog (Services, Classes, Policy, Employees, Models)"):
+            refresh_sheets()
+            services, classes, policy, emps, vmodels = load_catalog()
+            st.success("Refreshed.")
+
+        if st.button("Create empty tabs if missing"):
+            for t in [TAB_SERVICES, TAB_VEHICLE_CLASSES, TAB_VEHICLE_MODELS, TAB_EMPLOYEES, TAB_COMMISSION_POLICY, TAB_PAYROLL_EXPORTS]:
+                _ = load_sheet(SHEET_NAME, t)
+            for t in SHARDED_TABS:
+                _ = load_shards(t)
+            st.success("Tabs ensured / created if missing.")
+
+        if st.button("Migrate transactions to visits + visit lines"):
+            for wb in shard_workbooks():
+                n_visits, n_lines = migrate_transactions(wb)
+                st.write(f"{wb}: moved {n_visits:,} visit(s), {n_lines:,} line(s)")
+            refresh_sheets()
+            st.success("Legacy transactions migrated.")
+
+        with st.expander("Sheets API usage (this server process)"):
+            sched = get_scheduler()
+            st.write(f"Quota: {SHEETS_QUOTA_PER_MIN} calls/min")
+            st.json(sched.stats)
+
+        with st.expander("Profiler (sampled captures of reruns / payroll runs)"):
+            render_profiler_admin()
+
+        st.info("Tune commission behavior in **commission_policy**: "
+                "`commission_type` = 'pool_split' or 'direct'; `percent` as needed. Regex in `service_regex` lets you target services.")
+
+    with tab_run:
+        st.subheader("👤 Clock In / Clock Out")
         services, classes, policy, emps, vmodels = load_catalog()
-        st.success("Refreshed.")
-
-    if st.button("Create empty tabs if missing"):
-        for t in [TAB_SERVICES, TAB_VEHICLE_CLASSES, TAB_VEHICLE_MODELS, TAB_EMPLOYEES, TAB_COMMISSION_POLICY, TAB_ATTENDANCE, TAB_TRANSACTIONS, TAB_PAYROLL_EXPORTS]:
-            _ = load_sheet(SHEET_NAME, t)
-        st.success("Tabs ensured / created if missing.")
 
-    st.info("Tune commission behavior in **commission_policy**: "
-            "`commission_type` = 'pool_split' or 'direct'; `percent` as needed. Regex in `service_regex` lets you target services.")
-
-with tab_run:
-    st.subheader("👤 Clock In / Clock Out")
-    services, classes, policy, emps, vmodels = load_catalog()
+        # Branch selector for attendance
+        branch_choice = st.selectbox("Branch for this shift", ["B1", "B2"], index=0)
 
-    # Branch selector for attendance
-    branch_choice = st.selectbox("Branch for this shift", ["B1", "B2"], index=0)
+        def get_pin_for(eid):
+            row = emps.set_index("employee_id").loc[eid]
+            if "password_hint" in row and pd.notna(row["password_hint"]) and str(row["password_hint"]).strip() != "":
+                return str(row["password_hint"])
+            return str(row.get("pin_hint",""))
 
-    def get_pin_for(eid):
-        row = emps.set_index("employee_id").loc[eid]
-        if "password_hint" in row and pd.notna(row["password_hint"]) and str(row["password_hint"]).strip() != "":
-            return str(row["password_hint"])
-        return str(row.get("pin_hint",""))
-
-    employee = st.selectbox(
-        "Employee",
-        options=emps["employee_id"].tolist(),
-        format_func=lambda x: f"{x} — {emps.set_index('employee_id').loc[x, 'name']}"
-    )
-    pwd = st.text_input("Simple PIN", type="password")
-    col_in, col_out = st.columns(2)
-    with col_in:
-        if st.button("CLOCK IN"):
-            hint = get_pin_for(employee)
-            if pwd == hint:
-                record_attendance(employee, "CLOCK_IN", branch_choice)
-                st.cache_data.clear() 
-                st.success(f"{employee} clocked in at {branch_choice}.")
-                st.rerun()
+        employee = st.selectbox(
+            "Employee",
+            options=emps["employee_id"].tolist(),
+            format_func=lambda x: f"{x} — {emps.set_index('employee_id').loc[x, 'name']}"
+        )
+        pwd = st.text_input("Simple PIN", type="password")
+        col_in, col_out = st.columns(2)
+        with col_in:
+            if st.button("CLOCK IN"):
+                hint = get_pin_for(employee)
+                if pwd == hint:
+                    record_attendance(employee, "CLOCK_IN", branch_choice)
+                    refresh_sheets()
+                    st.success(f"{employee} clocked in at {branch_choice}.")
+                    st.rerun()
+                else:
+                    st.error("Wrong PIN.")
+        with col_out:
+            if st.button("CLOCK OUT"):
+                hint = get_pin_for(employee)
+                if pwd == hint:
+                    record_attendance(employee, "CLOCK_OUT", branch_choice)
+                    st.success(f"{employee} clocked out at {branch_choice}.")
+                else:
+                    st.error("Wrong PIN.")
+
+
+    with tab_tx_b1:
+        log_visit_ui("B1")
+
+    with tab_tx_b2:
+        log_visit_ui("B2")
+
+    with tab_pay:
+        st.subheader("🧮 Payroll (15-day periods)")
+        today = date.today()
+        s_guess, e_guess = current_pay_window(today)
+        colx, coly = st.columns(2)
+        with colx:
+            start_date = st.date_input("Start", value=s_guess)
+        with coly:
+            end_date   = st.date_input("End", value=e_guess)
+
+        streaming = st.toggle("Streaming mode (multi-year ranges, low memory)", key="payroll_streaming",
+                              help="Reads history one pay window at a time; the ledger is offered as a CSV download.")
+
+        if st.button("Compute Payroll"):
+            prev = st.session_state.pop("payroll_run", None)
+            if prev and isinstance(prev[3], str):  # the last streaming run's ledger file
+                discard_export_files([prev[3]])
+            if streaming:
+                sweep_export_files()
+                fd, ledger_path = tempfile.mkstemp(prefix="ledger_", suffix=".csv")
+                os.close(fd)
+                with st.spinner("Streaming transactions and attendance…"):
+                    payroll = stream_payroll(start_date, end_date, ledger_path=ledger_path)
+                st.session_state["payroll_run"] = (start_date, end_date, payroll, ledger_path)
             else:
-                st.error("Wrong PIN.")
-    with col_out:
-        if st.button("CLOCK OUT"):
-            hint = get_pin_for(employee)
-            if pwd == hint:
-                record_attendance(employee, "CLOCK_OUT", branch_choice)
-                st.success(f"{employee} clocked out at {branch_choice}.")
+                st.session_state["payroll_run"] = (start_date, end_date, *compute_commissions(start_date, end_date))
+
+        # keep the last run across reruns so export/append buttons still see it
+        run = st.session_state.get("payroll_run")
+        if run:
+            run_start, run_end, payroll, ledger = run
+            if payroll.empty:
+                st.warning("No data in this range.")
             else:
-                st.error("Wrong PIN.")
-
-
-with tab_tx_b1:
-    log_visit_ui("B1")
+                st.success(f"Computed payroll for {run_start} → {run_end}")
+                st.dataframe(payroll, use_container_width=True)
+                render_export("payroll", f"payroll_{run_start}_{run_end}", lambda: iter([payroll]))
+
+                if isinstance(ledger, str):  # streaming run: ledger lives in a CSV file (one per session)
+                    if os.path.exists(ledger):
+                        render_export(
+                            "ledger", f"ledger_{run_start}_{run_end}",
+                            lambda: pd.read_csv(ledger, dtype=str, keep_default_na=False, chunksize=EXPORT_CHUNK_ROWS),
+                            ["percent","base_amount","commission_peso"], label="commission ledger",
+                        )
+                else:
+                    with st.expander("See Commission Ledger (per employee & shift)"):
+                        st.dataframe(ledger, use_container_width=True)
 
-with tab_tx_b2:
-    log_visit_ui("B2")
+                if st.button("Append this run to 'payroll_exports' tab"):
+                    append_df(SHEET_NAME, TAB_PAYROLL_EXPORTS, payroll)  # other sessions' appends stay
+                    st.success("Appended to payroll_exports.")
 
-with tab_pay:
-    st.subheader("🧮 Payroll (15-day periods)")
-    today = date.today()
-    s_guess, e_guess = current_pay_window(today)
-    colx, coly = st.columns(2)
-    with colx:
-        start_date = st.date_input("Start", value=s_guess)
-    with coly:
-        end_date   = st.date_input("End", value=e_guess)
 
-    if st.button("Compute Payroll"):
-        payroll, ledger = compute_commissions(start_date, end_date)
-        if payroll.empty:
-            st.warning("No data in this range.")
-        else:
-            st.success(f"Computed payroll for {start_date} → {end_date}")
-            st.dataframe(payroll, use_container_width=True)
-            st.download_button("⬇️ Download Payroll CSV", data=payroll.to_csv(index=False), file_name=f"payroll_{start_date}_{end_date}.csv", mime="text/csv")
-
-            with st.expander("See Commission Ledger (per employee & shift)"):
-                st.dataframe(ledger, use_container_width=True)
-
-            if st.checkbox("Append this run to 'payroll_exports' tab"):
-                exports = load_sheet(SHEET_NAME, TAB_PAYROLL_EXPORTS)
-                new = pd.concat([exports, payroll], ignore_index=True) if not exports.empty else payroll.copy()
-                write_df(SHEET_NAME, TAB_PAYROLL_EXPORTS, new)
-                st.success("Appended to payroll_exports.")
+# `streamlit run app.py` executes this file as __main__; importing it (utils/ scripts) does not draw the UI
+if __name__ == "__main__":
+    with profile_rerun():
+        main()
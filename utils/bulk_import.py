@@ -0,0 +1,272 @@
+# utils/bulk_import.py
+#
+# Stream large historical CSVs into the workbook in batches, resumably.
+#
+#   python utils/bulk_import.py transactions history/tx_2019_2023.csv --branch B1
+#   python utils/bulk_import.py attendance   history/att_2019_2023.csv --branch B2
+#   python utils/bulk_import.py services     generated/services_rj_autospa.csv
+#
+# transactions/attendance are appended in size-limited batches; progress is kept in
+# <csv>.import_state.json so a re-run after an interruption continues where it stopped.
+# Transactions are stored normalized (visits + visit_lines tabs, each batch written whole);
+# a visit whose lines span batches or chunks gets one visits row, and a resume re-reads
+# the imported part of the CSV (without sending it) to know which visits are written.
+# That needs every visit_id imported so far in memory: about 170 bytes per visit, so
+# ~170 MB per million visits in one file. Lines of a visit may sit anywhere in the file,
+# so old entries are never dropped; split files far beyond that into several runs (a
+# visit must not span two files).
+# Rows that fail validation go to <csv>.rejects.csv. Catalog kinds replace their tab.
+# With branch shards configured, rows go to --branch's workbook; rows of branches stored
+# elsewhere are rejected, so split mixed files per shard (one run each).
+# Run from the project root so .streamlit/secrets.toml is found, and while the kiosks
+# are idle: resuming compares row counts, which their saves would throw off.
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import app  # noqa: E402  (constants, price book, Sheets access)
+
+CATALOG_TABS = {
+    "services":          app.TAB_SERVICES,
+    "vehicle_classes":   app.TAB_VEHICLE_CLASSES,
+    "vehicle_models":    app.TAB_VEHICLE_MODELS,
+    "commission_policy": app.TAB_COMMISSION_POLICY,
+    "employees":         app.TAB_EMPLOYEES,
+}
+APPEND_KINDS = {
+    "transactions": (app.TAB_VISIT_LINES, app.TX_COLS),  # rows counted on the lines tab
+    "attendance":   (app.TAB_ATTENDANCE, app.ATT_COLS),
+}
+MAX_CELLS_PER_REQUEST = 50_000
+
+
+# ---------- normalization ----------
+def _parse_timestamps(col):
+    ts = pd.to_datetime(col, errors="coerce")
+    iso = ts.map(lambda t: t.isoformat(timespec="seconds") if pd.notna(t) else "")
+    return ts, iso
+
+def _shift_ids(ts, current):
+    derived = ts.map(lambda t: app.get_shift_id(t.to_pydatetime()) if pd.notna(t) else "")
+    return current.where(current.astype(str).str.strip() != "", derived)
+
+def other_shard(branch_ids, branch):
+    """Rows whose branch lives in a different workbook than --branch (import those separately)."""
+    return branch_ids.map(app.branch_workbook) != app.branch_workbook(branch)
+
+def normalize_transactions(chunk, branch, price_book, vclass_by_model):
+    """Shape a chunk to TX_COLS; returns (good, rejects-with-reason)."""
+    df = app.ensure_tx_columns(chunk.copy()).copy()
+    ts, df["timestamp_iso"] = _parse_timestamps(df["timestamp_iso"])
+    df["shift_id"] = _shift_ids(ts, df["shift_id"])
+    df["branch_id"] = df["branch_id"].astype(str).str.strip().str.upper().replace("", branch)
+    df["plate"] = df["plate"].astype(str).str.strip().str.upper()
+    df["service"] = df["service"].astype(str).str.strip()
+
+    # class from the model list when only the model was recorded
+    missing_class = df["vehicle_class"].astype(str).str.strip() == ""
+    df.loc[missing_class, "vehicle_class"] = df.loc[missing_class, "vehicle_model"].map(vclass_by_model).fillna("")
+
+    # units default 1; prices from the price book when blank, amounts in centavos
+    units = pd.to_numeric(df["units"], errors="coerce").fillna(1).replace(0, 1)
+    df["units"] = units
+    book = pd.Series([price_book.get(k) for k in zip(df["service"], df["vehicle_class"])], index=df.index)
+    blank_price = pd.to_numeric(df["price_peso"], errors="coerce").isna()
+    price_c = app.to_centavos(df["price_peso"]).where(~blank_price, app.to_centavos(book))
+    df["price_peso"] = app.from_centavos(price_c).to_numpy()
+    blank_amount = pd.to_numeric(df["amount_peso"], errors="coerce").isna()
+    amount_c = app.to_centavos(df["amount_peso"]).where(~blank_amount, app.scale_centavos(price_c, units))
+    df["amount_peso"] = app.from_centavos(amount_c).to_numpy()
+
+    # one visit per (timestamp, plate, branch) when the source has no visit_id; deterministic so re-runs agree
+    df["visit_id"] = app.derive_visit_ids(df)
+
+    reason = pd.Series("", index=df.index)
+    reason[other_shard(df["branch_id"], branch)] = "branch is stored in another workbook"
+    reason[df["service"] == ""] = "missing service"
+    reason[(book.isna()) & blank_price] = "no price in price book"
+    reason[df["timestamp_iso"] == ""] = "bad timestamp"
+    bad = reason != ""
+    return df[~bad], chunk[bad].assign(reject_reason=reason[bad])
+
+def normalize_attendance(chunk, branch):
+    df = app.ensure_att_columns(chunk.copy()).copy()
+    ts, df["timestamp_iso"] = _parse_timestamps(df["timestamp_iso"])
+    df["shift_id"] = _shift_ids(ts, df["shift_id"])
+    df["branch_id"] = df["branch_id"].astype(str).str.strip().str.upper().replace("", branch)
+    df["employee_id"] = df["employee_id"].astype(str).str.strip()
+    df["action"] = df["action"].astype(str).str.strip().str.upper().str.replace(" ", "_")
+
+    reason = pd.Series("", index=df.index)
+    reason[other_shard(df["branch_id"], branch)] = "branch is stored in another workbook"
+    reason[~df["action"].isin(["CLOCK_IN", "CLOCK_OUT"])] = "unknown action"
+    reason[df["employee_id"] == ""] = "missing employee_id"
+    reason[df["timestamp_iso"] == ""] = "bad timestamp"
+    bad = reason != ""
+    return df[~bad], chunk[bad].assign(reject_reason=reason[bad])
+
+
+# ---------- resumable state ----------
+# rows_done:  source rows of fully imported chunks (the next chunk starts there)
+# good_sent:  valid rows of the current chunk already on the sheet
+# pending:    size of the batch in flight; sheet_rows is the row count before it
+def load_state(path, source, kind, chunk_rows):
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as fh:
+            state = json.load(fh)
+        if state.get("source") == os.path.abspath(source) and state.get("kind") == kind:
+            return state
+    return {"source": os.path.abspath(source), "kind": kind, "chunk_rows": chunk_rows,
+            "rows_done": 0, "good_sent": 0, "rejects_written": False,
+            "pending": 0, "sheet_rows": 0, "imported": 0, "rejected": 0}
+
+def save_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(state, fh, indent=2)
+    os.replace(tmp, path)  # atomic: never leaves a half-written state file
+
+
+# ---------- sheet side ----------
+def sheet_row_count(ws, sched):
+    """Rows in use (header included), from column A."""
+    return len(sched.call(ws.col_values, 1, priority=app.PRIORITY_BACKGROUND))
+
+def ensure_header(ws, sched, cols):
+    header = sched.call(ws.row_values, 1, priority=app.PRIORITY_BACKGROUND)
+    missing = [c for c in cols if c not in header]
+    if missing:
+        header = header + missing
+        sched.call(ws.update, [header], "A1", priority=app.PRIORITY_WRITE)
+    return header
+
+def to_values(df, header):
+    """Rows in sheet column order; columns the sheet has but we don't are left blank."""
+    return df.reindex(columns=header).astype(object).where(df.reindex(columns=header).notna(), "").values.tolist()
+
+
+def import_append(kind, path, branch, chunk_rows, batch_rows, dry_run):
+    tab, cols = APPEND_KINDS[kind]
+    state_path = path + ".import_state.json"
+    rejects_path = path + ".rejects.csv"
+    state = load_state(None if dry_run else state_path, path, kind, chunk_rows)
+    chunk_rows = state["chunk_rows"]  # chunk boundaries must match the interrupted run
+    sched = app.get_scheduler()
+
+    header, workbook = cols, app.branch_workbook(branch)
+    if not dry_run:
+        ws = app.get_worksheet(workbook, tab)
+        if kind == "transactions":
+            ensure_header(app.get_worksheet(workbook, app.TAB_VISITS), sched, app.VISIT_COLS)
+            header = ensure_header(ws, sched, app.LINE_COLS)
+        else:
+            header = ensure_header(ws, sched, cols)
+        actual = sheet_row_count(ws, sched)
+        if state["pending"] and actual >= state["sheet_rows"] + state["pending"]:
+            # the batch in flight when we stopped did land
+            state["good_sent"] += state["pending"]
+            state["imported"]  += state["pending"]
+        state["pending"], state["sheet_rows"] = 0, actual
+        save_state(state_path, state)
+    rows_per_call = max(1, min(batch_rows, MAX_CELLS_PER_REQUEST // len(cols)))
+
+    known = {}  # visits already on the sheet, so a visit spanning batches/chunks is written once
+
+    def send(part):
+        if kind == "transactions":
+            visits, lines = app.split_visit_rows(part, known)
+            app.append_frames(workbook, {app.TAB_VISITS: visits, app.TAB_VISIT_LINES: lines},
+                              priority=app.PRIORITY_BACKGROUND)
+        else:
+            sched.call(ws.append_rows, to_values(part, header), value_input_option="RAW",
+                       insert_data_option="INSERT_ROWS", priority=app.PRIORITY_BACKGROUND)
+
+    price_book, vclass_by_model = {}, {}
+    if kind == "transactions":
+        services = app.load_sheet(app.SHEET_NAME, app.TAB_SERVICES)
+        if not services.empty:
+            price_book = dict(zip(zip(services["service"], services["vehicle_class"]), services["price_peso"]))
+        vmodels = app.load_sheet(app.SHEET_NAME, app.TAB_VEHICLE_MODELS)
+        if not vmodels.empty:
+            vclass_by_model = app.VehicleModelIndex(vmodels).class_by_label  # ambiguous labels stay blank
+
+    if state["rows_done"] or state["good_sent"]:
+        print(f"Resuming {path} at source row {state['rows_done']:,} (+{state['good_sent']:,} sent from that chunk).")
+        if kind == "transactions" and state["rows_done"]:  # replay what was sent to rebuild `known`
+            for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunk_rows,
+                                     nrows=state["rows_done"]):
+                app.split_visit_rows(normalize_transactions(chunk, branch, price_book, vclass_by_model)[0][cols], known)
+    reader = pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunk_rows,
+                         skiprows=range(1, state["rows_done"] + 1))
+    for chunk in reader:
+        if kind == "transactions":
+            good, bad = normalize_transactions(chunk, branch, price_book, vclass_by_model)
+        else:
+            good, bad = normalize_attendance(chunk, branch)
+
+        if not state["rejects_written"]:
+            if not bad.empty:
+                bad.to_csv(rejects_path, mode="a", index=False, header=not os.path.exists(rejects_path))
+            state["rejected"] += len(bad)
+            state["rejects_written"] = True
+
+        if kind == "transactions" and state["good_sent"]:
+            app.split_visit_rows(good[cols].iloc[:state["good_sent"]], known)
+        todo = good[cols].iloc[state["good_sent"]:]
+        for start in range(0, 0 if dry_run else len(todo), rows_per_call):
+            batch = todo.iloc[start:start + rows_per_call]
+            state["pending"] = len(batch)
+            save_state(state_path, state)
+            send(batch)
+            state["sheet_rows"] += len(batch)
+            state["good_sent"]  += len(batch)
+            state["imported"]   += len(batch)
+            state["pending"] = 0
+            save_state(state_path, state)
+        if dry_run:
+            state["imported"] += len(todo)
+
+        state["rows_done"] += len(chunk)
+        state["good_sent"], state["rejects_written"] = 0, False
+        if not dry_run:
+            save_state(state_path, state)
+        print(f"  {state['rows_done']:,} rows read, {state['imported']:,} imported, {state['rejected']:,} rejected")
+
+    print(f"Done: {state['imported']:,} rows {'valid' if dry_run else 'imported into ' + repr(tab)}, "
+          f"{state['rejected']:,} rejected" + (f" (see {rejects_path})" if state["rejected"] else ""))
+    if not dry_run and os.path.exists(state_path):
+        os.remove(state_path)
+
+
+def import_catalog(kind, path, dry_run):
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    print(f"{kind}: {len(df):,} rows -> tab '{CATALOG_TABS[kind]}'" + (" [dry run]" if dry_run else ""))
+    if not dry_run:
+        app.write_df(app.SHEET_NAME, CATALOG_TABS[kind], df)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Bulk-import historical CSVs into the payroll workbook.")
+    ap.add_argument("kind", choices=sorted(APPEND_KINDS) + sorted(CATALOG_TABS))
+    ap.add_argument("csv")
+    ap.add_argument("--branch", default="B1", help="branch_id for rows that have none (default B1)")
+    ap.add_argument("--chunk-rows", type=int, default=20_000, help="CSV rows read per chunk")
+    ap.add_argument("--batch-rows", type=int, default=2_000, help="max rows per append request")
+    ap.add_argument("--dry-run", action="store_true", help="validate and count only; writes rejects file")
+    args = ap.parse_args(argv)
+
+    started = datetime.now()
+    if args.kind in APPEND_KINDS:
+        import_append(args.kind, args.csv, args.branch.upper(), args.chunk_rows, args.batch_rows, args.dry_run)
+    else:
+        import_catalog(args.kind, args.csv, args.dry_run)
+    print(f"Elapsed: {datetime.now() - started}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# utils/load_test.py
+#
+# Drive many simulated kiosk sessions through app.py against the local Sheets
+# stand-in (utils/sheets_standin.py) and report latency, API usage and lost writes.
+#
+#   python utils/load_test.py --sessions 1,2,4,8 --iterations 5 --latency-ms 150 --quota 300
+#
+# Each session is a streamlit AppTest running the real script in its own process (AppTest
+# swaps process-global state per run, so sessions can't share one); all of them hit the
+# same stand-in, served from this process. Per iteration a session clocks someone in,
+# logs a visit and (every few iterations) computes payroll. Caches and the request
+# scheduler are per process here, so API usage is an upper bound for one server.
+# "Lost writes" = saves the app reported as successful that are missing from the
+# stand-in afterwards (e.g. one session's whole-tab rewrite dropping another's row).
+import os
+import sys
+import time
+import random
+import argparse
+import multiprocessing as mp
+from datetime import date
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sheets_standin import StandInClient, RemoteClient, seed_catalog, serve  # noqa: E402
+
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app.py"))
+BOOK = "LOADTEST_Payroll"
+SERVICES = ["Carwash", "Bac to Zero", "Engine Wash", "Armour all", "Bac to Zero Promo"]
+
+
+class Session:
+    """One kiosk: an AppTest plus what it believes it has saved."""
+    def __init__(self, n, timeout, quota):
+        self.n = n
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.at.secrets["sheets"] = {"workbook_name": BOOK, "quota_per_minute": quota}
+        self.at.secrets["gcp_service_account"] = {}
+        self.latencies, self.errors = [], []
+        self.saved_visits, self.saved_clock_ins = [], 0
+        self.rng = random.Random(n)
+
+    def rerun(self, action=None):
+        t0 = time.perf_counter()
+        try:
+            (action or self.at.run)()
+        except Exception as e:  # timeouts etc. count as failed reruns
+            self.errors.append(repr(e))
+        self.latencies.append(time.perf_counter() - t0)
+        self.errors.extend(str(e.value) for e in self.at.exception)
+
+    def clock_in(self, emps):
+        eid, pin = self.rng.choice(emps)
+        emp = next(w for w in self.at.selectbox if w.label == "Employee")
+        emp.set_value(eid)
+        next(w for w in self.at.text_input if w.label == "Simple PIN").input(str(pin))
+        btn = next(w for w in self.at.button if w.label == "CLOCK IN")
+        self.rerun(btn.click().run)
+        if any("clocked in" in s.value for s in self.at.success):
+            self.saved_clock_ins += 1
+        self.rerun()  # the app calls st.rerun() after a clock-in
+
+    def log_visit(self, branch):
+        self.at.text_input(key=f"plate_{branch}").input(f"LT{self.n:02d}{self.rng.randint(0, 999):03d}")
+        self.rerun()
+        self.at.multiselect(key=f"svcsel_{branch}").set_value(self.rng.sample(SERVICES, self.rng.randint(1, 3)))
+        self.rerun()
+        self.rerun(self.at.button(key=f"save_{branch}").click().run)
+        for s in self.at.success:
+            if s.value.startswith("Saved visit "):
+                self.saved_visits.append(s.value.split(" ")[2])
+
+    def payroll(self):
+        today = date.today()
+        for d in self.at.date_input:
+            if d.label == "Start":
+                d.set_value(today.replace(day=1))
+        btn = next(w for w in self.at.button if w.label == "Compute Payroll")
+        self.rerun(btn.click().run)
+
+
+def _kiosk(n, iterations, timeout, quota, emps, address, authkey, barrier, results):
+    """Child process: one kiosk session against the shared stand-in."""
+    client = RemoteClient(address, authkey)
+    s, t0 = Session(n, timeout, quota), time.perf_counter()
+    try:
+        with mock.patch("gspread.authorize", return_value=client), \
+             mock.patch("google.oauth2.service_account.Credentials.from_service_account_info", return_value=None):
+            s.rerun()
+            barrier.wait()  # start the interactions together
+            t0 = time.perf_counter()
+            for i in range(iterations):
+                try:
+                    s.clock_in(emps)
+                    s.log_visit(s.rng.choice(["B1", "B2"]))
+                    if i % 3 == 2:
+                        s.payroll()
+                except Exception as e:  # a widget missing after a failed rerun
+                    s.errors.append(repr(e))
+    except Exception as e:
+        s.errors.append(repr(e))
+    finally:  # always report, or the parent would wait forever
+        results.put({"latencies": s.latencies, "errors": s.errors, "saved_visits": s.saved_visits,
+                     "saved_clock_ins": s.saved_clock_ins, "busy_s": time.perf_counter() - t0})
+
+
+def run_level(sessions, iterations, client_kwargs, timeout):
+    client = seed_catalog(StandInClient(**client_kwargs), BOOK)
+    emps = client.frame(BOOK, "employees")[["employee_id", "password_hint"]].values.tolist()
+    address, authkey = serve(client)
+    # the quota is per project: split it across the kiosks' schedulers
+    quota = max(1, (client_kwargs["quota_per_min"] or 100_000) // sessions)
+
+    ctx = mp.get_context("spawn")
+    barrier, results = ctx.Barrier(sessions), ctx.Queue()
+    procs = [ctx.Process(target=_kiosk,
+                         args=(i, iterations, timeout, quota, emps, address, authkey, barrier, results))
+             for i in range(sessions)]
+    for p in procs:
+        p.start()
+    pool = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    wall = max(r["busy_s"] for r in pool)
+
+    visits = client.frame(BOOK, "visits")
+    att = client.frame(BOOK, "attendance")
+    stored_visits = set(visits["visit_id"]) if not visits.empty else set()
+    saved = [v for r in pool for v in r["saved_visits"]]
+    lat = np.array([x for r in pool for x in r["latencies"]] or [np.nan]) * 1000
+    for e in sorted({e for r in pool for e in r["errors"]})[:5]:
+        print("  error:", e[:200])
+    return {
+        "sessions": sessions,
+        "reruns": len(lat),
+        "p50_ms": round(float(np.percentile(lat, 50)), 1),
+        "p99_ms": round(float(np.percentile(lat, 99)), 1),
+        "wall_s": round(wall, 1),
+        "api_calls": sum(client.calls.values()),
+        "api_429": client.errors[429],
+        "api_5xx": client.errors[500],
+        "visits_saved": len(saved),
+        "visits_lost": sum(1 for v in saved if v not in stored_visits),
+        "clock_ins_saved": sum(r["saved_clock_ins"] for r in pool),
+        "clock_ins_lost": max(0, sum(r["saved_clock_ins"] for r in pool)
+                              - (int((att["action"] == "CLOCK_IN").sum()) if not att.empty else 0)),
+        "app_errors": sum(len(r["errors"]) for r in pool),
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Concurrent-kiosk load test against a local Sheets stand-in.")
+    ap.add_argument("--sessions", default="1,2,4,8", help="comma-separated concurrency levels")
+    ap.add_argument("--iterations", type=int, default=5, help="clock-in + visit rounds per session")
+    ap.add_argument("--latency-ms", type=float, default=150.0)
+    ap.add_argument("--jitter-ms", type=float, default=100.0)
+    ap.add_argument("--quota", type=int, default=300, help="per-minute Sheets quota (0 = unlimited)")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="share of calls failing with HTTP 500")
+    ap.add_argument("--timeout", type=float, default=120.0, help="per-rerun timeout, seconds")
+    ap.add_argument("--out", help="also write the report as CSV")
+    args = ap.parse_args(argv)
+
+    client_kwargs = {"latency_s": args.latency_ms / 1000, "jitter_s": args.jitter_ms / 1000,
+                     "quota_per_min": args.quota or None, "fail_rate": args.fail_rate, "seed": 7}
+    rows = []
+    for n in [int(x) for x in args.sessions.split(",")]:
+        print(f"-- {n} session(s) ...", flush=True)
+        rows.append(run_level(n, args.iterations, client_kwargs, args.timeout))
+        print(rows[-1], flush=True)
+
+    report = pd.DataFrame(rows)
+    print()
+    print(report.to_string(index=False))
+    if args.out:
+        report.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# utils/payroll_diff.py
+#
+# Differential test of the payroll engines: a frozen reference build of app.py against
+# the working tree's engines, on randomized datasets served by the Sheets stand-in.
+#
+#   python utils/payroll_diff.py --cases 200 --seed 1                # working tree vs HEAD
+#   python utils/payroll_diff.py --reference 1a2b3c4 --engines batch # pin the reference
+#   python utils/payroll_diff.py --replay payroll_diff_failure       # re-run a saved case
+#
+# The reference is app.py at a git revision (or a saved copy of it) and is only ever
+# run with compute_commissions. Candidate engines (working tree): "batch" is
+# compute_commissions, "stream" is stream_payroll. Payroll and ledger are compared row
+# by row: text columns exactly, numbers within --tolerance pesos (default 0, to the
+# centavo). A mismatch (or an exception) is shrunk by dropping rows while it still
+# reproduces, then printed and saved to --out for --replay.
+# Datasets cover legacy blank branch_id rows, missing/unknown performers, pools nobody
+# was present for (UNASSIGNED), B2 shifts, branch-specific and broken policy rules,
+# forgotten clock-outs and both transaction layouts (--layout; "legacy" for references
+# older than the visits tabs).
+import os
+import sys
+import json
+import types
+import random
+import argparse
+import tempfile
+import subprocess
+import warnings
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit.config
+import streamlit.logger
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sheets_standin import StandInClient, GENERATED  # noqa: E402
+
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app.py"))
+BOOK = "PAYROLL_DIFF"
+SECRETS = {"sheets": {"workbook_name": BOOK, "quota_per_minute": 10**7}, "gcp_service_account": {}}
+DATA_TABS = ["transactions", "visits", "visit_lines", "attendance", "commission_policy", "employees", "services"]
+SHRINK_RUNS = 400  # engine runs spent on shrinking one failure
+FIRST_DAY = date(2024, 5, 1)
+
+
+# ---------- engines ----------
+def load_build(source, name):
+    """app.py source as a module of its own (own caches, scheduler and client)."""
+    mod = types.ModuleType(name)
+    mod.__file__ = APP_PATH
+    with mock.patch.object(st.secrets, "_secrets", SECRETS):
+        exec(compile(source, f"{name}:app.py", "exec"), mod.__dict__)
+    return mod
+
+def reference_source(ref):
+    """app.py at a git revision, or the file at ref if that is a path."""
+    if os.path.isfile(ref):
+        with open(ref, encoding="utf-8") as fh:
+            return fh.read()
+    return subprocess.run(["git", "show", f"{ref}:app.py"], cwd=os.path.dirname(APP_PATH),
+                          check=True, capture_output=True, text=True).stdout
+
+def run_batch(mod, case):
+    return mod.compute_commissions(case["start"], case["end"], case["branch"])
+
+def run_stream(mod, case):
+    fd, path = tempfile.mkstemp(prefix="payroll_diff_", suffix=".csv")
+    os.close(fd)
+    os.remove(path)  # stream_payroll appends; start from nothing
+    try:
+        payroll = mod.stream_payroll(case["start"], case["end"], case["branch"],
+                                     ledger_path=path, chunk_rows=case["chunk_rows"])
+        ledger = pd.read_csv(path, dtype=str, keep_default_na=False) if os.path.exists(path) else pd.DataFrame()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return payroll, ledger
+
+ENGINES = {"batch": run_batch, "stream": run_stream}
+
+
+def run_engine(mod, fn, tables, case):
+    """Serve the dataset from a fresh stand-in and run one engine; exceptions are results too."""
+    client = StandInClient()
+    for tab, df in tables.items():
+        client.put_frame(BOOK, tab, df)
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    with mock.patch.object(st.secrets, "_secrets", SECRETS), \
+         mock.patch("gspread.authorize", return_value=client), \
+         mock.patch("google.oauth2.service_account.Credentials.from_service_account_info", return_value=None):
+        try:
+            return fn(mod, case)
+        except Exception as e:
+            return e
+
+
+# ---------- comparison ----------
+def _blank(v):
+    return v is None or (isinstance(v, float) and np.isnan(v)) or v is pd.NA or str(v) == ""
+
+def _as_numbers(col):
+    return pd.to_numeric(col.map(lambda v: np.nan if _blank(v) else v), errors="coerce")
+
+def compare(ref, cand, tolerance=0.0):
+    """
+    Differences between two frames (list of strings, empty when equal). commission_c is
+    internal (the stream ledger has no such column) and is ignored.
+    """
+    frames = [df.drop(columns=[c for c in ["commission_c"] if c in df.columns]) if df is not None else pd.DataFrame()
+              for df in (ref, cand)]
+    if all(df.empty for df in frames):
+        return []
+    ref, cand = frames
+    if set(ref.columns) != set(cand.columns) and not (ref.empty or cand.empty):
+        return [f"columns differ: reference only {sorted(set(ref.columns) - set(cand.columns))}, "
+                f"candidate only {sorted(set(cand.columns) - set(ref.columns))}"]
+    cols = sorted(set(ref.columns) | set(cand.columns))
+    ref, cand = ref.reindex(columns=cols), cand.reindex(columns=cols)
+
+    numeric = []
+    for c in cols:
+        both = pd.concat([ref[c], cand[c]], ignore_index=True)
+        filled = both.map(lambda v: not _blank(v))
+        if filled.any() and _as_numbers(both)[filled].notna().all():
+            numeric.append(c)
+    text = [c for c in cols if c not in numeric]
+
+    def canonical(df):
+        out = pd.DataFrame({c: df[c].map(lambda v: "" if _blank(v) else str(v)) for c in text}, index=df.index)
+        for c in numeric:
+            out[c] = _as_numbers(df[c]).round(6)
+        return out.sort_values(text + numeric, na_position="first", kind="mergesort").reset_index(drop=True)
+
+    ref, cand = canonical(ref), canonical(cand)
+    if len(ref) != len(cand) or not ref[text].equals(cand[text]):
+        keyed = ref.merge(cand, how="outer", on=text, indicator=True, suffixes=("", "_cand"))
+        only = keyed[keyed["_merge"] != "both"]
+        lines = [f"rows: reference {len(ref)}, candidate {len(cand)}"]
+        for side, label in [("left_only", "reference only"), ("right_only", "candidate only")]:
+            for row in only[only["_merge"] == side][text].head(5).itertuples(index=False):
+                lines.append(f"  {label}: {dict(zip(text, row))}")
+        return lines
+    diffs = []
+    for c in numeric:
+        a, b = ref[c].fillna(0.0), cand[c].fillna(0.0)
+        bad = ((a - b).abs() > tolerance + 1e-9) | (ref[c].isna() != cand[c].isna())
+        for i in np.flatnonzero(bad.to_numpy())[:5]:
+            key = {k: ref.at[i, k] for k in text}
+            diffs.append(f"{c}: reference {ref.at[i, c]} != candidate {cand.at[i, c]} at {key}")
+    return diffs
+
+def check(ref_mod, cand_mod, engine, tables, case, tolerance):
+    """Differences between the reference and one candidate engine on one case."""
+    expected = run_engine(ref_mod, run_batch, tables, case)
+    actual = run_engine(cand_mod, ENGINES[engine], tables, case)
+    if isinstance(expected, Exception) or isinstance(actual, Exception):
+        if type(expected) is type(actual):
+            return []  # both engines reject this dataset the same way
+        return [f"reference: {expected!r}" if isinstance(expected, Exception) else "reference: ok",
+                f"candidate: {actual!r}" if isinstance(actual, Exception) else "candidate: ok"]
+    problems = []
+    for label, a, b in [("payroll", expected[0], actual[0]), ("ledger", expected[1], actual[1])]:
+        problems += [f"{label} {p}" for p in compare(a, b, tolerance)]
+    return problems
+
+
+# ---------- datasets ----------
+def random_dataset(rng, mod, visits=40, days=10, layout="mixed"):
+    """One randomized workbook: {tab: DataFrame}, blanks as ""."""
+    services = pd.read_csv(os.path.join(GENERATED, "services_rj_autospa.csv"), keep_default_na=False)
+    services = services.sample(frac=rng.uniform(0.3, 1.0), random_state=rng.randint(0, 10**6))
+    if rng.random() < 0.3:  # a repeated (service, class): the last row wins
+        dup = services.sample(1, random_state=rng.randint(0, 10**6)).assign(price_peso=rng.choice([99, 1234.5]))
+        services = pd.concat([services, dup], ignore_index=True)
+    service_names = sorted(services["service"].unique()) + ["Mystery service"]
+    classes = sorted(services["vehicle_class"].unique()) + ["Class 9"]
+
+    emp_ids = [f"E{i:03d}" for i in range(1, rng.randint(2, 6) + 1)]
+    employees = pd.DataFrame([{
+        "employee_id": eid, "name": f"Employee {eid}", "role": rng.choice(["Detailer", "TeamLead", "Washer"]),
+        "base_daily_salary": rng.choice([400, 500, 600, 550.5, ""]), "base_daily_override": "",
+        "password_hint": 1000 + i, "commission_multiplier_pool": "", "commission_multiplier_direct": "",
+    } for i, eid in enumerate(emp_ids)])
+
+    policy = pd.read_csv(os.path.join(GENERATED, "commission_policy_editable.csv"), keep_default_na=False)
+    policy["branch_id"] = ""
+    extra = pd.DataFrame([{
+        "rule_id": f"rule_{k}", "notes": "",
+        "service_regex": rng.choice(["^Carwash$", "Promo$", "Wax", "^Bac", "Engine", ".*", "(unclosed"]),
+        "commission_type": rng.choice(["pool_split", "direct", "direct", "none"]),
+        "percent": rng.choice([0, 10, 25, 30, 33.3, ""]),
+        "branch_id": rng.choice(["", "B1", "B2", "b2"]),
+    } for k in range(rng.randint(0, 5))])
+    policy = pd.concat([policy, extra], ignore_index=True)
+    policy = policy.sample(frac=1.0, random_state=rng.randint(0, 10**6)) if rng.random() < 0.5 else policy
+
+    def moment(day):
+        return datetime.combine(FIRST_DAY + timedelta(days=day), datetime.min.time()) + \
+            timedelta(minutes=rng.randint(0, 24 * 60 - 1))
+
+    att = []
+    for day in range(days):
+        for eid in emp_ids:
+            if rng.random() > 0.7:
+                continue
+            branch = rng.choice(["B1", "B1", "B2", "B2", ""])  # "" = legacy row without a branch
+            t_in = moment(day)
+            shift = mod.get_shift_id(t_in) if rng.random() < 0.9 else ""
+            if rng.random() < 0.95:
+                att.append([t_in.isoformat(timespec="seconds"), shift, branch, eid, "CLOCK_IN"])
+            if rng.random() < 0.8:  # otherwise the clock-out was forgotten
+                t_out = t_in + timedelta(minutes=rng.randint(30, 14 * 60))
+                att.append([t_out.isoformat(timespec="seconds"), shift, branch, eid, "CLOCK_OUT"])
+    if att and rng.random() < 0.2:
+        att.append(["not a time", "", "B1", emp_ids[0], "CLOCK_IN"])
+    rng.shuffle(att)
+    attendance = pd.DataFrame(att, columns=mod.ATT_COLS)
+
+    rows = []
+    for n in range(visits):
+        t = moment(rng.randint(0, days - 1))
+        visit = {
+            "timestamp_iso": t.isoformat(timespec="seconds"),
+            "shift_id": mod.get_shift_id(t) if rng.random() < 0.95 else "",
+            "visit_id": f"V{n:04d}", "branch_id": rng.choice(["B1", "B2", "B2", ""]),
+            "plate": f"ABC{rng.randint(0, 30):03d}", "vehicle_model": "",
+            "vehicle_class": rng.choice(classes), "amount_paid_peso": rng.choice([0, 500, ""]),
+            "payment_method": rng.choice(["cash", "gcash", ""]), "customer_name": "", "customer_phone": "",
+        }
+        for svc in rng.sample(service_names, rng.randint(1, 4)):
+            rows.append({**visit, "service": svc, "units": rng.choice([1, 1, 2, "", 0, 1.5]),
+                         "price_peso": rng.choice([180, 250.5, ""]), "amount_peso": "",
+                         "performed_by_employee_id": rng.choice(emp_ids + ["", "E999"]), "notes": ""})
+    tx = pd.DataFrame(rows, columns=mod.TX_COLS)
+    legacy = pd.Series([layout == "legacy" or (layout == "mixed" and rng.random() < 0.5)] * len(tx))
+    if layout == "mixed":  # per visit, not per line
+        legacy = tx["visit_id"].map({v: rng.random() < 0.5 for v in tx["visit_id"].unique()})
+    tables = {"transactions": tx[legacy.to_numpy()].reset_index(drop=True)}
+    if not legacy.all():
+        visits_df, lines = mod.split_visit_rows(tx[~legacy.to_numpy()])
+        tables.update(visits=visits_df.reset_index(drop=True), visit_lines=lines.reset_index(drop=True))
+    tables.update(attendance=attendance, commission_policy=policy.reset_index(drop=True),
+                  employees=employees, services=services.reset_index(drop=True),
+                  vehicle_classes=pd.DataFrame({"vehicle_class": classes[:-1]}),
+                  vehicle_models=pd.DataFrame(mod.VEHICLE_MODELS_SEED, columns=["brand", "model", "label", "vehicle_class"]))
+    return tables
+
+def random_case(rng, engine, days=10):
+    start = FIRST_DAY + timedelta(days=rng.randint(0, days - 1))
+    return {"engine": engine, "start": start, "end": start + timedelta(days=rng.randint(0, days)),
+            "branch": rng.choice([None, "B1", "B2"]), "chunk_rows": rng.choice([3, 7, 50, 5000])}
+
+
+# ---------- shrinking ----------
+def shrink(tables, still_fails, budget=SHRINK_RUNS):
+    """
+    Drop rows (halves, then quarters, ... single rows) from the data tabs while
+    still_fails(tables) holds; returns the smallest tables found within the budget.
+    """
+    tables = {tab: df.reset_index(drop=True) for tab, df in tables.items()}
+    runs, progress = 0, True
+    while progress and runs < budget:
+        progress = False
+        for tab in DATA_TABS:
+            size = len(tables.get(tab, ())) // 2
+            while size >= 1 and runs < budget:
+                i = 0
+                while i < len(tables[tab]) and runs < budget:
+                    trial = tables[tab].drop(index=range(i, min(i + size, len(tables[tab])))).reset_index(drop=True)
+                    runs += 1
+                    if still_fails({**tables, tab: trial}):
+                        tables[tab], progress = trial, True
+                    else:
+                        i += size
+                size //= 2
+    return tables
+
+def save_failure(out_dir, tables, case, problems):
+    os.makedirs(out_dir, exist_ok=True)
+    for tab in DATA_TABS:
+        if tab in tables:
+            tables[tab].to_csv(os.path.join(out_dir, f"{tab}.csv"), index=False)
+    with open(os.path.join(out_dir, "case.json"), "w", encoding="utf-8") as fh:
+        json.dump({**case, "start": case["start"].isoformat(), "end": case["end"].isoformat(),
+                   "problems": problems}, fh, indent=2)
+
+def load_failure(out_dir, mod):
+    with open(os.path.join(out_dir, "case.json"), encoding="utf-8") as fh:
+        case = json.load(fh)
+    case["start"], case["end"] = date.fromisoformat(case["start"]), date.fromisoformat(case["end"])
+    tables = {"vehicle_models": pd.DataFrame(mod.VEHICLE_MODELS_SEED, columns=["brand", "model", "label", "vehicle_class"])}
+    for tab in DATA_TABS:
+        path = os.path.join(out_dir, f"{tab}.csv")
+        if os.path.exists(path):
+            df = pd.read_csv(path, dtype=str, keep_default_na=False)
+            for c in df.columns:  # numeric cells come back from Sheets as numbers
+                num = pd.to_numeric(df[c], errors="coerce")
+                df[c] = df[c].where(num.isna() | (df[c] == ""), num)
+            tables[tab] = df
+    return tables, case
+
+def report(tables, case, problems):
+    print(f"\nMISMATCH engine={case['engine']} {case['start']}..{case['end']} branch={case['branch'] or 'ALL'} "
+          f"chunk_rows={case['chunk_rows']}")
+    for p in problems[:20]:
+        print("  " + p)
+    for tab in DATA_TABS:
+        if tab in tables and not tables[tab].empty:
+            print(f"\n[{tab}] {len(tables[tab])} row(s)")
+            print(tables[tab].to_csv(index=False).rstrip())
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Differential test: payroll engines vs a frozen reference build.")
+    ap.add_argument("--reference", default="HEAD", help="git revision (or path) of the reference app.py")
+    ap.add_argument("--engines", default="batch,stream", help=f"candidate engines: {', '.join(ENGINES)}")
+    ap.add_argument("--cases", type=int, default=100)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--visits", type=int, default=40, help="visits per generated dataset")
+    ap.add_argument("--days", type=int, default=10, help="days covered by a generated dataset")
+    ap.add_argument("--layout", choices=["mixed", "legacy", "visits"], default="mixed",
+                    help="where generated transactions are stored")
+    ap.add_argument("--tolerance", type=float, default=0.0, help="allowed difference of numbers (pesos)")
+    ap.add_argument("--out", default="payroll_diff_failure", help="where a shrunk failure is saved")
+    ap.add_argument("--replay", help="re-run a failure saved by --out instead of generating cases")
+    args = ap.parse_args(argv)
+    warnings.simplefilter("ignore")  # pandas deprecation noise from both builds
+    streamlit.config.set_option("logger.level", "error")  # "No runtime found" on every cached call
+    streamlit.logger.set_log_level("error")
+
+    ref_mod = load_build(reference_source(args.reference), "payroll_reference")
+    with open(APP_PATH, encoding="utf-8") as fh:
+        cand_mod = load_build(fh.read(), "payroll_candidate")
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+
+    if args.replay:
+        tables, case = load_failure(args.replay, cand_mod)
+        problems = check(ref_mod, cand_mod, case["engine"], tables, case, args.tolerance)
+        if problems:
+            report(tables, case, problems)
+            return 1
+        print("replay: engines agree")
+        return 0
+
+    rng = random.Random(args.seed)
+    for n in range(args.cases):
+        tables = random_dataset(rng, cand_mod, args.visits, args.days, args.layout)
+        for engine in engines:
+            case = random_case(rng, engine, args.days)
+            problems = check(ref_mod, cand_mod, engine, tables, case, args.tolerance)
+            if not problems:
+                continue
+            kind = problems[0].split(":")[0]
+            print(f"case {n + 1}: {engine} differs ({len(problems)} problem(s)); shrinking ...", flush=True)
+            tables = shrink(tables, lambda t: any(p.split(":")[0] == kind
+                                                 for p in check(ref_mod, cand_mod, engine, t, case, args.tolerance)))
+            problems = check(ref_mod, cand_mod, engine, tables, case, args.tolerance)
+            report(tables, case, problems)
+            save_failure(args.out, tables, case, problems)
+            print(f"\nsaved to {args.out}/ (python utils/payroll_diff.py --replay {args.out})")
+            return 1
+        print(f"case {n + 1}/{args.cases} ok", flush=True)
+    print(f"{args.cases} case(s): all engines agree with the reference ({args.reference})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
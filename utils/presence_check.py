@@ -0,0 +1,71 @@
+# utils/presence_check.py
+#
+# Regression check for attendance -> presence intervals (build_presence_intervals and
+# the streaming PresenceStream in app.py): hours worked and who counts as present.
+#
+#   python utils/presence_check.py
+#
+# Needs no workbook or secrets; exits 1 if any expectation fails.
+import os
+import sys
+from unittest import mock
+
+import pandas as pd
+import streamlit as st
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+with mock.patch.object(st.secrets, "_secrets", {"sheets": {"workbook_name": "-"}, "gcp_service_account": {}}):
+    import app  # noqa: E402
+
+DAY = "2024-05-06"
+# name -> (events as (time, action), expected hours, {time: expected present?})
+CASES = {
+    "in/out": ([("08:00", "CLOCK_IN"), ("12:00", "CLOCK_OUT")], 4.0, {"07:00": False, "09:00": True}),
+    "double tap out": ([("08:00", "CLOCK_IN"), ("12:00", "CLOCK_OUT"), ("12:01", "CLOCK_OUT")], 4.0,
+                       {"07:00": False, "09:00": True, "12:00": False}),
+    "out again later": ([("08:00", "CLOCK_IN"), ("12:00", "CLOCK_OUT"), ("16:00", "CLOCK_OUT")], 4.0,
+                        {"07:00": False, "13:00": False}),
+    "out only": ([("12:00", "CLOCK_OUT")], 6.0, {"07:00": True}),  # counts from the block start
+    "out, then out next block": ([("08:00", "CLOCK_IN"), ("12:00", "CLOCK_OUT"), ("20:00", "CLOCK_OUT")], 6.0,
+                                 {"13:00": False, "19:00": True}),
+}
+
+
+def attendance(events):
+    return pd.DataFrame([{"timestamp_iso": f"{DAY}T{t}:00", "shift_id": "", "branch_id": "B1",
+                          "employee_id": "E001", "action": a} for t, a in events])
+
+
+def streamed(att):
+    """Same intervals through PresenceStream, fed one event at a time."""
+    att = att.assign(timestamp=pd.to_datetime(att["timestamp_iso"]))
+    ps, parts = app.PresenceStream(), []
+    for i in range(len(att)):
+        parts.append(ps.feed(att.iloc[i:i + 1], att["timestamp"].iloc[i] + pd.Timedelta(seconds=1),
+                             pd.Timestamp("2030-01-01")))
+    parts.append(ps.close(pd.Timestamp("2030-01-01")))
+    return pd.concat(parts, ignore_index=True)
+
+
+def main(argv=None):
+    failures = []
+    start, end = pd.Timestamp(DAY), pd.Timestamp(DAY) + pd.Timedelta(days=2)
+    for name, (events, hours, present) in CASES.items():
+        att = attendance(events)
+        for label, iv in [("batch", app.build_presence_intervals(att)), ("stream", streamed(att))]:
+            idx = app.PresenceIndex(iv)
+            got = round(float(idx.hours_worked(start, end).get("E001", 0.0)), 4)
+            if got != hours:
+                failures.append(f"{name} ({label}): {got} hours, expected {hours}")
+            for t, want in present.items():
+                if ("E001" in idx.present_at("B1", pd.Timestamp(f"{DAY}T{t}:00"))) != want:
+                    failures.append(f"{name} ({label}): present at {t} should be {want}")
+
+    for f in failures:
+        print("FAIL", f)
+    print(f"{len(CASES)} attendance cases: " + ("ok" if not failures else f"{len(failures)} failure(s)"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# utils/revenue_cube_check.py
+#
+# Regression check for the revenue cube (RevenueCube in app.py): folding a visit's lines
+# in over several add_rows calls, or recording them and reading them back from the sheet,
+# must give the same rollups as folding every line in at once.
+#
+#   python utils/revenue_cube_check.py
+#
+# Needs no workbook or secrets; exits 1 if any expectation fails.
+import os
+import sys
+from unittest import mock
+
+import streamlit as st
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+with mock.patch.object(st.secrets, "_secrets", {"sheets": {"workbook_name": "-"}, "gcp_service_account": {}}):
+    import app  # noqa: E402
+
+GROUPINGS = [[], ["service"], ["branch_id", "payment_method"], ["date", "service"]]
+
+
+def line(visit_id, service, amount, paid, ts="2024-05-06T09:00:00", branch="B1", method="Cash"):
+    return {"timestamp_iso": ts, "shift_id": ts[:10] + "_Day", "visit_id": visit_id, "branch_id": branch,
+            "plate": visit_id, "vehicle_class": "Class 1", "service": service, "units": 1, "price_peso": amount,
+            "amount_peso": amount, "amount_paid_peso": paid, "payment_method": method}
+
+
+# V1 has two Wash lines and a Wax line, V2 one line, V3 is on another day, branch and method
+ROWS = [
+    line("V1", "Wash", 200, 750), line("V1", "Wax", 350, 750), line("V2", "Wash", 200, 200),
+    line("V1", "Wash", 200, 750), line("V3", "Wax", 350.5, 400, ts="2024-05-07T19:30:00", branch="B2", method="GCash"),
+]
+
+
+def rollups(cube):
+    return [cube.query(g).fillna(0).to_dict("records") for g in GROUPINGS]
+
+
+def folded(*calls):
+    """Cube after add_rows over each (rows, recorded) call in turn."""
+    cube = app.RevenueCube()
+    for rows, recorded in calls:
+        cube.add_rows(rows, recorded=recorded)
+    return cube
+
+
+def main(argv=None):
+    want = rollups(folded((ROWS, False)))
+    cases = {f"split after line {i}": folded((ROWS[:i], False), (ROWS[i:], False)) for i in range(1, len(ROWS))}
+    cases["one line per call"] = folded(*[([r], False) for r in ROWS])
+    cases["recorded, then read back"] = folded((ROWS[:3], True), (ROWS, False))
+    cases["read back, late lines recorded"] = folded((ROWS[:3], True), (ROWS[:3], False), (ROWS[3:], True), (ROWS[3:], False))
+
+    failures = [name for name, cube in cases.items() if rollups(cube) != want]
+    total = want[0][0]
+    if (total["visits"], total["lines"], total["amount_peso"], total["amount_paid_peso"]) != (3, 5, 1300.5, 1350.0):
+        failures.append(f"single fold totals {total}")
+
+    for f in failures:
+        print("FAIL", f)
+    print(f"{len(cases)} fold orders, {len(GROUPINGS)} groupings: "
+          + ("ok" if not failures else f"{len(failures)} failure(s)"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,452 @@
+# utils/sheets_standin.py
+#
+# In-memory (optionally file-backed) stand-in for the slice of gspread that app.py uses:
+# Client.open -> Spreadsheet.worksheet/add_worksheet -> Worksheet.get_all_records,
+# get, row_values, col_values, clear, update, append_rows, batch_update,
+# insert_rows, delete_rows, and Spreadsheet.batch_update (updateCells, appendCells,
+# deleteDimension, insertDimension; applied atomically, like the real endpoint).
+#
+# Knobs for load/failure testing:
+#   latency_s, jitter_s   per-call sleep (uniform jitter)
+#   quota_per_min         sliding 60 s window; over it -> APIError 429
+#   fail_rate             random APIError 500 on any call
+#   path                  JSON file to load from / save to (None = memory only)
+#
+#   client = StandInClient(latency_s=0.15, quota_per_min=60)
+#   seed_catalog(client, "RJ_AutoSpa_Payroll")   # tabs from generated/*.csv
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter, deque
+from multiprocessing.managers import BaseManager
+
+import gspread
+import pandas as pd
+import requests
+from gspread.utils import a1_to_rowcol
+
+GENERATED = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "generated"))
+SEED_TABS = {
+    "services":          "services_rj_autospa.csv",
+    "vehicle_classes":   "vehicle_classes.csv",
+    "commission_policy": "commission_policy_editable.csv",
+    "employees":         "employees_overrides_template.csv",
+}
+
+
+def api_error(code, message, status):
+    """A real gspread.exceptions.APIError, as raised for an HTTP error response."""
+    resp = requests.Response()
+    resp.status_code = code
+    resp._content = json.dumps({"error": {"code": code, "message": message, "status": status}}).encode()
+    return gspread.exceptions.APIError(resp)
+
+
+def _json_cell(v):
+    # the real client JSON-encodes the payload; NaN/inf are rejected there too
+    if isinstance(v, float) and (v != v or v in (float("inf"), float("-inf"))):
+        raise ValueError("Out of range float values are not JSON compliant")
+    return v
+
+
+def _range_bounds(rng):
+    """'A2:Q10' / 'A1' / '2:5' -> (row0, col0, row1, col1), 1-based, None = open."""
+    rng = rng.split("!")[-1]
+    parts = rng.split(":")
+    def corner(p):
+        m = re.fullmatch(r"([A-Z]*)(\d*)", p.upper())
+        col = a1_to_rowcol(m.group(1) + "1")[1] if m.group(1) else None
+        row = int(m.group(2)) if m.group(2) else None
+        return row, col
+    r0, c0 = corner(parts[0])
+    r1, c1 = corner(parts[1]) if len(parts) > 1 else (r0, c0)
+    return r0 or 1, c0 or 1, r1, c1
+
+
+def _cell_value(cell):
+    """CellData -> stored value ('' when it has no userEnteredValue)."""
+    value = cell.get("userEnteredValue")
+    return _json_cell(next(iter(value.values()))) if value else ""
+
+
+class StandInWorksheet:
+    def __init__(self, client, title, values=None):
+        self._client = client
+        self.title = title
+        self.id = client._next_id()
+        self._values = [list(r) for r in (values or [])]
+
+    # ---- reads ----
+    def get_all_records(self, **kwargs):
+        self._client._api("get_all_records")
+        with self._client._lock:
+            if not self._values:
+                return []
+            header = self._values[0]
+            return [dict(zip(header, r + [""] * (len(header) - len(r)))) for r in self._values[1:]]
+
+    def get_all_values(self, **kwargs):
+        self._client._api("get_all_values")
+        with self._client._lock:
+            return [list(r) for r in self._values]
+
+    def get(self, range_name=None, **kwargs):
+        self._client._api("get")
+        r0, c0, r1, c1 = _range_bounds(range_name or "A1:ZZZ")
+        with self._client._lock:
+            rows = self._values[r0 - 1:r1]
+            out = [list(r[c0 - 1:c1]) for r in rows]
+        while out and not any(str(v) != "" for v in out[-1]):
+            out.pop()
+        return out
+
+    def row_values(self, row, **kwargs):
+        self._client._api("row_values")
+        with self._client._lock:
+            return list(self._values[row - 1]) if row <= len(self._values) else []
+
+    def col_values(self, col, **kwargs):
+        self._client._api("col_values")
+        with self._client._lock:
+            vals = [r[col - 1] if len(r) >= col else "" for r in self._values]
+        while vals and vals[-1] == "":
+            vals.pop()
+        return vals
+
+    # ---- writes ----
+    def clear(self):
+        self._client._api("clear")
+        with self._client._lock:
+            self._values = []
+        self._client._persist()
+
+    def update(self, values=None, range_name=None, **kwargs):
+        # accept both update(values, range) and the older update(range, values)
+        if isinstance(values, str):
+            values, range_name = range_name, values
+        self._client._api("update")
+        self._write_block(range_name or "A1", values)
+        self._client._persist()
+        return {"updatedRows": len(values)}
+
+    def batch_update(self, data, **kwargs):
+        self._client._api("batch_update")
+        for item in data:
+            self._write_block(item["range"], item["values"])
+        self._client._persist()
+        return {"totalUpdatedRanges": len(data)}
+
+    def append_rows(self, values, **kwargs):
+        self._client._api("append_rows")
+        with self._client._lock:
+            self._values.extend([[_json_cell(v) for v in r] for r in values])
+        self._client._persist()
+        return {"updates": {"updatedRows": len(values)}}
+
+    def insert_rows(self, values, row=1, **kwargs):
+        self._client._api("insert_rows")
+        with self._client._lock:
+            self._values[row - 1:row - 1] = [[_json_cell(v) for v in r] for r in values]
+        self._client._persist()
+
+    def delete_rows(self, start_index, end_index=None):
+        self._client._api("delete_rows")
+        with self._client._lock:
+            del self._values[start_index - 1:(end_index or start_index)]
+        self._client._persist()
+
+    # ---- spreadsheet batchUpdate requests (caller holds the lock) ----
+    def _updateCells(self, spec):
+        if "rows" not in spec:  # range + fields without rows clears the range
+            g = spec["range"]
+            for r in self._values[g.get("startRowIndex", 0):g.get("endRowIndex")]:
+                c0, c1 = g.get("startColumnIndex", 0), g.get("endColumnIndex", len(r))
+                r[c0:c1] = [""] * len(r[c0:c1])
+            return
+        start = spec.get("start") or {"rowIndex": spec["range"].get("startRowIndex", 0),
+                                      "columnIndex": spec["range"].get("startColumnIndex", 0)}
+        self._put(start.get("rowIndex", 0), start.get("columnIndex", 0),
+                  [[_cell_value(c) for c in row.get("values", [])] for row in spec["rows"]])
+
+    def _appendCells(self, spec):
+        while self._values and not any(str(v) != "" for v in self._values[-1]):
+            self._values.pop()
+        self._put(len(self._values), 0, [[_cell_value(c) for c in row.get("values", [])] for row in spec["rows"]])
+
+    def _deleteDimension(self, spec):
+        g = spec["range"]
+        if g["dimension"] == "ROWS":
+            del self._values[g["startIndex"]:g["endIndex"]]
+        else:
+            for r in self._values:
+                del r[g["startIndex"]:g["endIndex"]]
+
+    def _insertDimension(self, spec):
+        g = spec["range"]
+        if g["dimension"] == "ROWS":
+            self._values[g["startIndex"]:g["startIndex"]] = [[] for _ in range(g["endIndex"] - g["startIndex"])]
+
+    def _updateSheetProperties(self, spec):
+        rows = spec["properties"].get("gridProperties", {}).get("rowCount")
+        if rows is not None:  # shrinking the grid drops the rows below it
+            del self._values[rows:]
+
+    def _put(self, r0, c0, rows):
+        for i, row in enumerate(rows):
+            while len(self._values) <= r0 + i:
+                self._values.append([])
+            line = self._values[r0 + i]
+            if len(line) < c0 + len(row):
+                line.extend([""] * (c0 + len(row) - len(line)))
+            line[c0:c0 + len(row)] = row
+
+    def _write_block(self, rng, values):
+        r0, c0, _, _ = _range_bounds(rng)
+        with self._client._lock:
+            for i, row in enumerate(values):
+                r = r0 - 1 + i
+                while len(self._values) <= r:
+                    self._values.append([])
+                line = self._values[r]
+                need = c0 - 1 + len(row)
+                if len(line) < need:
+                    line.extend([""] * (need - len(line)))
+                line[c0 - 1:need] = [_json_cell(v) for v in row]
+
+
+class StandInSpreadsheet:
+    def __init__(self, client, title):
+        self._client = client
+        self.title = title
+        self._tabs = {}
+
+    def worksheet(self, title):
+        self._client._api("worksheet")
+        with self._client._lock:
+            if title not in self._tabs:
+                raise gspread.WorksheetNotFound(title)
+            return self._tabs[title]
+
+    def worksheets(self):
+        self._client._api("worksheets")
+        with self._client._lock:
+            return list(self._tabs.values())
+
+    def batch_update(self, body):
+        """Spreadsheet-level batchUpdate: all requests or none, like the real endpoint."""
+        self._client._api("batch_update")
+        with self._client._lock:
+            by_id = {ws.id: ws for ws in self._tabs.values()}
+            work = []
+            for req in body["requests"]:
+                (kind, spec), = req.items()
+                where = spec.get("range") or spec.get("start") or spec.get("properties") or spec
+                sheet_id = where.get("sheetId")
+                if sheet_id not in by_id or not hasattr(StandInWorksheet, "_" + kind):
+                    raise api_error(400, f"Invalid request: {kind}", "INVALID_ARGUMENT")
+                work.append((getattr(by_id[sheet_id], "_" + kind), spec))
+            snapshot = {ws.id: [list(r) for r in ws._values] for ws in by_id.values()}
+            try:
+                for apply, spec in work:
+                    apply(spec)
+            except Exception:
+                for ws in by_id.values():
+                    ws._values = snapshot[ws.id]
+                raise
+        self._client._persist()
+        return {"spreadsheetId": self.title, "replies": [{} for _ in work]}
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self._client._api("add_worksheet")
+        with self._client._lock:
+            ws = self._tabs.setdefault(title, StandInWorksheet(self._client, title))
+        self._client._persist()
+        return ws
+
+
+class StandInClient:
+    """Drop-in for gspread.Client as used by app.get_client()."""
+    def __init__(self, latency_s=0.0, jitter_s=0.0, quota_per_min=None, fail_rate=0.0, path=None, seed=None):
+        self.latency_s, self.jitter_s = latency_s, jitter_s
+        self.quota_per_min, self.fail_rate = quota_per_min, fail_rate
+        self.path = path
+        self.calls = Counter()   # method -> calls (including rejected ones)
+        self.errors = Counter()  # status -> count
+        self._window = deque()   # timestamps of accepted calls (quota window)
+        self._lock = threading.RLock()
+        self._rng = random.Random(seed)
+        self._books = {}
+        self._ids = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def open(self, title):
+        with self._lock:
+            return self._books.setdefault(title, StandInSpreadsheet(self, title))
+
+    def _next_id(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    # ---- fault model ----
+    def _api(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            now = time.monotonic()
+            while self._window and now - self._window[0] > 60:
+                self._window.popleft()
+            if self.quota_per_min is not None and len(self._window) >= self.quota_per_min:
+                self.errors[429] += 1
+                raise api_error(429, "Quota exceeded for quota metric 'Read requests'", "RESOURCE_EXHAUSTED")
+            self._window.append(now)
+            fail = self._rng.random() < self.fail_rate
+            delay = self.latency_s + self._rng.uniform(0, self.jitter_s)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors[500] += 1
+            raise api_error(500, "Internal error encountered.", "INTERNAL")
+
+    # ---- persistence ----
+    def _persist(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {b: {t: ws._values for t, ws in sh._tabs.items()} for b, sh in self._books.items()}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.replace(tmp, self.path)
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        for book, tabs in data.items():
+            sh = self._books.setdefault(book, StandInSpreadsheet(self, book))
+            for title, values in tabs.items():
+                sh._tabs[title] = StandInWorksheet(self, title, values)
+
+    # ---- test helpers (no API accounting) ----
+    def frame(self, book, tab):
+        """Current tab contents as a DataFrame (header row -> columns)."""
+        sh = self._books.get(book)
+        ws = sh._tabs.get(tab) if sh else None
+        if ws is None or not ws._values:
+            return pd.DataFrame()
+        header = ws._values[0]
+        return pd.DataFrame([r + [""] * (len(header) - len(r)) for r in ws._values[1:]], columns=header)
+
+    def put_frame(self, book, tab, df):
+        sh = self.open(book)
+        with self._lock:
+            sh._tabs[tab] = StandInWorksheet(self, tab, [list(df.columns)] + df.astype(object).values.tolist())
+        self._persist()
+
+
+def seed_catalog(client, book, generated_dir=GENERATED):
+    """Load the catalog tabs from generated/*.csv (as utils/create_csv.py writes them)."""
+    for tab, filename in SEED_TABS.items():
+        df = pd.read_csv(os.path.join(generated_dir, filename), dtype=str, keep_default_na=False)
+        # numeric cells come back from Sheets as numbers
+        for c in df.columns:
+            num = pd.to_numeric(df[c], errors="coerce")
+            if num.notna().all() and len(df):
+                df[c] = num
+        client.put_frame(book, tab, df)
+    return client
+
+
+# ---------- sharing one stand-in across processes ----------
+# The app caches per process, so each simulated kiosk runs in its own process; they
+# all talk to the one StandInClient in the parent through a multiprocessing manager.
+#
+#   addr, authkey = serve(client)                 # parent
+#   client = RemoteClient(addr, authkey)          # child; drop-in for gspread.Client
+class _Dispatch:
+    def __init__(self, client):
+        self._client = client
+
+    def call(self, book, tab, method, args, kwargs):
+        """Run one worksheet/spreadsheet call; errors come back as data (they don't pickle)."""
+        try:
+            sh = self._client.open(book)
+            if tab is None:  # spreadsheet-level call; worksheet handles stay here, ids travel
+                result = getattr(sh, method)(*args, **kwargs)
+                return "ok", result.id if method in ("worksheet", "add_worksheet") else result
+            return "ok", getattr(sh.worksheet(tab), method)(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            return "api", e.response.status_code, str(e)
+        except gspread.WorksheetNotFound as e:
+            return "missing", str(e)
+
+
+class _Manager(BaseManager):
+    pass
+
+
+def serve(client):
+    """Serve client to other processes from a background thread; returns (address, authkey)."""
+    authkey = os.urandom(16)
+    dispatch = _Dispatch(client)
+    _Manager.register("sheets", callable=lambda: dispatch)
+    server = _Manager(address=("127.0.0.1", 0), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.address, authkey
+
+
+class _RemoteWorksheet:
+    def __init__(self, remote, book, title, id):
+        self._remote, self._book, self.title, self.id = remote, book, title, id
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self._remote._call(self._book, self.title, method, args, kwargs)
+        return call
+
+
+class _RemoteSpreadsheet:
+    def __init__(self, remote, title):
+        self._remote, self.title = remote, title
+
+    def worksheet(self, title):
+        return _RemoteWorksheet(self._remote, self.title, title,
+                                self._remote._call(self.title, None, "worksheet", (title,), {}))
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        return _RemoteWorksheet(self._remote, self.title, title,
+                                self._remote._call(self.title, None, "add_worksheet", (title, rows, cols), kwargs))
+
+    def batch_update(self, body):
+        return self._remote._call(self.title, None, "batch_update", (body,), {})
+
+
+class RemoteClient:
+    """Client side of serve(); one connection per thread."""
+    def __init__(self, address, authkey):
+        self._address, self._authkey = address, authkey
+        self._local = threading.local()
+
+    def _proxy(self):
+        if not hasattr(self._local, "proxy"):
+            _Manager.register("sheets")
+            mgr = _Manager(address=self._address, authkey=self._authkey)
+            mgr.connect()
+            self._local.proxy = mgr.sheets()
+        return self._local.proxy
+
+    def _call(self, book, tab, method, args, kwargs):
+        status, *rest = self._proxy().call(book, tab, method, args, kwargs)
+        if status == "api":
+            code, message = rest
+            raise api_error(code, message, "RESOURCE_EXHAUSTED" if code == 429 else "INTERNAL")
+        if status == "missing":
+            raise gspread.WorksheetNotFound(rest[0])
+        return rest[0]
+
+    def open(self, title):
+        return _RemoteSpreadsheet(self, title)
@@ -0,0 +1,72 @@
+# utils/vehicle_search_check.py
+#
+# Regression check for the vehicle model typeahead (VehicleModelIndex in app.py) against
+# the seed list: each query's top result, and that ambiguous labels resolve per class.
+#
+#   python utils/vehicle_search_check.py
+#
+# Needs no workbook or secrets; exits 1 if any expectation fails.
+import os
+import sys
+from unittest import mock
+
+import pandas as pd
+import streamlit as st
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+with mock.patch.object(st.secrets, "_secrets", {"sheets": {"workbook_name": "-"}, "gcp_service_account": {}}):
+    import app  # noqa: E402
+
+# query -> options expected first, in order (typos, joined words, aliases, ambiguous labels)
+EXPECTED = {
+    "vois":         ["TOYOTA - Vios"],
+    "hiace":        ["TOYOTA - Hi-Ace"],
+    "hi ace":       ["TOYOTA - Hi-Ace"],
+    "cherokee":     ["JEEP - Cherokee (Class 3)", "JEEP - Cherokee (Class 4)"],
+    "chevy spin":   ["Chevrolet - Spin"],
+    "xtrail":       ["Nissan - Xtrail", "NISSAN - X-Trail"],
+    "toyta coroll": ["TOYOTA - Corolla"],
+    "hliux":        ["TOYOTA - Hilux"],
+    "vw golf":      ["Volkswagen - Golf"],
+}
+EVERY_HIT = {"chevy": "CHEVROLET"}  # every result of the query has this brand
+NO_HITS = ["zzzz"]
+
+
+def main(argv=None):
+    vm = pd.DataFrame(app.VEHICLE_MODELS_SEED, columns=["brand", "model", "label", "vehicle_class"])
+    idx = app.VehicleModelIndex(vm)
+    failures = []
+    for query, want in EXPECTED.items():
+        got = idx.search(query)[:len(want)]
+        if got != want:
+            failures.append(f"search({query!r}) starts {got}, expected {want}")
+    for query, brand in EVERY_HIT.items():
+        got = idx.search(query)
+        if not got or any(idx.entry(o)["brand"].upper() != brand for o in got):
+            failures.append(f"search({query!r}) = {got}, expected only {brand} models")
+    for query in NO_HITS:
+        if idx.search(query):
+            failures.append(f"search({query!r}) should find nothing")
+
+    # one class per option; labels listed under several classes are left out of class_by_label
+    for option in idx.options:
+        if not idx.entry(option)["vehicle_class"]:
+            failures.append(f"{option!r} has no class")
+    if idx.option_for("JEEP - Cherokee", "Class 4") != "JEEP - Cherokee (Class 4)":
+        failures.append("option_for('JEEP - Cherokee', 'Class 4') is not the Class 4 option")
+    for label in ["JEEP - Cherokee", "Subaru - Forester", "SUBARU - Forester"]:
+        if label in idx.class_by_label:
+            failures.append(f"class_by_label maps ambiguous {label!r}")
+    if idx.class_by_label.get("TOYOTA - Vios") != "Class 1":
+        failures.append("class_by_label lost 'TOYOTA - Vios'")
+
+    for f in failures:
+        print("FAIL", f)
+    print(f"{len(EXPECTED) + len(EVERY_HIT) + len(NO_HITS)} queries, {len(idx.options)} options: "
+          + ("ok" if not failures else f"{len(failures)} failure(s)"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())